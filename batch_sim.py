@@ -0,0 +1,594 @@
+#!/usr/bin/env python3
+
+# Steps hundreds of copies of one level in lockstep, for search-based level
+# testing. All worlds share the level's tiles and spawn points; each one only
+# has its own hero and enemy state, kept in NumPy arrays, so a tick is a
+# handful of array operations no matter how many worlds there are.
+#
+# The rules follow Character.update, the enemy update methods and
+# Game.update (timers, dying, respawning) tick for tick. Drawing and
+# animation are left out. Run with --check to compare against game.py.
+
+import argparse
+import math
+import os
+import time
+
+os.environ.setdefault("PLATFORMER_HEADLESS", "1")
+
+import numpy as np
+
+import game
+
+# World status
+RUNNING = 0
+COMPLETED = 1
+GAME_OVER = 2
+
+STATUS_NAMES = ["running", "completed", "game over"]
+
+# Tile grid flags
+EDGE_LEFT = 1
+EDGE_RIGHT = 2
+EDGE_TOP = 4
+EDGE_BOTTOM = 8
+SOLID = 16
+
+# Enemy kinds
+BEAR = 0
+MONSTER = 1
+BIRD = 2
+
+# Powerup kinds
+ONEUP = 0
+HEART = 1
+SPEEDUP = 2
+SPEEDDOWN = 3
+
+SIZE = game.GRID_SIZE # Every sprite is one grid cell big
+
+
+def round_rect(v):
+    # pygame.Rect rounds halves away from zero when given floats
+    return np.where(v >= 0, np.floor(v + 0.5), np.ceil(v - 0.5))
+
+
+def overlaps(ax, ay, bx, by):
+    return (np.abs(ax - bx) < SIZE) & (np.abs(ay - by) < SIZE)
+
+
+class TileGrid():
+    # Static blocks rasterised to a grid fine enough that every block edge
+    # falls on a cell boundary. Each cell records which block edges start
+    # there, which is all the swept checks in TileIndex need.
+
+    def __init__(self, level):
+        rects = [block.rect for block in level.blocks]
+        res = SIZE
+
+        for rect in rects:
+            res = math.gcd(res, math.gcd(rect.x, rect.y))
+
+        self.res = res
+        self.cols = -(-level.width // res) + 1
+        self.rows = -(-level.height // res) + 1
+        self.flags = np.zeros((self.rows, self.cols), np.uint8)
+        span = SIZE // res
+
+        for rect in rects:
+            c, r = rect.x // res, rect.y // res
+
+            if r >= self.rows or c >= self.cols:
+                continue
+
+            self.flags[max(r, 0):r + span, max(c, 0):c + span] |= SOLID
+            self.flags[max(r, 0):r + span, c] |= EDGE_LEFT
+            self.flags[max(r, 0):r + span, c + span - 1] |= EDGE_RIGHT
+            self.flags[r, max(c, 0):c + span] |= EDGE_TOP
+            self.flags[r + span - 1, max(c, 0):c + span] |= EDGE_BOTTOM
+
+        # An empty border lets out of range lookups be clamped instead of masked
+        self.stride = self.cols + 2
+        self.padded = np.zeros((self.rows + 2, self.stride), np.uint8)
+        self.padded[1:-1, 1:-1] = self.flags
+        self.padded = self.padded.ravel()
+
+    def get(self, r, c):
+        c = np.minimum(np.maximum(c + 1, 0), self.stride - 1)
+
+        return self.padded.take((r + 1) * self.stride + c, mode='clip')
+
+    def collide(self, x, y):
+        # Whether each SIZE square rect overlaps a block
+        res = self.res
+        hit = np.zeros(len(x), bool)
+
+        for j in range(SIZE // res + 1):
+            r = y // res + j
+            row_ok = r <= (y + SIZE - 1) // res
+
+            for i in range(SIZE // res + 1):
+                c = x // res + i
+                col_ok = c <= (x + SIZE - 1) // res
+                hit |= row_ok & col_ok & (self.get(r, c) & SOLID > 0)
+
+        return hit
+
+    def sweep(self, pos, cross, d, vertical):
+        # Same result as TileIndex.sweep_x/sweep_y for SIZE square rects.
+        # pos is the coordinate along the motion, cross the other one.
+        # Returns how far each rect moves, whether it hit, and the cell
+        # holding the edge it stopped at.
+        res = self.res
+        fwd = d > 0
+        back = d < 0
+        lead = np.where(fwd, pos + SIZE, pos)
+        target = lead + d
+
+        start = np.where(fwd, -(-pos // res), (pos + SIZE) // res - 1)
+        end = np.where(fwd, np.ceil(target / res) - 1, np.floor(target / res)).astype(np.int64)
+        count = np.where(fwd, end - start + 1, start - end + 1)
+        count = np.where(fwd | back, np.maximum(count, 0), 0)
+        step = np.where(fwd, 1, -1)
+
+        if vertical:
+            want = np.where(fwd, EDGE_TOP, EDGE_BOTTOM)
+        else:
+            want = np.where(fwd, EDGE_LEFT, EDGE_RIGHT)
+
+        first = cross // res
+        last = (cross + SIZE - 1) // res
+
+        found = np.zeros(len(pos), bool)
+        cell = np.zeros(len(pos), np.int64)
+        steps = int(count.max()) if len(count) > 0 else 0
+
+        for k in range(steps):
+            active = (k < count) & ~found
+
+            if not active.any():
+                break
+
+            c = start + k * step
+            hit = np.zeros(len(pos), bool)
+
+            for j in range(SIZE // res + 1):
+                other = first + j
+
+                if vertical:
+                    flags = self.get(c, other)
+                else:
+                    flags = self.get(other, c)
+
+                hit |= (other <= last) & (flags & want > 0)
+
+            hit &= active
+            cell = np.where(hit, c, cell)
+            found |= hit
+
+        edge = np.where(fwd, cell * res, (cell + 1) * res)
+        move = np.where(found, edge - lead, d)
+
+        return move, found, cell
+
+
+class BatchWorlds():
+
+    def __init__(self, file_path, count):
+        self.level = game.Level(file_path, game.Scheduler())
+        self.grid = TileGrid(self.level)
+        self.count = count
+
+        level = self.level
+        self.width = level.width
+        self.height = level.height
+        self.gravity = level.gravity
+        self.terminal_velocity = level.terminal_velocity
+
+        # Spawn points shared by every world
+        enemies = level.starting_enemies
+        self.enemy_kind = np.array([BEAR if isinstance(e, game.Bear) else MONSTER if isinstance(e, game.Monster) else BIRD for e in enemies], np.int64)
+        self.enemy_points = np.array([e.point_value for e in enemies], np.int64)
+        self.enemy_start = np.array([[e.start_x, e.start_y, e.start_vx, e.start_vy] for e in enemies], float).reshape(-1, 4)
+
+        kinds = {game.OneUp: ONEUP, game.Heart: HEART, game.SpeedUp: SPEEDUP, game.SpeedDown: SPEEDDOWN}
+        self.powerup_kind = np.array([kinds[type(p)] for p in level.starting_powerups], np.int64)
+        self.powerup_value = np.array([p.value for p in level.starting_powerups], np.int64)
+
+        self.items = {}
+
+        for name, sprites in [("coins", level.starting_coins), ("alt_coins", level.starting_alt_coins),
+                              ("powerups", level.starting_powerups), ("prizes", level.starting_prizes),
+                              ("keys", level.starting_keys), ("chests", level.starting_chests),
+                              ("flag", level.starting_flag)]:
+            self.items[name] = np.array([[s.rect.x, s.rect.y] for s in sprites], np.int64).reshape(-1, 2)
+
+        self.reset()
+
+    def reset(self):
+        n = self.count
+        E = len(self.enemy_kind)
+
+        self.tick = 0
+        self.status = np.zeros(n, np.int64)
+        self.steps = np.zeros(n, np.int64)
+
+        # Hero, same fields as Character
+        self.x = np.full(n, float(self.level.start_x))
+        self.y = np.full(n, float(self.level.start_y))
+        self.vx = np.zeros(n)
+        self.vy = np.zeros(n)
+        self.on_ground = np.ones(n, bool)
+        self.crouching = np.zeros(n, bool)
+        self.has_key = np.zeros(n, bool)
+        self.speed = np.full(n, 5)
+        self.normal_speed = np.full(n, 5)
+        self.jump_power = 20
+        self.score = np.zeros(n, np.int64)
+        self.power_ups_collected = np.zeros(n, np.int64)
+        self.enemies_slain = np.zeros(n, np.int64)
+        self.collected_coins = np.zeros(n, np.int64)
+        self.total_collected_coins = np.zeros(n, np.int64)
+        self.lives = np.full(n, 3)
+        self.hearts = np.full(n, 3)
+        self.max_hearts = 3
+        self.invincible_until = np.zeros(n, np.int64)
+        self.powerup_time = np.zeros(n, np.int64)
+        self.powerup_due = np.full(n, -1)
+        self.time_limit = np.full(n, 300)
+
+        # Enemies
+        self.ex = np.zeros((n, E))
+        self.ey = np.zeros((n, E))
+        self.evx = np.zeros((n, E))
+        self.evy = np.zeros((n, E))
+        self.enemy_alive = np.zeros((n, E), bool)
+
+        self.alive = {}
+
+        for name, positions in self.items.items():
+            self.alive[name] = np.ones((n, len(positions)), bool)
+
+        self.chest_opened = np.zeros(n, bool)
+        self.reset_level(np.ones(n, bool))
+
+    def reset_level(self, worlds):
+        # Level.reset for the selected worlds
+        self.ex[worlds] = self.enemy_start[:, 0]
+        self.ey[worlds] = self.enemy_start[:, 1]
+        self.evx[worlds] = self.enemy_start[:, 2]
+        self.evy[worlds] = self.enemy_start[:, 3]
+        self.enemy_alive[worlds] = True
+
+        for name in self.alive:
+            self.alive[name][worlds] = True
+
+        self.chest_opened[worlds] = False
+
+    def respawn(self, worlds):
+        self.x[worlds] = self.level.start_x
+        self.y[worlds] = self.level.start_y
+        self.hearts[worlds] = self.max_hearts
+        self.score[worlds] = 0
+        self.powerup_time[worlds] = 0
+        self.powerup_due[worlds] = -1
+        self.speed[worlds] = self.normal_speed[worlds]
+        self.invincible_until[worlds] = self.tick
+        self.has_key[worlds] = False
+
+    def hits(self, name, worlds):
+        positions = self.items[name]
+        hit = overlaps(self.x[:, None], self.y[:, None], positions[None, :, 0], positions[None, :, 1])
+        hit &= self.alive[name] & worlds[:, None]
+
+        return hit
+
+    def apply_input(self, buttons, worlds):
+        # Game.apply_input
+        jump = worlds & (buttons & game.INPUT_JUMP > 0)
+        jump &= self.grid.collide(self.x.astype(np.int64), self.y.astype(np.int64) + 1)
+        self.vy = np.where(jump, -self.jump_power, self.vy)
+
+        down = buttons & game.INPUT_DOWN > 0
+        start = worlds & down & ~self.crouching
+        self.speed = np.where(start & self.on_ground, 2, self.speed)
+        self.crouching = np.where(worlds, down, self.crouching)
+
+        left = buttons & game.INPUT_LEFT > 0
+        right = buttons & game.INPUT_RIGHT > 0
+        vx = np.where(left, -self.speed, np.where(right, self.speed, 0))
+        self.vx = np.where(worlds, vx, self.vx)
+
+    def run_timers(self, worlds):
+        # Game.count_down and Character.count_down_powerup
+        if self.tick % 60 == 0:
+            self.time_limit[worlds] -= 1
+            out = worlds & (self.time_limit == 0)
+            self.hearts[out] = 0
+            self.time_limit[out] = 300
+
+        due = worlds & (self.powerup_due == self.tick)
+        self.powerup_time[due] -= 1
+        done = due & (self.powerup_time <= 0)
+        self.powerup_time[done] = 0
+        self.normal_speed[done] = 5
+        self.powerup_due[done] = -1
+        self.powerup_due[due & ~done] += 60
+
+    def update_hero(self, w):
+        # Character.update, w is the mask of worlds being stepped
+        tick = self.tick
+
+        # process_enemies
+        touching = overlaps(self.x[:, None], self.y[:, None], self.ex, self.ey) & self.enemy_alive & w[:, None]
+        invincibility = np.maximum(0, self.invincible_until - tick)
+        hurt = touching.any(axis=1) & (invincibility == 0) & (self.vy == 0)
+        self.hearts[hurt] -= 1
+        self.invincible_until[hurt] = tick + int(0.75 * game.FPS)
+
+        stomp = touching & ~self.on_ground[:, None]
+        stomped = stomp.any(axis=1)
+        self.enemy_alive &= ~stomp
+
+        # Only the first enemy scores, the bounce makes vy negative for the rest
+        scored = stomped & (self.vy > 0)
+        first = np.argmax(stomp, axis=1)
+        self.score[scored] += self.enemy_points[first[scored]]
+        self.enemies_slain[scored] += 1
+        self.vy[scored] = -15
+
+        # apply_gravity and move_and_process_blocks
+        self.vy = np.where(w, np.minimum(self.vy + self.gravity, self.terminal_velocity), self.vy)
+
+        x = self.x.astype(np.int64)
+        y = self.y.astype(np.int64)
+        dx, hit, cell = self.grid.sweep(x, y, np.where(w, self.vx, 0), False)
+        self.x = np.where(w, round_rect(self.x + dx), self.x)
+        self.vx = np.where(w & hit, 0, self.vx)
+
+        x = self.x.astype(np.int64)
+        dy, hit, cell = self.grid.sweep(y, x, np.where(w, self.vy, 0), True)
+        self.y = np.where(w, round_rect(self.y + dy), self.y)
+        self.on_ground = np.where(w, hit & (self.vy > 0), self.on_ground)
+        self.vy = np.where(w & hit, 0, self.vy)
+
+        # check_world_boundaries
+        self.x = np.where(w, np.clip(self.x, 0, self.width - SIZE), self.x)
+        fell = w & (self.y > self.height) & ~self.on_ground
+        self.hearts[fell] = 0
+
+        alive = w & (self.hearts > 0)
+
+        # process_coins and process_alt_coins
+        for name, points in [("coins", 100), ("alt_coins", 200)]:
+            hit = self.hits(name, alive)
+            self.alive[name] &= ~hit
+            got = hit.sum(axis=1)
+            self.score += points * got
+            self.collected_coins += got
+            self.total_collected_coins += got
+            self.lives += self.collected_coins // 10
+            self.collected_coins %= 10
+
+        # process_powerups
+        hit = self.hits("powerups", alive)
+        self.alive["powerups"] &= ~hit
+        self.power_ups_collected += hit.sum(axis=1)
+        self.score += (hit * self.powerup_value).sum(axis=1)
+
+        def kind_count(kind):
+            return (hit & (self.powerup_kind == kind)).sum(axis=1)
+
+        self.lives += kind_count(ONEUP)
+
+        if self.max_hearts != 3:
+            self.hearts += kind_count(HEART)
+
+        speedups = kind_count(SPEEDUP)
+        speeddowns = kind_count(SPEEDDOWN)
+        self.normal_speed += 2 * speedups - 2 * speeddowns
+        timed = speedups + speeddowns
+        self.powerup_time += 10 * timed
+        start = (timed > 0) & (self.powerup_due < 0)
+        self.powerup_due[start] = tick + 60
+
+        # process_prizes, process_key and process_chest
+        hit = self.hits("prizes", alive)
+        self.alive["prizes"] &= ~hit
+        self.score += 200 * hit.sum(axis=1)
+        self.lives += hit.sum(axis=1)
+
+        hit = self.hits("keys", alive)
+        self.alive["keys"] &= ~hit
+        self.has_key |= hit.any(axis=1)
+
+        hit = self.hits("chests", alive & self.has_key)
+        self.alive["chests"] &= ~hit
+        opened = hit.any(axis=1)
+        self.chest_opened |= opened
+        self.has_key &= ~opened
+
+        # check_flag, with the same bonus rules
+        done = alive & self.hits("flag", alive).any(axis=1)
+        t = self.time_limit
+        bonus = np.where(t >= 330, 500, 0) + np.where((t <= 329) & (t >= 150), 250, 0)
+        bonus += np.where((t <= 149) & (t >= 50), 175, 105)
+        self.score[done] += bonus[done]
+        self.status[done] = COMPLETED
+
+        # crouch
+        self.speed = np.where(alive & self.crouching & self.on_ground, 2, self.speed)
+        self.speed = np.where(alive & ~self.crouching, self.normal_speed, self.speed)
+
+        # die
+        dead = w & ~alive
+        self.lives[dead] -= 1
+        self.speed[dead] = self.normal_speed[dead]
+
+    def update_enemies(self, w):
+        near = np.abs(self.ex - self.x[:, None]) < 2 * game.VIEW_WIDTH
+        moving = near & self.enemy_alive & w[:, None]
+        rows, cols = np.nonzero(moving)
+
+        if len(rows) == 0:
+            return
+
+        kind = self.enemy_kind[cols]
+        x = self.ex[rows, cols]
+        y = self.ey[rows, cols]
+        vx = self.evx[rows, cols]
+        vy = self.evy[rows, cols]
+
+        vy = np.where(kind != BIRD, np.minimum(vy + self.gravity, self.terminal_velocity), vy)
+
+        dx, hit, cell = self.grid.sweep(x.astype(np.int64), y.astype(np.int64), vx, False)
+        x = round_rect(x + dx)
+        vx = np.where(hit, -vx, vx)
+
+        ix = x.astype(np.int64)
+        dy, hit, cell = self.grid.sweep(y.astype(np.int64), ix, vy, True)
+        y = round_rect(y + dy)
+
+        # Monsters turn around at ledges, or any time they aren't landing on something
+        edge_x = np.where(vx > 0, ix + SIZE - 1, ix) // self.grid.res
+        supported = hit & (vy >= 0) & (self.grid.get(cell, edge_x) & EDGE_TOP > 0)
+        vx = np.where((kind == MONSTER) & ~supported, -vx, vx)
+        vy = np.where(hit, 0, vy)
+
+        # check_world_boundaries
+        out = (x < 0) | (x + SIZE > self.width)
+        x = np.clip(x, 0, self.width - SIZE)
+        vx = np.where(out, -vx, vx)
+
+        self.ex[rows, cols] = x
+        self.ey[rows, cols] = y
+        self.evx[rows, cols] = vx
+        self.evy[rows, cols] = vy
+
+    def step(self, buttons):
+        # One Game.process_events + Game.update for every running world
+        w = self.status == RUNNING
+
+        if not w.any():
+            return
+
+        self.apply_input(buttons, w)
+        self.tick += 1
+        self.run_timers(w)
+        self.update_hero(w)
+        self.update_enemies(w)
+        self.steps[w] += 1
+
+        # Game.update
+        over = w & (self.status == RUNNING) & (self.lives == 0)
+        self.status[over] = GAME_OVER
+
+        dead = w & (self.status == RUNNING) & (self.hearts == 0)
+
+        if dead.any():
+            self.reset_level(dead)
+            self.respawn(dead)
+
+    def run(self, inputs):
+        # inputs has one row of buttons per tick, one column per world
+        for buttons in inputs:
+            if not (self.status == RUNNING).any():
+                break
+
+            self.step(buttons)
+
+    def outcomes(self):
+        return [{"status": STATUS_NAMES[self.status[i]],
+                 "steps": int(self.steps[i]),
+                 "score": int(self.score[i]),
+                 "lives": int(self.lives[i]),
+                 "hearts": int(self.hearts[i]),
+                 "coins": int(self.total_collected_coins[i]),
+                 "enemies_slain": int(self.enemies_slain[i]),
+                 "x": int(self.x[i])} for i in range(self.count)]
+
+
+def random_inputs(ticks, worlds, seed):
+    # Mostly running right with some jumping, a crude stand-in for a search policy
+    rng = np.random.default_rng(seed)
+    moves = rng.choice([0, game.INPUT_LEFT, game.INPUT_RIGHT, game.INPUT_DOWN], size=(ticks, worlds), p=[0.15, 0.2, 0.6, 0.05])
+    jumps = np.where(rng.random((ticks, worlds)) < 0.1, game.INPUT_JUMP, 0)
+
+    return (moves | jumps).astype(np.int64)
+
+
+def run_reference(file_path, inputs):
+    # Plays one column of inputs through the real Game, for --check
+    game.levels = [file_path]
+    g = game.Game()
+    game.game = g
+    g.stage = game.Game.PLAYING
+    states = []
+
+    for buttons in inputs:
+        if g.stage != game.Game.PLAYING:
+            break
+
+        g.apply_input(int(buttons))
+        g.update()
+        states.append((g.hero.rect.x, g.hero.rect.y, g.hero.score, g.hero.lives, g.hero.hearts))
+
+    return states
+
+
+def check(file_path, ticks, worlds, seed):
+    inputs = random_inputs(ticks, worlds, seed)
+    batch = BatchWorlds(file_path, worlds)
+    expected = [run_reference(file_path, inputs[:, i]) for i in range(worlds)]
+    mismatches = 0
+
+    for t in range(ticks):
+        batch.step(inputs[t])
+
+        for i in range(worlds):
+            if t < len(expected[i]):
+                got = (int(batch.x[i]), int(batch.y[i]), int(batch.score[i]), int(batch.lives[i]), int(batch.hearts[i]))
+
+                if got != expected[i][t]:
+                    print("World", i, "differs at tick", t, "expected", expected[i][t], "got", got)
+                    mismatches += 1
+                    expected[i] = []
+
+    print("Checked", worlds, "worlds for", ticks, "ticks,", mismatches, "mismatches")
+
+    return mismatches
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Step many copies of a level at once.")
+    parser.add_argument("level", nargs="?", default=game.levels[0])
+    parser.add_argument("--worlds", type=int, default=500)
+    parser.add_argument("--ticks", type=int, default=3600)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--check", action="store_true", help="compare a few worlds against game.py")
+    args = parser.parse_args()
+
+    if args.check:
+        return 1 if check(args.level, args.ticks, min(args.worlds, 8), args.seed) > 0 else 0
+
+    batch = BatchWorlds(args.level, args.worlds)
+    inputs = random_inputs(args.ticks, args.worlds, args.seed)
+
+    start = time.perf_counter()
+    batch.run(inputs)
+    elapsed = time.perf_counter() - start
+
+    results = batch.outcomes()
+    total = int(batch.steps.sum())
+
+    for name in STATUS_NAMES:
+        print(name + ":", sum(1 for r in results if r["status"] == name))
+
+    print("best score:", max(r["score"] for r in results))
+    print(total, "world steps in", round(elapsed, 2), "s,", int(total / elapsed), "steps per second")
+
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
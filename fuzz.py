@@ -0,0 +1,463 @@
+#!/usr/bin/env python3
+
+# Plays seeded random input through the real Game, headless and as fast as
+# it will go, checking invariants after every tick. A failing input is
+# shrunk to a short replay that still breaks the same invariant and saved
+# so it can be played back with --replay.
+#
+# Input is a list of [buttons, ticks] steps, like holding a few keys for a
+# while. Shrinking drops steps, shortens them and clears buttons one at a
+# time, keeping each change that still fails. An exception from the game
+# counts as breaking the "crash" invariant and is shrunk the same way.
+#
+#   python fuzz.py --runs 200 --ticks 3000 --jobs 4
+#   python fuzz.py --ignore score --ignore heart-heals
+#   python fuzz.py --replay fuzz/heart-heals-17.json --video captures/heart-heals-17
+
+import argparse
+import contextlib
+import json
+import multiprocessing
+import os
+import random
+import time
+import traceback
+
+os.environ.setdefault("PLATFORMER_HEADLESS", "1")
+
+import game
+
+OUT_DIR = "fuzz"
+STUCK_TICKS = 10 * game.FPS # No movement for this long despite a free jump is a stuck hero
+CLOCK_TICKS = 2 * game.FPS # The time limit has to go down at least this often while playing
+SHRINK_BUDGET = 200 # Most replays tried while shrinking one failure, each one starts a fresh game
+ALT_COIN_VALUE = 200 # Character.process_alt_coins ignores the coin's own value
+
+BUTTONS = [0, game.INPUT_LEFT, game.INPUT_RIGHT, game.INPUT_DOWN, game.INPUT_LEFT | game.INPUT_DOWN,
+           game.INPUT_RIGHT | game.INPUT_DOWN]
+
+
+class Violation(Exception):
+
+    def __init__(self, name, tick, message):
+        super().__init__(name + " at tick " + str(tick) + ": " + message)
+        self.name = name
+        self.tick = tick
+
+
+def random_steps(rng, ticks):
+    # Mostly running right with jumps mixed in, held for a few ticks to a second or so
+    steps = []
+    total = 0
+
+    while total < ticks:
+        buttons = rng.choices(BUTTONS, weights=[2, 3, 8, 1, 1, 1])[0]
+
+        if rng.random() < 0.4:
+            buttons |= game.INPUT_JUMP
+
+        count = min(rng.randint(1, 60), ticks - total)
+        steps.append([buttons, count])
+        total += count
+
+    return steps
+
+
+def flag_bonus(time_left):
+    # What finishing is meant to be worth, one tier only
+    if time_left >= 330:
+        return 500
+    elif time_left >= 150:
+        return 250
+    elif time_left >= 50:
+        return 175
+    else:
+        return 105
+
+
+class Checker():
+    # Watches one Game and raises Violation when an invariant breaks. Sprites
+    # that leave a group are noticed by the group's size changing, so a
+    # quiet tick costs a few comparisons.
+
+    def __init__(self, g, ignore=()):
+        self.g = g
+        self.ignore = ignore
+        self.restart()
+
+    def restart(self):
+        self.level = self.g.level
+        self.known = {name: set(getattr(self.level, name)) for name in ["coins", "alt_coin", "powerups", "prize", "enemies"]}
+        self.still = 0
+        self.free_jump = False
+        self.last_pos = self.g.hero.rect.topleft
+        self.last_time = self.g.time_limit
+        self.clock = 0
+
+    def removed(self, name):
+        group = getattr(self.level, name)
+        known = self.known[name]
+
+        if len(group) == len(known):
+            return []
+
+        current = set(group)
+        gone = [e for e in known if e not in current]
+        self.known[name] = current
+
+        return gone
+
+    def before(self, buttons):
+        hero = self.g.hero
+        tiles = self.level.tiles
+        self.score = hero.score
+        self.hearts = hero.hearts
+        self.lives = hero.lives
+        self.invincibility = hero.invincibility
+        self.completed = self.level.completed
+
+        # A jump from the ground with nothing overhead has to move the hero
+        if buttons & game.INPUT_JUMP and len(tiles.collide(hero.rect.move(0, 1))) > 0 and \
+           len(tiles.collide(hero.rect.move(0, -1))) == 0:
+            self.free_jump = True
+
+    def after(self, tick):
+        g = self.g
+        hero = g.hero
+        level = self.level
+
+        if g.level is not level:
+            self.restart()
+            return
+
+        def fail(name, message):
+            if name not in self.ignore:
+                raise Violation(name, tick, message)
+
+        if not 0 <= hero.hearts <= hero.max_hearts:
+            fail("hearts", "hearts " + str(hero.hearts) + " of " + str(hero.max_hearts))
+
+        if hero.lives < 0:
+            fail("lives", "lives " + str(hero.lives))
+
+        if hero.rect.left < 0 or hero.rect.right > level.width:
+            fail("inside-width", "hero at x " + str(hero.rect.x) + " in a level " + str(level.width) + " wide")
+
+        if hero.rect.top > level.height:
+            fail("fell-out", "hero at y " + str(hero.rect.y) + " below a level " + str(level.height) + " high")
+
+        for block in level.tiles.collide(hero.rect):
+            if block in level.blocks:
+                fail("inside-block", "hero " + str(tuple(hero.rect)) + " overlaps block " + str(tuple(block.rect)))
+
+        # Everything picked up or stomped this tick
+        coins = self.removed("coins")
+        alt_coins = self.removed("alt_coin")
+        powerups = self.removed("powerups")
+        prizes = self.removed("prize")
+        stomped = self.removed("enemies")
+        respawned = hero.lives < self.lives and hero.hearts == hero.max_hearts
+
+        if respawned:
+            self.restart()
+            return
+
+        hurt = hero.invincibility > self.invincibility
+        healed = [p for p in powerups if isinstance(p, game.Heart)]
+
+        if len(healed) > 0 and self.hearts < hero.max_hearts and not hurt and hero.hearts <= self.hearts:
+            fail("heart-heals", "picked up a heart with " + str(self.hearts) + " of " + str(hero.max_hearts) +
+                 " hearts and still has " + str(hero.hearts))
+
+        expected = self.score + sum(c.value for c in coins) + ALT_COIN_VALUE * len(alt_coins)
+        expected += sum(p.value for p in powerups) + sum(p.value for p in prizes)
+        expected += sum(e.point_value for e in stomped)
+
+        if level.completed and not self.completed:
+            expected += flag_bonus(g.time_limit)
+
+        if hero.score != expected:
+            fail("score", "score went from " + str(self.score) + " to " + str(hero.score) + ", expected " + str(expected))
+
+        # Stuck states
+        if hero.rect.topleft == self.last_pos:
+            self.still += 1
+        else:
+            self.still = 0
+            self.free_jump = False
+            self.last_pos = hero.rect.topleft
+
+        if self.still >= STUCK_TICKS and self.free_jump:
+            fail("stuck", "hero hasn't moved from " + str(self.last_pos) + " in " + str(self.still) + " ticks")
+
+        if g.time_limit == self.last_time:
+            self.clock += 1
+        else:
+            self.clock = 0
+            self.last_time = g.time_limit
+
+        if self.clock > CLOCK_TICKS:
+            fail("clock", "time left stuck at " + str(g.time_limit))
+
+
+def play(g, steps, ignore=(), record=False):
+    # Runs steps from a fresh game. Returns the ticks played, raises Violation.
+    # An exception from the game is a Violation of the "crash" invariant.
+    # With record every tick is drawn and kept by the current recording.
+    tick = 0
+
+    try:
+        with contextlib.redirect_stdout(None):
+            g.reset()
+            g.stage = game.Game.PLAYING
+            checker = Checker(g, ignore)
+
+            for buttons, count in steps:
+                for i in range(count):
+                    if g.stage != game.Game.PLAYING:
+                        # Over or finished, start again with the rest of the input
+                        g.reset()
+                        g.stage = game.Game.PLAYING
+                        checker.restart()
+
+                    checker.before(buttons)
+                    g.apply_input(buttons)
+                    g.update()
+
+                    if record:
+                        # No need to show it, and no dropped frames
+                        g.render()
+                        game.capture.frame(g.window, wait=True)
+
+                    checker.after(tick)
+                    tick += 1
+    except Violation:
+        raise
+    except Exception as e:
+        raise Violation("crash", tick, type(e).__name__ + ": " + str(e)) from e
+
+    return tick
+
+
+def fails_with(g, steps, name):
+    try:
+        play(g, steps)
+    except Violation as v:
+        return v if v.name == name else None
+
+    return None
+
+
+def truncate(steps, ticks):
+    out = []
+    total = 0
+
+    for buttons, count in steps:
+        if total >= ticks:
+            break
+
+        count = min(count, ticks - total)
+        out.append([buttons, count])
+        total += count
+
+    return out
+
+
+def shrink(g, steps, violation, budget=SHRINK_BUDGET):
+    # Greedy shrinking, each pass tries smaller inputs and keeps any that
+    # still break the same invariant
+    name = violation.name
+    steps = truncate(steps, violation.tick + 1)
+    tries = 0
+
+    def attempt(candidate):
+        nonlocal tries, steps, violation
+
+        if tries >= budget or len(candidate) == 0:
+            return False
+
+        tries += 1
+        v = fails_with(g, candidate, name)
+
+        if v is None:
+            return False
+
+        steps = truncate(candidate, v.tick + 1)
+        violation = v
+
+        return True
+
+    changed = True
+
+    while changed and tries < budget:
+        changed = False
+
+        # Drop runs of steps, halving the run length down to single steps
+        size = max(1, len(steps) // 2)
+
+        while size >= 1:
+            i = 0
+
+            while i < len(steps):
+                if attempt(steps[:i] + steps[i + size:]):
+                    changed = True
+                else:
+                    i += size
+
+            size //= 2
+
+        # Shorter steps
+        for i in range(len(steps)):
+            if i < len(steps) and steps[i][1] > 1:
+                candidate = [list(s) for s in steps]
+                candidate[i][1] //= 2
+                changed = attempt(candidate) or changed
+
+        # Fewer buttons
+        for i in range(len(steps)):
+            for bit in [game.INPUT_JUMP, game.INPUT_DOWN, game.INPUT_LEFT, game.INPUT_RIGHT]:
+                if i < len(steps) and steps[i][0] & bit:
+                    candidate = [list(s) for s in steps]
+                    candidate[i][0] &= ~bit
+                    changed = attempt(candidate) or changed
+
+        # Merge neighbours that ended up the same
+        merged = []
+
+        for buttons, count in steps:
+            if len(merged) > 0 and merged[-1][0] == buttons:
+                merged[-1][1] += count
+            else:
+                merged.append([buttons, count])
+
+        steps = merged
+
+    return steps, violation
+
+
+def save_replay(level, seed, name, message, steps, ignore):
+    os.makedirs(OUT_DIR, exist_ok=True)
+    path = os.path.join(OUT_DIR, name + "-" + str(seed) + ".json")
+
+    with open(path, 'w') as f:
+        json.dump({"level": level, "seed": seed, "invariant": name, "message": message, "ignore": list(ignore),
+                   "steps": steps}, f)
+
+    return path
+
+
+def fuzz_seed(args):
+    # One seeded run, shrunk if it fails. Runs in a worker process.
+    level, seed, ticks, budget, ignore = args
+    game.levels = [level]
+    g = fuzz_seed.game
+
+    if g is None:
+        g = fuzz_seed.game = game.Game()
+        game.game = g
+
+    steps = random_steps(random.Random(seed), ticks)
+
+    try:
+        played = play(g, steps, ignore)
+    except Violation as v:
+        start = time.perf_counter()
+        small, shrunk = shrink(g, steps, v, budget)
+        return seed, v.tick + 1, time.perf_counter() - start, shrunk.name, str(shrunk), small
+
+    return seed, played, 0, None, None, None
+
+fuzz_seed.game = None
+
+
+def replay(path, video=None):
+    with open(path) as f:
+        data = json.load(f)
+
+    game.levels = [data["level"]]
+    g = game.Game()
+    game.game = g
+
+    if video is not None:
+        game.capture.start_recording(video)
+
+    start = time.perf_counter()
+
+    try:
+        ticks = play(g, data["steps"], data.get("ignore", ()), video is not None)
+    except Violation as v:
+        if v.__cause__ is not None:
+            traceback.print_exception(v.__cause__)
+
+        print("Fails:", v)
+        return 1
+    finally:
+        if video is not None:
+            game.capture.close()
+            print("Rendered in", round(time.perf_counter() - start, 2), "s")
+
+    print("Passes,", ticks, "ticks")
+
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fuzz the game with seeded random input.")
+    parser.add_argument("level", nargs="?", default=game.levels[0])
+    parser.add_argument("--runs", type=int, default=100)
+    parser.add_argument("--ticks", type=int, default=3000, help="ticks of input per run")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the first run, the rest count up from it")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--shrink-budget", type=int, default=SHRINK_BUDGET)
+    parser.add_argument("--ignore", action="append", default=[], metavar="INVARIANT",
+                        help="don't stop for a known failure, so runs can go on to find others")
+    parser.add_argument("--replay", help="play back a saved failure")
+    parser.add_argument("--video", metavar="DIR", help="with --replay, write every frame of it to DIR")
+    args = parser.parse_args()
+
+    if args.replay:
+        return replay(args.replay, args.video)
+
+    work = [(args.level, seed, args.ticks, args.shrink_budget, tuple(args.ignore)) for seed in range(args.seed, args.seed + args.runs)]
+    start = time.perf_counter()
+    total = 0
+    shrinking = 0
+    failures = {}
+
+    if args.jobs > 1:
+        pool = multiprocessing.Pool(args.jobs)
+        results = pool.imap_unordered(fuzz_seed, work)
+    else:
+        pool = None
+        results = map(fuzz_seed, work)
+
+    for seed, played, shrink_time, name, message, steps in results:
+        total += played
+        shrinking += shrink_time
+
+        if name is not None:
+            failures.setdefault(name, []).append((sum(c for b, c in steps), seed, message, steps))
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    elapsed = time.perf_counter() - start
+
+    for name, found in sorted(failures.items()):
+        # The shortest replay of each kind of failure is the one worth keeping
+        ticks, seed, message, steps = min(found)
+        path = save_replay(args.level, seed, name, message, steps, args.ignore)
+        print(name + ":", len(found), "runs, shortest", ticks, "ticks (seed " + str(seed) + "):", message)
+        print("  saved", path)
+
+    # Shrinking replays from a fresh game each try, so it is timed on its own
+    fuzzing = max(elapsed - shrinking / args.jobs, 1e-9)
+    print(args.runs, "runs,", total, "ticks in", round(fuzzing, 2), "s,", int(total / fuzzing * 60), "ticks per minute,",
+          round(shrinking, 2), "s shrinking")
+
+    return 1 if len(failures) > 0 else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
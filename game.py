@@ -1,21 +1,100 @@
 #!/usr/bin/env python3
 
+import atexit
+import collections
+import gc
+import gzip
+import heapq
 import json
-import pygame
+import math
+import os
+import queue
+import sqlite3
 import sys
+import threading
+import time
+import tracemalloc
+import weakref
+
+# Headless runs (tests, simulations, replays) use SDL's dummy drivers
+HEADLESS = os.environ.get("PLATFORMER_HEADLESS") == "1"
+
+if HEADLESS:
+    os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+    os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+import pygame
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 pygame.mixer.pre_init()
 pygame.init()
 
+
+def option(name, env, default):
+    # A setting given as "--name value" on the command line or in an environment variable
+    if name in sys.argv[:-1]:
+        return sys.argv[sys.argv.index(name) + 1]
+
+    return os.environ.get(env, default)
+
+
 # Window settings
 TITLE = "Platformer"
-WIDTH = 960
-HEIGHT = 640
+VIEW_WIDTH = 960 # How much of the level is on screen at once, in level pixels
+VIEW_HEIGHT = 640
+RENDER_SIZE = option("--render-size", "PLATFORMER_RENDER_SIZE", "960x640") # Backbuffer resolution, the level is drawn at this size
+WIDTH, HEIGHT = [int(n) for n in RENDER_SIZE.split("x")]
+RENDER_SCALE = min(WIDTH / VIEW_WIDTH, HEIGHT / VIEW_HEIGHT) # Backbuffer pixels per level pixel
+WINDOW_WIDTH = 960 # Output size, the window can also be resized while playing
+WINDOW_HEIGHT = 640
+SCALE_MODE = "integer" # "integer" for crisp whole-number scaling, "smooth" to fill the window
 FPS = 60
 GRID_SIZE = 64
+CHUNK_SIZE = 512 # Static sprites are baked into square chunks this many pixels wide
+CHUNKS_KEPT = 24 # Baked chunks kept around, the least recently drawn go first
 
 # Options
 sound_on = True
+DEV_MODE = "--dev" in sys.argv or os.environ.get("PLATFORMER_DEV") == "1" # Hot reloads levels and images
+HOT_RELOAD_INTERVAL = 0.05 # Seconds between checks for changed files
+
+# Audio
+AUDIO_CHANNELS = 8
+
+# Telemetry
+TELEMETRY = "--telemetry" in sys.argv or os.environ.get("PLATFORMER_TELEMETRY") == "1"
+TELEMETRY_DIR = "telemetry" # One gzipped JSON lines file per session
+TELEMETRY_SAMPLE = int(option("--telemetry-sample", "PLATFORMER_TELEMETRY_SAMPLE", 1)) # Keep 1 in n of each frequent event (coins, powerups, hits), deaths and level ends are always kept
+TELEMETRY_BUFFER = 8192 # Events held in memory, the oldest are dropped if the writer falls behind
+TELEMETRY_FLUSH_INTERVAL = 2.0 # Seconds between writes
+TELEMETRY_SECTION = 960 # Width in pixels of the level sections that are timed
+
+# Run history
+RUN_HISTORY_PATH = "runs.db" # SQLite file, not used in headless runs
+RUN_HISTORY_TOP = 3 # High scores shown on the game over and victory screens
+
+# Memory
+MEMORY = "--memory" in sys.argv or os.environ.get("PLATFORMER_MEMORY") == "1" # Snapshots memory at resets, level loads and deaths
+MEMORY_GROWTH_CYCLES = 3 # Something that grows this many times in a row at the same transition is flagged
+MEMORY_SLACK = 64 * 1024 # Python allocation growth in bytes that counts as noise
+
+# Capture
+CAPTURE_DIR = "captures" # Screenshots, and a folder of numbered frames for each recording
+CAPTURE_FRAME_FORMAT = "tga" # Quick to encode and still compressed, png takes about 8 times as long
+CAPTURE_BUFFERS = 8 # Frames waiting to be written, any more are dropped
+CAPTURE_WORKERS = 2 # Threads encoding and writing frames
+
+# Ghosts
+GHOST_DIR = "ghosts" # Fastest finish of each level, raced against as a ghost
+GHOST_ALPHA = 100
+
+# Enemies
+CHASE = "--chase" in sys.argv or os.environ.get("PLATFORMER_CHASE") == "1" # Enemies head for the hero instead of just patrolling
+CHASE_DISTANCE = 24 # Furthest an enemy will chase from, in grid steps
 
 # Controls
 LEFT = pygame.K_a
@@ -25,6 +104,20 @@ JUMP = pygame.K_SPACE
 SOUND_BUTTON = pygame.K_z
 SHIFT = pygame.K_LSHIFT
 PAUSE = pygame.K_p
+EDIT = pygame.K_F1
+EDIT_SAVE = pygame.K_F2
+EDIT_NEXT = pygame.K_e
+EDIT_PREV = pygame.K_q
+EDIT_UP = pygame.K_w
+SCREENSHOT = pygame.K_F12
+RECORD = pygame.K_F10
+FRAME_STATS = pygame.K_F3
+
+# Input bits, used when the game is driven without a keyboard (replays, simulations)
+INPUT_LEFT = 1
+INPUT_RIGHT = 2
+INPUT_JUMP = 4
+INPUT_DOWN = 8
 
 # Levels
 levels = ["levels/world-1.json"]
@@ -34,35 +127,262 @@ TRANSPARENT = (0, 0, 0, 0)
 DARK_BLUE = (16, 86, 103)
 WHITE = (255, 255, 255)
 BLACK = (0, 0, 0)
+DEFAULT_BACKGROUND = BLACK # For levels with an empty "background-color"
 
 # Fonts
-FONT_SM = pygame.font.Font("assets/fonts/minya_nouvelle_bd.ttf", 32)
-FONT_MD = pygame.font.Font("assets/fonts/minya_nouvelle_bd.ttf", 64)
-FONT_LG = pygame.font.Font("assets/fonts/thats_super.ttf", 72)
+UI_SCALE = HEIGHT / 640 # The HUD and messages are laid out for a 640 high backbuffer
+
+
+def ui(n):
+    # A HUD size or position, scaled to the backbuffer
+    return int(n * UI_SCALE)
+
+
+FONT_SM = pygame.font.Font("assets/fonts/minya_nouvelle_bd.ttf", ui(32))
+FONT_MD = pygame.font.Font("assets/fonts/minya_nouvelle_bd.ttf", ui(64))
+FONT_LG = pygame.font.Font("assets/fonts/thats_super.ttf", ui(72))
+FONT_XS = pygame.font.Font("assets/fonts/minya_nouvelle_bd.ttf", ui(20)) # Frame stats
 
 # Timer
 clock = pygame.time.Clock()
 refresh_rate = 60
 
+# Frame pacing
+FRAME_BUDGET_MS = 1000 / FPS
+FRAME_HISTOGRAM_BUCKETS = [4, 8, 12, 16, 20, 25, 33, 50] # Upper bounds in ms, the last bucket is everything slower
+DEGRADE_AFTER = 30 # Frames over budget before dropping a quality level
+RESTORE_AFTER = 120 # Frames with headroom before raising it again
+
+# Optional work that can be dropped when frames run over budget, lowest quality first
+QUALITY_LEVELS = [{"parallax": False, "blink": False, "hud_interval": 8, "animate_enemies": False, "particles": False},
+                  {"parallax": False, "blink": True, "hud_interval": 4, "animate_enemies": False, "particles": True},
+                  {"parallax": True, "blink": True, "hud_interval": 2, "animate_enemies": True, "particles": True},
+                  {"parallax": True, "blink": True, "hud_interval": 1, "animate_enemies": True, "particles": True}]
+
+# Particles
+PARTICLE_CAPACITY = 16384 # The oldest particles are reused once this many are alive
+PARTICLE_GRAVITY = 0.25
+PARTICLE_SIZE = 2
+
+# Burst effects: color, particles, speed and lifetime in ticks
+PARTICLE_EFFECTS = {"coin": ((255, 215, 0), 16, 3.0, 30),
+                    "powerup": ((120, 255, 120), 32, 4.0, 45),
+                    "stomp": ((150, 90, 40), 40, 5.0, 40),
+                    "hurt": ((255, 60, 60), 20, 3.0, 25)}
+
 # Helper functions
+loaded_images = {} # File path -> surfaces made from it, so dev mode can reload them
+
 def load_image(file_path):
     img = pygame.image.load(file_path)
     img = pygame.transform.scale(img, (GRID_SIZE, GRID_SIZE))
+    loaded_images.setdefault(file_path, []).append(img)
 
     return img
 
-    
+
+def reload_image(file_path):
+    # Redraws the existing surfaces in place so every sprite using them updates
+    img = pygame.image.load(file_path)
+    img = pygame.transform.scale(img, (GRID_SIZE, GRID_SIZE))
+
+    for surface in loaded_images[file_path]:
+        surface.fill(TRANSPARENT)
+        surface.blit(img, [0, 0])
+
+    scaled_images.clear()
+
+    return loaded_images[file_path]
+
+
+# The level is drawn straight into the backbuffer at RENDER_SCALE, so a
+# lower render size means fewer pixels drawn, not just a smaller picture
+scaled_images = weakref.WeakKeyDictionary() # Image -> copy at RENDER_SCALE, see scaled()
+
+
+def scaled(img):
+    # The image as it's drawn, scaled the first time and kept while the image is in use
+    if RENDER_SCALE == 1:
+        return img
+
+    copy = scaled_images.get(img)
+
+    if copy is None:
+        w, h = img.get_size()
+        copy = pygame.transform.scale(img, (max(1, round(w * RENDER_SCALE)), max(1, round(h * RENDER_SCALE))))
+        scaled_images[img] = copy
+
+    return copy
+
+
+def to_render(n):
+    # A position in level pixels, in backbuffer pixels
+    return math.floor(n * RENDER_SCALE)
+
+
+def to_render_rect(rect):
+    left = to_render(rect[0])
+    top = to_render(rect[1])
+
+    return pygame.Rect(left, top, math.ceil((rect[0] + rect[2]) * RENDER_SCALE) - left,
+                       math.ceil((rect[1] + rect[3]) * RENDER_SCALE) - top)
+
+
 def play_sound(sound, loops=0, maxtime=0, fade_ms=0):
     if sound_on:
-        if maxtime == 0:
-            sound.play(loops, maxtime, fade_ms)
-        else:
-            sound.play(loops, maxtime, fade_ms)
+        audio.play(sound, loops, maxtime, fade_ms)
     
 
 def play_music():
     if sound_on:
-        pygame.mixer.music.play(-1)
+        audio.play_music()
+
+
+def stop_music():
+    audio.stop_music()
+
+
+# Audio
+class NullAudio():
+    # Used when there is no mixer (headless runs), every call is a no-op
+
+    def load(self, name, file_path, priority=0, min_interval=0):
+        return name
+
+    def play(self, name, loops=0, maxtime=0, fade_ms=0):
+        return None
+
+    def load_music(self, file_path):
+        pass
+
+    def play_music(self):
+        pass
+
+    def stop_music(self):
+        pass
+
+
+class AudioManager():
+    # Owns a fixed pool of mixer channels. A sound that finds no free channel
+    # steals the oldest channel playing something of equal or lower priority,
+    # otherwise it is dropped. Each sound can also only be retriggered every
+    # min_interval milliseconds so bursts (a row of coins) don't pile up.
+
+    def __init__(self, num_channels):
+        pygame.mixer.set_num_channels(num_channels)
+
+        self.channels = [pygame.mixer.Channel(i) for i in range(num_channels)]
+        self.channel_priority = [0] * num_channels
+        self.channel_started = [0] * num_channels
+
+        self.sounds = {}
+        self.priorities = {}
+        self.min_intervals = {}
+        self.last_played = {}
+
+        self.music_lock = threading.Lock() # Guards music_request, the worker checks it for stale commands
+        self.music_loaded = False # Only touched by the worker
+        self.music_wanted = False
+        self.music_request = 0
+        self.music_requests = queue.Queue() # (command, request, file path)
+
+        self.music_thread = threading.Thread(target=self._run_music, daemon=True)
+        self.music_thread.start()
+
+    def load(self, name, file_path, priority=0, min_interval=0):
+        self.sounds[name] = pygame.mixer.Sound(file_path)
+        self.priorities[name] = priority
+        self.min_intervals[name] = min_interval
+        self.last_played[name] = None
+
+        return name
+
+    def find_channel(self, priority):
+        stolen = None
+
+        for i, channel in enumerate(self.channels):
+            if not channel.get_busy():
+                return i
+
+            if self.channel_priority[i] <= priority:
+                if stolen is None or (self.channel_priority[i], self.channel_started[i]) < (self.channel_priority[stolen], self.channel_started[stolen]):
+                    stolen = i
+
+        return stolen
+
+    def play(self, name, loops=0, maxtime=0, fade_ms=0):
+        now = pygame.time.get_ticks()
+        last = self.last_played[name]
+
+        if last is not None and now - last < self.min_intervals[name]:
+            return None
+
+        priority = self.priorities[name]
+        i = self.find_channel(priority)
+
+        if i is None:
+            return None
+
+        self.channels[i].play(self.sounds[name], loops, maxtime, fade_ms)
+        self.channel_priority[i] = priority
+        self.channel_started[i] = now
+        self.last_played[name] = now
+
+        return self.channels[i]
+
+    def load_music(self, file_path):
+        # Loading the level track can take a while, so every pygame.mixer.music
+        # call is made by one worker thread and the frame thread only queues
+        # commands. A load makes all the commands before it stale.
+        with self.music_lock:
+            self.music_request += 1
+            request = self.music_request
+
+        self.music_requests.put(("load", request, file_path))
+
+    def _run_music(self):
+        while True:
+            command, request, file_path = self.music_requests.get()
+
+            with self.music_lock:
+                stale = request != self.music_request
+
+            if command == "stop":
+                pygame.mixer.music.stop()
+            elif stale:
+                # A newer track is on its way, it starts itself if music is still wanted
+                continue
+            elif command == "load":
+                pygame.mixer.music.stop()
+                self.music_loaded = False
+
+                try:
+                    pygame.mixer.music.load(file_path)
+                except pygame.error as e:
+                    print("Could not load music:", e)
+                    continue
+
+                self.music_loaded = True
+
+                if self.music_wanted:
+                    pygame.mixer.music.play(-1)
+            elif command == "play" and self.music_loaded:
+                pygame.mixer.music.play(-1)
+
+    def play_music(self):
+        self.music_wanted = True
+        self.music_requests.put(("play", self.music_request, None))
+
+    def stop_music(self):
+        # Called every frame on the end screens, so only a change is queued
+        if self.music_wanted:
+            self.music_wanted = False
+            self.music_requests.put(("stop", self.music_request, None))
+
+if HEADLESS or pygame.mixer.get_init() is None:
+    audio = NullAudio()
+else:
+    audio = AudioManager(AUDIO_CHANNELS)
 
  
 # Images
@@ -117,13 +437,903 @@ sound_on_img = load_image("assets/sounds/sound_on.png")
 sound_off_img = load_image("assets/sounds/sound_off.png")
 
 # Sounds
-JUMP_SOUND = pygame.mixer.Sound("assets/sounds/jump.wav")
-COIN_SOUND = pygame.mixer.Sound("assets/sounds/pickup_coin.wav")
-POWERUP_SOUND = pygame.mixer.Sound("assets/sounds/powerup.wav")
-HURT_SOUND = pygame.mixer.Sound("assets/sounds/hurt.ogg")
-DIE_SOUND = pygame.mixer.Sound("assets/sounds/death.wav")
-LEVELUP_SOUND = pygame.mixer.Sound("assets/sounds/level_up.wav")
-GAMEOVER_SOUND = pygame.mixer.Sound("assets/sounds/game_over.wav")
+JUMP_SOUND = audio.load("jump", "assets/sounds/jump.wav", priority=1, min_interval=50)
+COIN_SOUND = audio.load("coin", "assets/sounds/pickup_coin.wav", priority=0, min_interval=40)
+POWERUP_SOUND = audio.load("powerup", "assets/sounds/powerup.wav", priority=1, min_interval=40)
+HURT_SOUND = audio.load("hurt", "assets/sounds/hurt.ogg", priority=2, min_interval=100)
+DIE_SOUND = audio.load("die", "assets/sounds/death.wav", priority=3)
+LEVELUP_SOUND = audio.load("level_up", "assets/sounds/level_up.wav", priority=3, min_interval=1000)
+GAMEOVER_SOUND = audio.load("game_over", "assets/sounds/game_over.wav", priority=3)
+
+# Telemetry
+class NullTelemetry():
+    # Used when telemetry is off, every call is a no-op
+
+    def emit(self, kind, tick, x, y, **data):
+        pass
+
+    def sample(self, kind, tick, x, y, **data):
+        pass
+
+    def close(self):
+        pass
+
+
+class Telemetry():
+    # Game events go into a ring buffer as plain tuples, which is all the
+    # frame thread pays for. A writer thread turns them into JSON lines and
+    # appends them to a gzip file in batches.
+
+    def __init__(self, directory, sample=1, size=8192, interval=2.0):
+        os.makedirs(directory, exist_ok=True)
+        name = time.strftime("%Y%m%d-%H%M%S") + "-" + str(os.getpid()) + ".jsonl.gz"
+
+        self.file_path = os.path.join(directory, name)
+        self.sample_every = max(1, int(sample))
+        self.sampled = {} # Event kind -> events since the last one kept
+        self.buffer = collections.deque(maxlen=size)
+        self.dropped = 0
+        self.drop_lock = threading.Lock() # Only taken by the frame thread when the buffer is full
+        self.written = 0
+        self.interval = interval
+        self.stopping = threading.Event()
+        self.lock = threading.Lock() # Only taken by the writer and close()
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def emit(self, kind, tick, x, y, **data):
+        if len(self.buffer) == self.buffer.maxlen:
+            with self.drop_lock:
+                self.dropped += 1
+
+        self.buffer.append((time.time(), tick, kind, x, y, data))
+
+    def sample(self, kind, tick, x, y, **data):
+        # For events that can happen many times a second, each kind is counted on its own
+        count = self.sampled.get(kind, 0) + 1
+
+        if count >= self.sample_every:
+            count = 0
+            self.emit(kind, tick, x, y, **data)
+
+        self.sampled[kind] = count
+
+    def run(self):
+        while not self.stopping.wait(self.interval):
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            lines = []
+
+            # popleft is atomic, so the frame thread can keep appending meanwhile
+            while len(self.buffer) > 0:
+                t, tick, kind, x, y, data = self.buffer.popleft()
+                event = {"t": round(t, 3), "tick": tick, "event": kind, "x": x, "y": y}
+                event.update(data)
+                lines.append(json.dumps(event))
+
+            with self.drop_lock:
+                dropped = self.dropped
+                self.dropped = 0
+
+            if dropped > 0:
+                lines.append(json.dumps({"t": round(time.time(), 3), "event": "dropped", "count": dropped}))
+
+            if len(lines) == 0:
+                return
+
+            # Each batch is its own gzip member, gzip.open reads them back as one stream
+            with gzip.open(self.file_path, 'at', compresslevel=6) as f:
+                f.write("\n".join(lines) + "\n")
+
+            self.written += len(lines)
+
+    def close(self):
+        self.stopping.set()
+        self.thread.join()
+        self.flush()
+
+
+if TELEMETRY:
+    telemetry = Telemetry(TELEMETRY_DIR, TELEMETRY_SAMPLE, TELEMETRY_BUFFER, TELEMETRY_FLUSH_INTERVAL)
+    atexit.register(telemetry.close)
+else:
+    telemetry = NullTelemetry()
+
+
+# Run history
+class NullRunHistory():
+    # Used for headless runs so simulations don't fill up the high scores
+
+    def __init__(self):
+        self.top = []
+        self.best = {}
+
+    def record(self, level, outcome, hero, time_left):
+        pass
+
+    def refresh(self, level):
+        pass
+
+    def close(self):
+        pass
+
+
+class RunHistory():
+    # Finished and failed runs go in a SQLite table. The database is only
+    # touched by a worker thread, which writes whatever runs have queued up in
+    # one transaction and then answers queries into self.top and self.best so
+    # the end screens just read the last results. Both queries are walks of an
+    # index, so they stay quick however many runs are stored.
+
+    def __init__(self, file_path, top=3):
+        self.file_path = file_path
+        self.top_count = top
+        self.top = [] # (score, level) of the best runs on any level
+        self.best = {} # Level name -> best score
+        self.requests = queue.Queue()
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def record(self, level, outcome, hero, time_left):
+        self.requests.put(("run", (time.time(), level, outcome, hero.score, hero.total_collected_coins,
+                                   hero.power_ups_collected, hero.enemies_slain, hero.timers.tick, time_left)))
+
+    def refresh(self, level):
+        self.requests.put(("query", level))
+
+    def run(self):
+        db = sqlite3.connect(self.file_path)
+        db.execute("CREATE TABLE IF NOT EXISTS runs (time REAL, level TEXT, outcome TEXT, score INTEGER, coins INTEGER, "
+                   "powerups INTEGER, kills INTEGER, ticks INTEGER, time_left INTEGER)")
+        db.execute("CREATE INDEX IF NOT EXISTS runs_score ON runs (score)")
+        db.execute("CREATE INDEX IF NOT EXISTS runs_level_score ON runs (level, score)")
+        db.commit()
+
+        while True:
+            batch = [self.requests.get()]
+
+            while not self.requests.empty():
+                batch.append(self.requests.get())
+
+            runs = [args for kind, args in batch if kind == "run"]
+            queries = [args for kind, args in batch if kind == "query"]
+
+            if len(runs) > 0:
+                try:
+                    with db:
+                        db.executemany("INSERT INTO runs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", runs)
+                except sqlite3.Error as e:
+                    print("Could not save run:", e)
+
+            if len(queries) > 0:
+                self.query(db, queries)
+
+            if ("stop", None) in batch:
+                db.close()
+                return
+
+    def query(self, db, levels):
+        self.top = db.execute("SELECT score, level FROM runs ORDER BY score DESC LIMIT ?", (self.top_count,)).fetchall()
+        best = dict(self.best)
+
+        for level in levels:
+            best[level] = db.execute("SELECT MAX(score) FROM runs WHERE level = ?", (level,)).fetchone()[0]
+
+        self.best = best
+
+    def close(self):
+        self.requests.put(("stop", None))
+        self.thread.join()
+
+
+if HEADLESS:
+    run_history = NullRunHistory()
+else:
+    run_history = RunHistory(RUN_HISTORY_PATH, RUN_HISTORY_TOP)
+    atexit.register(run_history.close)
+
+
+# Ghosts
+# A ghost file is a header (magic, start position, frame count) followed by
+# runs of identical frames. Each run is stored as varints: how many frames,
+# the x and y change per frame and the hero's pose. Walking or falling at a
+# steady speed is one run, so a whole level is a few kB.
+GHOST_MAGIC = b"GHST1"
+
+def write_varint(out, n):
+    while n >= 0x80:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+
+    out.append(n)
+
+
+def write_signed(out, n):
+    write_varint(out, n * 2 if n >= 0 else -n * 2 - 1) # Zigzag, keeps small negatives small
+
+
+def read_varint(data, i):
+    n = 0
+    shift = 0
+
+    while True:
+        b = data[i]
+        i += 1
+        n |= (b & 0x7f) << shift
+        shift += 7
+
+        if b < 0x80:
+            return n, i
+
+
+def read_signed(data, i):
+    n, i = read_varint(data, i)
+
+    return (n >> 1) if n & 1 == 0 else -(n >> 1) - 1, i
+
+
+def read_ghost_header(data):
+    if data[:len(GHOST_MAGIC)] != GHOST_MAGIC:
+        raise ValueError("not a ghost file")
+
+    i = len(GHOST_MAGIC)
+    x, i = read_signed(data, i)
+    y, i = read_signed(data, i)
+    frames, i = read_varint(data, i)
+
+    return x, y, frames, i
+
+
+def read_ghost_runs(data, i):
+    # Decodes one run at a time, the frames are never expanded
+    while i < len(data):
+        count, i = read_varint(data, i)
+        dx, i = read_signed(data, i)
+        dy, i = read_signed(data, i)
+        pose, i = read_varint(data, i)
+
+        yield count, dx, dy, pose
+
+
+class GhostRecorder():
+
+    def start(self, hero):
+        self.start_x = hero.rect.x
+        self.start_y = hero.rect.y
+        self.x = hero.rect.x
+        self.y = hero.rect.y
+        self.frames = 0
+        self.frame = None
+        self.count = 0
+        self.runs = bytearray()
+
+    def record(self, hero):
+        frame = (hero.rect.x - self.x, hero.rect.y - self.y, hero.poses.get(hero.image, 0))
+        self.x = hero.rect.x
+        self.y = hero.rect.y
+        self.frames += 1
+
+        if frame == self.frame:
+            self.count += 1
+        else:
+            self.end_run()
+            self.frame = frame
+            self.count = 1
+
+    def end_run(self):
+        if self.count > 0:
+            dx, dy, pose = self.frame
+            write_varint(self.runs, self.count)
+            write_signed(self.runs, dx)
+            write_signed(self.runs, dy)
+            write_varint(self.runs, pose)
+
+    def finish(self):
+        self.end_run()
+        self.count = 0
+
+        data = bytearray(GHOST_MAGIC)
+        write_signed(data, self.start_x)
+        write_signed(data, self.start_y)
+        write_varint(data, self.frames)
+
+        return bytes(data + self.runs)
+
+
+class Ghost():
+    # Plays a recording back a frame at a time next to the hero
+
+    def __init__(self, data, hero):
+        self.x, self.y, self.frames, i = read_ghost_header(data)
+        self.runs = read_ghost_runs(data, i)
+        self.count = 0
+        self.pose = None
+        self.done = False
+        self.images = []
+
+        for img in hero.pose_images:
+            img = scaled(img).copy()
+            img.set_alpha(GHOST_ALPHA)
+            self.images.append(img)
+
+    def advance(self):
+        if self.count == 0:
+            try:
+                self.count, self.dx, self.dy, self.pose = next(self.runs)
+            except StopIteration:
+                self.done = True
+                return
+
+        self.count -= 1
+        self.x += self.dx
+        self.y += self.dy
+
+    def draw(self, surface, offset_x, offset_y):
+        if self.pose is not None and not self.done:
+            surface.blit(self.images[self.pose], [to_render(self.x + offset_x), to_render(self.y + offset_y)])
+
+
+class GhostStore():
+    # Keeps the fastest finish of each level
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path(self, level_path):
+        name = os.path.splitext(os.path.basename(level_path))[0]
+
+        return os.path.join(self.directory, name + ".ghost")
+
+    def load(self, level_path, poses):
+        # Returns None if there is no recording or any of it is unreadable.
+        # Every run is decoded here, so playback can't fail part way through.
+        try:
+            with open(self.path(level_path), 'rb') as f:
+                data = f.read()
+
+            x, y, frames, i = read_ghost_header(data)
+            total = 0
+
+            for count, dx, dy, pose in read_ghost_runs(data, i):
+                if count == 0 or pose >= poses:
+                    raise ValueError("bad ghost run")
+
+                total += count
+
+            if total != frames:
+                raise ValueError("ghost frame count doesn't match its runs")
+        except (OSError, ValueError, IndexError):
+            return None
+
+        return data
+
+    def save(self, level_path, data, poses):
+        # Only kept if it beats the current best
+        old = self.load(level_path, poses)
+
+        if old is not None and read_ghost_header(old)[2] <= read_ghost_header(data)[2]:
+            return False
+
+        os.makedirs(self.directory, exist_ok=True)
+
+        with open(self.path(level_path), 'wb') as f:
+            f.write(data)
+
+        return True
+
+
+# Particles
+class NullParticles():
+    # Used without NumPy and in headless runs, every call is a no-op
+
+    def burst(self, effect, rect):
+        pass
+
+    def update(self):
+        pass
+
+    def draw(self, surface, offset_x, offset_y):
+        pass
+
+    def clear(self):
+        pass
+
+
+class Particles():
+    # Every particle lives in a slot of a few preallocated arrays. New ones
+    # take the slots after the last ones handed out, wrapping around, so
+    # emitting never searches for free space. Updating and drawing are a few
+    # array operations over the slots in use, drawing writes the visible
+    # particles straight into the surface's pixels.
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.x = np.zeros(capacity, np.float32)
+        self.y = np.zeros(capacity, np.float32)
+        self.vx = np.zeros(capacity, np.float32)
+        self.vy = np.zeros(capacity, np.float32)
+        self.life = np.zeros(capacity, np.int16)
+        self.color = np.zeros((capacity, 3), np.uint8)
+        self.rng = np.random.default_rng()
+        self.head = 0
+        self.used = 0 # Slots past this have never held a particle
+
+    def emit(self, x, y, count, color, speed, life):
+        i = (self.head + np.arange(count)) % self.capacity
+        angle = self.rng.uniform(0, 2 * np.pi, count)
+        power = self.rng.uniform(0.3, 1.0, count) * speed
+
+        self.x[i] = x
+        self.y[i] = y
+        self.vx[i] = np.cos(angle) * power
+        self.vy[i] = np.sin(angle) * power - speed / 2
+        self.life[i] = self.rng.integers(life // 2, life + 1, count)
+        self.color[i] = color
+
+        self.head = (self.head + count) % self.capacity
+        self.used = min(self.capacity, self.used + count)
+
+    def burst(self, effect, rect):
+        color, count, speed, life = PARTICLE_EFFECTS[effect]
+        self.emit(rect.centerx, rect.centery, count, color, speed, life)
+
+    def update(self):
+        n = self.used
+
+        if n == 0:
+            return
+
+        self.vy[:n] += PARTICLE_GRAVITY
+        self.x[:n] += self.vx[:n]
+        self.y[:n] += self.vy[:n]
+        np.subtract(self.life[:n], 1, out=self.life[:n], where=self.life[:n] > 0)
+
+    def draw(self, surface, offset_x, offset_y):
+        n = self.used
+
+        if n == 0:
+            return
+
+        w, h = surface.get_size()
+        size = max(1, to_render(PARTICLE_SIZE))
+        sx = ((self.x[:n] + offset_x) * RENDER_SCALE).astype(np.int32)
+        sy = ((self.y[:n] + offset_y) * RENDER_SCALE).astype(np.int32)
+        visible = (self.life[:n] > 0) & (sx >= 0) & (sx < w - size) & (sy >= 0) & (sy < h - size)
+
+        if not visible.any():
+            return
+
+        sx = sx[visible]
+        sy = sy[visible]
+        color = self.color[:n][visible]
+        pixels = pygame.surfarray.pixels3d(surface)
+
+        for dx in range(size):
+            for dy in range(size):
+                pixels[sx + dx, sy + dy] = color
+
+        del pixels # Unlocks the surface
+
+    def clear(self):
+        self.life[:] = 0
+        self.used = 0
+        self.head = 0
+
+    def count(self):
+        return int(np.count_nonzero(self.life[:self.used]))
+
+
+if HEADLESS or np is None:
+    particles = NullParticles()
+else:
+    particles = Particles(PARTICLE_CAPACITY)
+
+
+# Memory
+class NullMemoryTracker():
+    # Used when memory tracking is off, every call is a no-op
+
+    def snapshot(self, label, game):
+        pass
+
+    def report(self):
+        return []
+
+
+class MemoryTracker():
+    # Takes a snapshot at each transition (reset, advance, death): surfaces
+    # and the bytes of their pixels, live levels, characters and sprites by
+    # class, the current level's groups and traced Python allocations. A
+    # number that keeps going up at the same transition means something from
+    # the earlier levels is still being held on to.
+
+    def __init__(self, cycles=3, slack=64 * 1024):
+        self.cycles = cycles
+        self.slack = slack
+        self.history = {} # label -> snapshots in order
+        self.traces = {} # label -> first tracemalloc snapshot
+        self.flagged = set()
+        self.warnings = []
+
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def measure(self, game):
+        gc.collect()
+        counts = collections.Counter()
+        surfaces = {}
+
+        # Surfaces aren't tracked by the garbage collector, so they are found
+        # through whatever refers to them
+        for obj in gc.get_objects():
+            if isinstance(obj, pygame.sprite.Sprite):
+                counts["sprites"] += 1
+                counts["sprites." + type(obj).__name__] += 1
+            elif isinstance(obj, Level):
+                counts["levels"] += 1
+            elif isinstance(obj, Character):
+                counts["characters"] += 1
+
+            for ref in gc.get_referents(obj):
+                if isinstance(ref, pygame.Surface) and ref.get_parent() is None:
+                    surfaces[id(ref)] = ref
+
+        counts["surfaces"] = len(surfaces)
+        counts["surface_bytes"] = sum(s.get_pitch() * s.get_height() for s in surfaces.values())
+        counts["python_bytes"] = tracemalloc.get_traced_memory()[0]
+
+        level = game.level
+        groups = ["blocks", "platforms", "active_sprites", "active_sprites2", "inactive_sprites"]
+        groups += [category.group for category in ENTITY_CATEGORIES.values()]
+
+        for name in groups:
+            counts["group." + name] = len(getattr(level, name))
+
+        counts["timers"] = game.timers.pending()
+
+        return counts
+
+    def snapshot(self, label, game):
+        counts = self.measure(game)
+        history = self.history.setdefault(label, [])
+        history.append(counts)
+
+        if label not in self.traces:
+            self.traces[label] = tracemalloc.take_snapshot()
+
+        if len(history) <= self.cycles:
+            return
+
+        recent = history[-self.cycles - 1:]
+
+        for key in counts:
+            values = [c[key] for c in recent]
+            grew = all(b > a for a, b in zip(values, values[1:]))
+
+            if key == "python_bytes":
+                grew = grew and values[-1] - values[0] > self.slack
+
+            if grew and (label, key) not in self.flagged:
+                self.flagged.add((label, key))
+                self.warn(label, key, history)
+
+    def warn(self, label, key, history):
+        message = "Memory: " + key + " grew from " + str(history[0][key]) + " to " + str(history[-1][key]) + \
+                  " over " + str(len(history)) + " " + label + "s"
+        self.warnings.append(message)
+        print(message)
+
+        if key == "python_bytes":
+            # Where the extra allocations were made
+            stats = tracemalloc.take_snapshot().compare_to(self.traces[label], "lineno")
+
+            for stat in stats[:5]:
+                line = "  " + str(stat)
+                self.warnings.append(line)
+                print(line)
+
+    def report(self):
+        lines = []
+
+        for label, history in self.history.items():
+            first = history[0]
+            last = history[-1]
+            lines.append(label + ": " + str(len(history)) + " snapshots")
+
+            # The totals, and anything else that changed
+            for key in sorted(last):
+                if last[key] != first[key] or key in ["levels", "sprites", "surfaces", "surface_bytes", "python_bytes"]:
+                    lines.append("  " + key + " " + str(first[key]) + " -> " + str(last[key]))
+
+        return lines + self.warnings
+
+
+if MEMORY:
+    memory = MemoryTracker(MEMORY_GROWTH_CYCLES, MEMORY_SLACK)
+else:
+    memory = NullMemoryTracker()
+
+
+# Capture
+class Capture():
+    # Frames are copied into a fixed pool of surfaces and worker threads
+    # encode and write them, so the frame thread only pays for one blit. If
+    # every surface is still waiting to be written the frame is dropped
+    # instead. Headless replays can pass wait=True to keep every frame.
+
+    def __init__(self, directory, buffers=8, workers=2, frame_format="tga"):
+        self.directory = directory
+        self.buffers = buffers
+        self.workers = workers
+        self.frame_format = frame_format
+        self.free = queue.Queue()
+        self.jobs = queue.Queue()
+        self.threads = []
+        self.pooled = False
+        self.lock = threading.Lock()
+        self.written = 0
+        self.shots = 0
+        self.recording = None # Folder of the current recording
+        self.frames = 0
+        self.dropped = 0
+
+    def start(self, surface):
+        # The pool matches the size and pixel format of the first surface
+        # captured, so copying a frame is a straight blit. It's made once,
+        # after close() the buffers are all back in free for the next start.
+        if not self.pooled:
+            for i in range(self.buffers):
+                self.free.put(pygame.Surface(surface.get_size(), 0, surface))
+
+            self.pooled = True
+
+        for i in range(self.workers):
+            thread = threading.Thread(target=self.run, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def run(self):
+        while True:
+            job = self.jobs.get()
+
+            if job is None:
+                self.jobs.task_done()
+                return
+
+            buffer, path = job
+
+            try:
+                pygame.image.save(buffer, path)
+            except (pygame.error, OSError) as e:
+                print("Could not save", path, e)
+            else:
+                with self.lock:
+                    self.written += 1
+
+            self.free.put(buffer)
+            self.jobs.task_done()
+
+    def grab(self, surface, path, wait=False):
+        if len(self.threads) == 0:
+            self.start(surface)
+
+        try:
+            buffer = self.free.get(block=wait)
+        except queue.Empty:
+            return False
+
+        buffer.blit(surface, [0, 0])
+        self.jobs.put((buffer, path))
+
+        return True
+
+    def screenshot(self, surface):
+        os.makedirs(self.directory, exist_ok=True)
+        self.shots += 1
+        name = "screenshot-" + time.strftime("%Y%m%d-%H%M%S") + "-" + str(self.shots) + ".png"
+        path = os.path.join(self.directory, name)
+
+        if self.grab(surface, path):
+            print("Screenshot", path)
+        else:
+            print("Screenshot dropped, still writing frames")
+
+    def start_recording(self, directory=None):
+        if directory is None:
+            directory = os.path.join(self.directory, time.strftime("%Y%m%d-%H%M%S"))
+
+        os.makedirs(directory, exist_ok=True)
+        self.recording = directory
+        self.frames = 0
+        self.dropped = 0
+        print("Recording to", directory)
+
+    def stop_recording(self):
+        # Waits for the frames already grabbed to be written
+        self.jobs.join()
+        print("Recorded", self.frames, "frames to", self.recording + ",", self.dropped, "dropped")
+        self.recording = None
+
+    def toggle_recording(self):
+        if self.recording is None:
+            self.start_recording()
+        else:
+            self.stop_recording()
+
+    def frame(self, surface, wait=False):
+        # Frames are numbered as they are kept, so dropping one leaves no gap
+        if self.recording is None:
+            return
+
+        name = "frame-" + str(self.frames).zfill(6) + "." + self.frame_format
+
+        if self.grab(surface, os.path.join(self.recording, name), wait):
+            self.frames += 1
+        else:
+            self.dropped += 1
+
+    def close(self):
+        # Waits for everything already captured to be written
+        if self.recording is not None:
+            self.stop_recording()
+
+        for thread in self.threads:
+            self.jobs.put(None)
+
+        for thread in self.threads:
+            thread.join()
+
+        self.threads = []
+
+
+capture = Capture(CAPTURE_DIR, CAPTURE_BUFFERS, CAPTURE_WORKERS, CAPTURE_FRAME_FORMAT)
+atexit.register(capture.close)
+
+
+# Timers
+class TimerEvent():
+
+    def __init__(self, callback, interval):
+        self.callback = callback
+        self.interval = interval
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class Scheduler():
+    # Counts game ticks and runs callbacks when they come due, so timed
+    # effects cost nothing on the ticks where nothing happens. Events are
+    # kept in a heap and cancelled ones are just skipped when they come up.
+
+    def __init__(self):
+        self.tick = 0
+        self.queue = []
+        self.count = 0
+
+    def schedule(self, delay, callback):
+        return self.push(self.tick + delay, TimerEvent(callback, None))
+
+    def every(self, interval, callback):
+        return self.push(self.tick + interval, TimerEvent(callback, interval))
+
+    def push(self, due, event):
+        # count breaks ties so events due on the same tick run in the order they were added
+        self.count += 1
+        heapq.heappush(self.queue, (due, self.count, event))
+
+        return event
+
+    def advance(self):
+        self.tick += 1
+
+        while len(self.queue) > 0 and self.queue[0][0] <= self.tick:
+            due, count, event = heapq.heappop(self.queue)
+
+            if event.cancelled:
+                continue
+
+            if event.interval is not None:
+                self.push(due + event.interval, event)
+
+            event.callback()
+
+    def pending(self):
+        return sum(1 for due, count, event in self.queue if not event.cancelled)
+
+
+# Animation
+# State -> (image names, ticks per frame). An image name can stand for a list
+# of frames. A frame time of 0 holds the frame until the state changes.
+HERO_ANIMATIONS = {"idle": (["idle"], 0),
+                   "run": (["run"], 5),
+                   "jump": (["jump"], 0),
+                   "fall": (["fall"], 0),
+                   "crouch": (["crouch"], 0),
+                   "hurt": (["in_pain"], 0)}
+
+ENEMY_ANIMATIONS = {"walk": (["walk"], 20)}
+
+
+class Animation():
+
+    def __init__(self, frames, durations):
+        self.frames = frames
+        self.durations = durations
+
+
+def build_animations(images, spec, faces_right=True):
+    # Returns a table keyed by (state, facing right) with mirrored copies of
+    # the frames for the other direction.
+    table = {}
+
+    for state, (names, ticks) in spec.items():
+        frames = []
+
+        for name in names:
+            img = images[name]
+            frames += img if isinstance(img, list) else [img]
+
+        mirrored = [pygame.transform.flip(img, 1, 0) for img in frames]
+        durations = [ticks] * len(frames)
+
+        table[(state, faces_right)] = Animation(frames, durations)
+        table[(state, not faces_right)] = Animation(mirrored, durations)
+
+    return table
+
+
+class Animator():
+    # Plays animations from a table made by build_animations. The frame only
+    # changes when the state does or the current frame's time is up, so it
+    # costs the same however many frames an animation has. Turning around
+    # keeps the frame and timing.
+
+    def __init__(self, table):
+        self.table = table
+        self.reset()
+
+    def reset(self):
+        self.state = None
+        self.animation = None
+        self.frame = 0
+        self.frame_end = None
+
+    def play(self, state, tick):
+        # Returns the image to show on this tick
+        if state != self.state:
+            if self.state is None or state[0] != self.state[0]:
+                self.frame = 0
+                self.start_frame(tick, self.table[state])
+
+            self.state = state
+            self.animation = self.table[state]
+
+        elif self.frame_end is not None and tick >= self.frame_end:
+            self.frame = (self.frame + 1) % len(self.animation.frames)
+            self.start_frame(tick, self.animation)
+
+        return self.animation.frames[self.frame]
+
+    def start_frame(self, tick, animation):
+        ticks = animation.durations[self.frame]
+        self.frame_end = tick + ticks if ticks > 0 else None
+
+    def turn(self, state):
+        # Other direction, same frame, without moving the animation on
+        if self.state is None:
+            return self.table[state].frames[0]
+
+        self.state = state
+        self.animation = self.table[state]
+
+        return self.animation.frames[self.frame]
+
 
 class Entity(pygame.sprite.Sprite):
 
@@ -147,27 +1357,369 @@ class Block(Entity):
     def __init__(self, x, y, image):
         super().__init__(x, y, image)
 
+
+class Platform(Block):
+    # A row of tiles that goes back and forth along a path of grid points,
+    # or drops once something has stood on it for a while. Platforms sit in
+    # the level's TileIndex like any block, so bodies land on them the same
+    # way, but they are drawn every frame instead of baked.
+
+    def __init__(self, path, width=1, speed=1, loop=False, falls=False, delay=30):
+        image = pygame.Surface([width * GRID_SIZE, GRID_SIZE], pygame.SRCALPHA, 32)
+
+        if width == 1:
+            codes = ["LF"]
+        else:
+            codes = ["EL"] + ["TM"] * (width - 2) + ["ER"]
+
+        for i, code in enumerate(codes):
+            image.blit(block_images[code], [i * GRID_SIZE, 0])
+
+        self.path = [(p[0] * GRID_SIZE, p[1] * GRID_SIZE) for p in path]
+        self.speed = speed
+        self.loop = loop # Back to the first point after the last, instead of turning around
+        self.falls = falls
+        self.delay = delay # Ticks something has to stand on a falling platform before it drops
+
+        super().__init__(self.path[0][0], self.path[0][1], image)
+        self.reset()
+
+    def reset(self):
+        self.x, self.y = self.path[0]
+        self.rect.topleft = self.path[0]
+        self.target = 1 % len(self.path)
+        self.step = 1
+        self.vy = 0
+        self.stood_on = 0
+        self.fallen = False
+
+    def advance(self, level, ridden):
+        # Returns where the platform is on this tick
+        if self.falls:
+            if self.stood_on >= self.delay:
+                self.vy = min(self.vy + level.gravity, level.terminal_velocity)
+                self.y += self.vy
+                self.fallen = self.y > level.height
+            elif ridden:
+                self.stood_on += 1
+
+        elif len(self.path) > 1:
+            tx, ty = self.path[self.target]
+            dx = tx - self.x
+            dy = ty - self.y
+            distance = (dx * dx + dy * dy) ** 0.5
+
+            if distance <= self.speed:
+                self.x, self.y = tx, ty
+
+                if self.loop:
+                    self.target = (self.target + 1) % len(self.path)
+                else:
+                    if not 0 <= self.target + self.step < len(self.path):
+                        self.step *= -1
+
+                    self.target += self.step
+            else:
+                self.x += dx * self.speed / distance
+                self.y += dy * self.speed / distance
+
+        return round(self.x), round(self.y)
+
+class TileIndex():
+    # Buckets blocks by the grid cells they overlap (blocks don't have to be
+    # grid aligned) so collision checks only look at nearby cells. The sweep
+    # methods move a rect along one axis and stop it at the first block in the
+    # way, visiting only the cells the rect covers and the ones its leading
+    # edge crosses, so any speed is safe without sub-stepping. A block that
+    # already overlaps the rect pushes it back out, like the old move-then-
+    # resolve code did for enemies placed inside the ground.
+
+    def __init__(self, blocks, cell_size=GRID_SIZE):
+        self.cell_size = cell_size
+        self.cells = {}
+
+        for block in blocks:
+            self.add(block)
+
+    def cell_range(self, rect):
+        cs = self.cell_size
+
+        return (range(rect.left // cs, (rect.right - 1) // cs + 1),
+                range(rect.top // cs, (rect.bottom - 1) // cs + 1))
+
+    def add(self, block):
+        cols, rows = self.cell_range(block.rect)
+
+        for cx in cols:
+            for cy in rows:
+                self.cells.setdefault((cx, cy), []).append(block)
+
+    def remove(self, block):
+        cols, rows = self.cell_range(block.rect)
+
+        for cx in cols:
+            for cy in rows:
+                cell = self.cells.get((cx, cy))
+
+                if cell is not None and block in cell:
+                    cell.remove(block)
+
+                    if len(cell) == 0:
+                        del self.cells[(cx, cy)]
+
+    def collide(self, rect):
+        cols, rows = self.cell_range(rect)
+        hit_list = []
+
+        for cx in cols:
+            for cy in rows:
+                for block in self.cells.get((cx, cy), ()):
+                    if block.rect.colliderect(rect) and block not in hit_list:
+                        hit_list.append(block)
+
+        return hit_list
+
+    def sweep_x(self, rect, dx):
+        # Returns how far rect can move (dx if nothing is in the way) and the
+        # blocks it comes to rest against.
+        if dx == 0:
+            return 0, []
+
+        cs = self.cell_size
+        rows = range(rect.top // cs, (rect.bottom - 1) // cs + 1)
+
+        if dx > 0:
+            lead = rect.right
+            cols = range(rect.left // cs, int((lead + dx - 1) // cs) + 1)
+        else:
+            lead = rect.left
+            cols = range((rect.right - 1) // cs, int((lead + dx) // cs) - 1, -1)
+
+        for cx in cols:
+            nearest = None
+            hit_list = []
+
+            for cy in rows:
+                for block in self.cells.get((cx, cy), ()):
+                    if block.rect.bottom <= rect.top or block.rect.top >= rect.bottom:
+                        continue
+
+                    if dx > 0:
+                        edge = block.rect.left
+                        ahead = rect.left <= edge < lead + dx
+                    else:
+                        edge = block.rect.right
+                        ahead = lead + dx < edge <= rect.right
+
+                    if not ahead:
+                        continue
+
+                    if nearest is None or edge == nearest:
+                        nearest = edge
+                        hit_list.append(block)
+                    elif (edge < nearest) == (dx > 0):
+                        nearest = edge
+                        hit_list = [block]
+
+            if nearest is not None:
+                return nearest - lead, hit_list
+
+        return dx, []
+
+    def sweep_y(self, rect, dy):
+        if dy == 0:
+            return 0, []
+
+        cs = self.cell_size
+        cols = range(rect.left // cs, (rect.right - 1) // cs + 1)
+
+        if dy > 0:
+            lead = rect.bottom
+            rows = range(rect.top // cs, int((lead + dy - 1) // cs) + 1)
+        else:
+            lead = rect.top
+            rows = range((rect.bottom - 1) // cs, int((lead + dy) // cs) - 1, -1)
+
+        for cy in rows:
+            nearest = None
+            hit_list = []
+
+            for cx in cols:
+                for block in self.cells.get((cx, cy), ()):
+                    if block.rect.right <= rect.left or block.rect.left >= rect.right:
+                        continue
+
+                    if dy > 0:
+                        edge = block.rect.top
+                        ahead = rect.top <= edge < lead + dy
+                    else:
+                        edge = block.rect.bottom
+                        ahead = lead + dy < edge <= rect.bottom
+
+                    if not ahead or block in hit_list:
+                        continue
+
+                    if nearest is None or edge == nearest:
+                        nearest = edge
+                        hit_list.append(block)
+                    elif (edge < nearest) == (dy > 0):
+                        nearest = edge
+                        hit_list = [block]
+
+            if nearest is not None:
+                return nearest - lead, hit_list
+
+        return dy, []
+
+class FlowField():
+    # Distance to the hero from every grid cell within CHASE_DISTANCE steps,
+    # found with one breadth first search back from the hero's cell. Each
+    # cell also keeps the first step of its shortest path, so any number of
+    # enemies can look up which way to go without searching. The search only
+    # runs again when the hero moves to another cell, and only clears the
+    # cells the last one reached.
+    #
+    # mode is how an enemy gets around:
+    #   "walk"  along the ground, dropping off ledges
+    #   "ledge" along the ground, never leaving it
+    #   "fly"   through any open cell
+    # Moving platforms are left out, enemies don't ride them on purpose.
+
+    def __init__(self, level, mode):
+        self.mode = mode
+        self.cols = level.width // GRID_SIZE
+        self.rows = level.height // GRID_SIZE
+        self.solid = bytearray(self.cols * self.rows)
+
+        for block in level.blocks:
+            cols, rows = level.tiles.cell_range(block.rect)
+
+            for cx in cols:
+                for cy in rows:
+                    if 0 <= cx < self.cols and 0 <= cy < self.rows:
+                        self.solid[cy * self.cols + cx] = 1
+
+        self.dist = [-1] * (self.cols * self.rows)
+        self.moves = [None] * (self.cols * self.rows)
+        self.reached = []
+        self.target = None
+
+    def supported(self, i):
+        below = i + self.cols
+
+        return below < len(self.solid) and self.solid[below]
+
+    def target_cell(self, rect):
+        cx = rect.centerx // GRID_SIZE
+        cy = min(max(rect.centery // GRID_SIZE, 0), self.rows - 1)
+
+        if cx < 0 or cx >= self.cols:
+            return None
+
+        i = cy * self.cols + cx
+
+        if self.solid[i]:
+            return None
+
+        if self.mode != "fly":
+            # Where the hero will land, ground enemies can't follow a jump
+            while not self.supported(i) and i + self.cols < len(self.solid):
+                i += self.cols
+
+        return i
+
+    def update(self, rect):
+        target = self.target_cell(rect)
+
+        if target == self.target:
+            return
+
+        for i in self.reached:
+            self.dist[i] = -1
+            self.moves[i] = None
+
+        self.target = target
+        self.reached = []
+
+        if target is None:
+            return
+
+        cols = self.cols
+        solid = self.solid
+        dist = self.dist
+        moves = self.moves
+        fly = self.mode == "fly"
+        falls = self.mode == "walk"
+
+        dist[target] = 0
+        moves[target] = (0, 0)
+        self.reached.append(target)
+        frontier = [target]
+        d = 0
+
+        while len(frontier) > 0 and d < CHASE_DISTANCE:
+            d += 1
+            next_frontier = []
+
+            for i in frontier:
+                x = i % cols
+                # Cells that get to i in one step, with the step they take
+                steps = []
+
+                if x > 0:
+                    steps.append((i - 1, (1, 0)))
+                if x < cols - 1:
+                    steps.append((i + 1, (-1, 0)))
+                if i >= cols and (fly or falls):
+                    steps.append((i - cols, (0, 1)))
+                if fly and i + cols < len(solid):
+                    steps.append((i + cols, (0, -1)))
+
+                for j, move in steps:
+                    if dist[j] != -1 or solid[j]:
+                        continue
+
+                    if not fly:
+                        if move[1] == 0:
+                            # Walking in from the side needs ground under both cells
+                            if not self.supported(j) or (not falls and not self.supported(i)):
+                                continue
+                        elif self.supported(j):
+                            continue
+
+                    dist[j] = d
+                    moves[j] = move
+                    self.reached.append(j)
+                    next_frontier.append(j)
+
+            frontier = next_frontier
+
+    def move(self, rect):
+        # First step toward the hero from the cell rect is in, as (dx, dy),
+        # or None if the hero can't be reached from there
+        cx = rect.centerx // GRID_SIZE
+
+        if self.mode == "fly":
+            cy = rect.centery // GRID_SIZE
+        else:
+            cy = (rect.bottom - 1) // GRID_SIZE
+
+        if 0 <= cx < self.cols and 0 <= cy < self.rows:
+            return self.moves[cy * self.cols + cx]
+
+        return None
+
+
 class Character(Entity):
 
-    def __init__(self, images):
+    def __init__(self, images, timers):
         super().__init__(0, 0, images['idle'])
 
-        self.image_idle = images['idle']
-        self.image_idle_left = pygame.transform.flip(self.image_idle, 1, 0)
-        self.images_run_right = images['run']
-        self.images_run_left = [pygame.transform.flip(img, 1, 0) for img in self.images_run_right]
-        self.image_jump_right = images['jump']
-        self.image_jump_left = pygame.transform.flip(self.image_jump_right, 1, 0)
-        self.image_fall = images['fall']
-        self.image_fall_left = pygame.transform.flip(self.image_fall, 1, 0)
-        self.image_crouch = images['crouch']
-        self.image_crouch_left = pygame.transform.flip(self.image_crouch, 1, 0)
-        self.image_in_pain = images['in_pain']
-        self.image_in_pain_left = pygame.transform.flip(self.image_in_pain, 1, 0)
-    
-        self.running_images = self.images_run_right
-        self.image_index = 0
-        self.steps = 0
+        self.timers = timers
+        self.invincible_until = 0
+        self.powerup_timer = None
+
+        self.load_images(images)
 
         self.speed = 5
         self.normal_speed = 5
@@ -191,6 +1743,47 @@ class Character(Entity):
         self.invincibility = 0
         self.powerup_time = 0
 
+    def load_images(self, images):
+        self.animations = build_animations(images, HERO_ANIMATIONS)
+        self.animator = Animator(self.animations)
+        self.image = self.animator.play(("idle", True), 0)
+
+        # Numbered so ghost recordings can store which one was showing
+        self.pose_images = []
+
+        for state in HERO_ANIMATIONS:
+            self.pose_images += self.animations[(state, True)].frames + self.animations[(state, False)].frames
+
+        self.poses = {img: i for i, img in enumerate(self.pose_images)}
+
+    @property
+    def invincibility(self):
+        # Ticks left, worked out from a deadline instead of counted down every frame
+        return max(0, self.invincible_until - self.timers.tick)
+
+    @invincibility.setter
+    def invincibility(self, ticks):
+        self.invincible_until = self.timers.tick + ticks
+
+    def add_powerup_time(self, seconds):
+        self.powerup_time += seconds
+
+        if self.powerup_timer is None:
+            self.powerup_timer = self.timers.every(refresh_rate, self.count_down_powerup)
+
+    def count_down_powerup(self):
+        self.powerup_time -= 1
+
+        if self.powerup_time <= 0:
+            self.powerup_time = 0
+            self.normal_speed = 5
+            self.stop_powerup_timer()
+
+    def stop_powerup_timer(self):
+        if self.powerup_timer is not None:
+            self.powerup_timer.cancel()
+            self.powerup_timer = None
+
     def move_left(self):
         self.vx = -self.speed
         self.facing_right = False
@@ -199,24 +1792,37 @@ class Character(Entity):
         self.vx = self.speed
         self.facing_right = True
 
+    def apply_input(self, buttons, tiles):
+        if buttons & INPUT_JUMP:
+            self.jump(tiles)
+
+        if buttons & INPUT_DOWN:
+            if not self.crouching:
+                self.crouching = True
+                self.crouch()
+        else:
+            self.crouching = False
+
+        if buttons & INPUT_LEFT:
+            self.move_left()
+        elif buttons & INPUT_RIGHT:
+            self.move_right()
+        else:
+            self.stop()
+
     def crouch(self):
         if self.crouching == True and self.on_ground:
-            if self.facing_right:
-                self.image = self.image_crouch
-                self.speed = 2
-            if not self.facing_right:
-                self.image = self.image_crouch_left
-                self.speed = 2
+            self.speed = 2
         if self.crouching == False:
             self.speed = self.normal_speed
     
     def stop(self):
         self.vx = 0
 
-    def jump(self, blocks):
+    def jump(self, tiles):
         self.rect.y += 1
 
-        hit_list = pygame.sprite.spritecollide(self, blocks, False)
+        hit_list = tiles.collide(self.rect)
 
         if len(hit_list) > 0:
             self.vy = -1 * self.jump_power
@@ -232,36 +1838,29 @@ class Character(Entity):
         if self.rect.y > level.height and not self.on_ground:
             self.hearts = 0
 
-    def move_and_process_blocks(self, blocks):
-        self.rect.x += self.vx
-        hit_list = pygame.sprite.spritecollide(self, blocks, False)
+    def move_and_process_blocks(self, tiles):
+        dx, hit_list = tiles.sweep_x(self.rect, self.vx)
+        self.rect.x += dx
 
-        for block in hit_list:
-            if self.vx > 0:
-                self.rect.right = block.rect.left
-                self.vx = 0
-            elif self.vx < 0:
-                self.rect.left = block.rect.right
-                self.vx = 0
+        if len(hit_list) > 0:
+            self.vx = 0
 
         self.on_ground = False
-        self.rect.y += self.vy
-        hit_list = pygame.sprite.spritecollide(self, blocks, False)
+        dy, hit_list = tiles.sweep_y(self.rect, self.vy)
+        self.rect.y += dy
 
-        for block in hit_list:
+        if len(hit_list) > 0:
             if self.vy > 0:
-                self.rect.bottom = block.rect.top
-                self.vy = 0
                 self.on_ground = True
-            elif self.vy < 0:
-                self.rect.top = block.rect.bottom
-                self.vy = 0
+            self.vy = 0
 
-    def process_coins(self, coins):
+    def process_coins(self, coins, level):
         hit_list = pygame.sprite.spritecollide(self, coins, True)
 
         for coin in hit_list:
             play_sound(COIN_SOUND)
+            particles.burst("coin", coin.rect)
+            telemetry.sample("coin", self.timers.tick, coin.rect.x, coin.rect.y, value=coin.value)
             self.score += coin.value
             self.collected_coins += 1
             self.total_collected_coins += 1
@@ -269,11 +1868,12 @@ class Character(Entity):
                 self.lives += 1
                 self.collected_coins = 0
     
-    def process_alt_coins(self, alt_coins):
+    def process_alt_coins(self, alt_coins, level):
         hit_list = pygame.sprite.spritecollide(self, alt_coins, True)
 
         for alt_coin in hit_list:
             play_sound(COIN_SOUND)
+            particles.burst("coin", alt_coin.rect)
             self.score += 200
             self.collected_coins += 1
             self.total_collected_coins += 1
@@ -283,39 +1883,46 @@ class Character(Entity):
     
 
 
-    def process_enemies(self, enemies):
+    def process_enemies(self, enemies, level):
         hit_list = pygame.sprite.spritecollide(self, enemies, False)
 
         if len(hit_list) > 0 and self.invincibility == 0 and self.vy == 0:
             play_sound(HURT_SOUND)
             self.hearts -= 1
             self.invincibility = int(0.75 * FPS)
+            particles.burst("hurt", self.rect)
+            telemetry.sample("hurt", self.timers.tick, self.rect.x, self.rect.y,
+                             enemy=type(hit_list[0]).__name__, hearts=self.hearts)
             
         if self.on_ground == False:
             hit_list2 = pygame.sprite.spritecollide(self, enemies, True)
             for enemy in hit_list2:
                 if self.vy > 0 and len(hit_list2) > 0:
+                    particles.burst("stomp", enemy.rect)
+                    telemetry.sample("stomp", self.timers.tick, enemy.rect.x, enemy.rect.y, enemy=type(enemy).__name__)
                     self.score += enemy.point_value
                     self.enemies_slain += 1
                     self.vy = -15
                 
-    def process_powerups(self, powerups):
+    def process_powerups(self, powerups, level):
         hit_list = pygame.sprite.spritecollide(self, powerups, True)
         
         for p in hit_list:   
             play_sound(POWERUP_SOUND)
+            particles.burst("powerup", p.rect)
+            telemetry.sample("powerup", self.timers.tick, p.rect.x, p.rect.y, powerup=type(p).__name__)
             self.power_ups_collected += 1
             self.score += p.value
             p.apply(self)
 
-    def process_prizes(self, prizes):
+    def process_prizes(self, prizes, level):
         hit_list = pygame.sprite.spritecollide(self, prizes, True)
         
         for p in hit_list:
             self.score += p.value
             p.apply(self)
 
-    def process_key(self, key):
+    def process_key(self, key, level):
         hit_list = pygame.sprite.spritecollide(self, key, True)
         
         for l in hit_list:   
@@ -337,8 +1944,8 @@ class Character(Entity):
                 c.apply(self, level)
                 self.has_key = False
         
-    def check_flag(self, level):
-        hit_list = pygame.sprite.spritecollide(self, level.flag, False)
+    def check_flag(self, flag, level):
+        hit_list = pygame.sprite.spritecollide(self, flag, False)
 
         if len(hit_list) > 0:
             level.completed = True
@@ -351,45 +1958,30 @@ class Character(Entity):
                 self.score += 175
             else:
                 self.score += 105
-        
-    def set_image(self):
-        if self.on_ground:
-            if self.vx != 0:
-                if self.facing_right:
-                    self.running_images = self.images_run_right
-                else:
-                    self.running_images = self.images_run_left
 
-                self.steps = (self.steps + 1) % self.speed # Works well with 2 images, try lower number if more frames are in animation
-
-                if self.steps == 0:
-                    self.image_index = (self.image_index + 1) % len(self.running_images)
-                    self.image = self.running_images[self.image_index]
-
-            else:
-                if self.facing_right:
-                    self.image = self.image_idle
-                else:
-                    self.image = self.image_idle_left
-            
+            # Coins still on the level are the ones the player missed
+            missed = [c.rect.topleft for c in level.coins] + [c.rect.topleft for c in level.alt_coin]
+            telemetry.emit("flag", self.timers.tick, self.rect.x, self.rect.y, time_left=game.time_limit,
+                           score=self.score, missed_coins=missed)
         
+    def animate(self):
+        if self.invincibility > 0 and self.hearts > 0:
+            state = "hurt"
+        elif self.crouching and self.on_ground:
+            state = "crouch"
+        elif self.on_ground:
+            state = "run" if self.vx != 0 else "idle"
+        elif self.vy > 0:
+            state = "fall"
         else:
-            if self.on_ground == False and self.vy > 0:
-                if self.facing_right:
-                    self.image = self.image_fall
-                if not self.facing_right:
-                    self.image = self.image_fall_left
-            
-            
-            elif self.facing_right:
-                self.image = self.image_jump_right
-            else:
-                self.image = self.image_jump_left
-                
+            state = "jump"
+
+        self.image = self.animator.play((state, self.facing_right), self.timers.tick)
 
     def die(self):
         self.lives -= 1
         self.speed = self.normal_speed
+        telemetry.emit("die", self.timers.tick, self.rect.x, self.rect.y, lives=self.lives, score=self.score)
 
         if self.lives > 0:
             play_sound(DIE_SOUND)
@@ -402,34 +1994,23 @@ class Character(Entity):
         self.hearts = self.max_hearts
         self.score = 0
         self.powerup_time = 0
+        self.stop_powerup_timer()
         self.speed = self.normal_speed
         self.invincibility = 0
         self.has_key = False
 
     def update(self, level):
-        self.process_enemies(level.enemies)
+        self.process_enemies(level.enemies, level)
         self.apply_gravity(level)
-        self.move_and_process_blocks(level.blocks)
+        self.move_and_process_blocks(level.tiles)
         self.check_world_boundaries(level)
-        self.set_image()
-              
-            
+
         if self.hearts > 0:
-            self.process_coins(level.coins)
-            self.process_alt_coins(level.alt_coin)
-            self.process_powerups(level.powerups)
-            self.process_prizes(level.prize)
-            self.process_key(level.key)
-            self.process_chest(level.chest, level)
-            self.check_flag(level)
-            self.crouch()  
-
-            if self.invincibility > 0:
-                self.invincibility -= 1
-                if self.facing_right:
-                    self.image = self.image_in_pain
-                if not self.facing_right:
-                    self.image = self.image_in_pain_left
+            for handler, group in level.pickups:
+                handler(self, group, level)
+
+            self.crouch()
+            self.animate()
         else:
             self.die()
 
@@ -443,21 +2024,36 @@ class Enemy(Entity):
     def __init__(self, x, y, images):
         super().__init__(x, y, images[0])
 
+        self.load_images(images)
+
+    def load_images(self, images):
+        self.animations = build_animations({"walk": images}, ENEMY_ANIMATIONS, faces_right=False)
+        self.animator = Animator(self.animations)
+
         self.images_left = images
-        self.images_right = [pygame.transform.flip(img, 1, 0) for img in images]
-        self.current_images = self.images_left
-        self.image_index = 0
-        self.steps = 0
+        self.images_right = self.animations[("walk", True)].frames
+        self.image = self.animator.turn(("walk", self.vx > 0))
+
+    # Turned off by the frame pacer when there is no time to spare
+    animate_enemies = True
+
+    # How it gets around, picks the FlowField used to chase the hero
+    path = "walk"
+
+    def chase(self, level):
+        # Turns toward the hero when there is a way there, otherwise keeps patrolling
+        move = level.flow_field(self.path).move(self.rect)
+
+        if move is not None:
+            self.steer(move[0])
+
+    def steer(self, dx):
+        if dx != 0 and (dx > 0) != (self.vx > 0):
+            self.reverse()
         
     def reverse(self):
         self.vx *= -1
-
-        if self.vx < 0:
-            self.current_images = self.images_left
-        else:
-            self.current_images = self.images_right
-
-        self.image = self.current_images[self.image_index]
+        self.image = self.animator.turn(("walk", self.vx > 0))
 
     def check_world_boundaries(self, level):
         if self.rect.left < 0:
@@ -470,12 +2066,11 @@ class Enemy(Entity):
     def move_and_process_blocks(self):
         pass
 
-    def set_images(self):
-        if self.steps == 0:
-            self.image = self.current_images[self.image_index]
-            self.image_index = (self.image_index + 1) % len(self.current_images)
+    def set_images(self, timers):
+        if not Enemy.animate_enemies:
+            return
 
-        self.steps = (self.steps + 1) % 20 # Nothing significant about 20. It just seems to work okay.
+        self.image = self.animator.play(("walk", self.vx > 0), timers.tick)
 
     def update(self, level, hero):
         pass
@@ -486,8 +2081,8 @@ class Enemy(Entity):
         self.rect.y = self.start_y
         self.vx = self.start_vx
         self.vy = self.start_vy
+        self.animator.reset()
         self.image = self.images_left[0]
-        self.steps = 0
 
 class Bear(Enemy):
     def __init__(self, x, y, images):
@@ -503,38 +2098,31 @@ class Bear(Enemy):
 
         self.point_value = 50
 
-    def move_and_process_blocks(self, blocks):
-        self.rect.x += self.vx
-        hit_list = pygame.sprite.spritecollide(self, blocks, False)
+    def move_and_process_blocks(self, tiles):
+        dx, hit_list = tiles.sweep_x(self.rect, self.vx)
+        self.rect.x += dx
 
-        for block in hit_list:
-            if self.vx > 0:
-                self.rect.right = block.rect.left
-                self.reverse()
-            elif self.vx < 0:
-                self.rect.left = block.rect.right
-                self.reverse()
+        if len(hit_list) > 0:
+            self.reverse()
 
-        self.rect.y += self.vy
-        hit_list = pygame.sprite.spritecollide(self, blocks, False)
+        dy, hit_list = tiles.sweep_y(self.rect, self.vy)
+        self.rect.y += dy
 
-        for block in hit_list:
-            if self.vy > 0:
-                self.rect.bottom = block.rect.top
-                self.vy = 0
-            elif self.vy < 0:
-                self.rect.top = block.rect.bottom
-                self.vy = 0
+        if len(hit_list) > 0:
+            self.vy = 0
                 
     def is_near(self, hero):
-        return abs(self.rect.x - hero.rect.x) < 2 * WIDTH
+        return abs(self.rect.x - hero.rect.x) < 2 * VIEW_WIDTH
 
     def update(self, level, hero):
         if self.is_near(hero):
+            if CHASE:
+                self.chase(level)
+
             self.apply_gravity(level)
-            self.move_and_process_blocks(level.blocks)
+            self.move_and_process_blocks(level.tiles)
             self.check_world_boundaries(level)
-            self.set_images()
+            self.set_images(level.timers)
 
     
 class Monster(Enemy):
@@ -551,28 +2139,22 @@ class Monster(Enemy):
 
         self.point_value = 100
 
-    def move_and_process_blocks(self, blocks):
-        reverse = False
+    path = "ledge" # Turns around at the edge of the ground
 
-        self.rect.x += self.vx
-        hit_list = pygame.sprite.spritecollide(self, blocks, False)
+    def move_and_process_blocks(self, tiles):
+        dx, hit_list = tiles.sweep_x(self.rect, self.vx)
+        self.rect.x += dx
 
-        for block in hit_list:
-            if self.vx > 0:
-                self.rect.right = block.rect.left
-                self.reverse()
-            elif self.vx < 0:
-                self.rect.left = block.rect.right
-                self.reverse()
+        if len(hit_list) > 0:
+            self.reverse()
 
-        self.rect.y += self.vy
-        hit_list = pygame.sprite.spritecollide(self, blocks, False)
+        dy, hit_list = tiles.sweep_y(self.rect, self.vy)
+        self.rect.y += dy
 
         reverse = True
 
         for block in hit_list:
             if self.vy >= 0:
-                self.rect.bottom = block.rect.top
                 self.vy = 0
 
                 if self.vx > 0 and self.rect.right <= block.rect.right:
@@ -582,7 +2164,6 @@ class Monster(Enemy):
                     reverse = False
             
             elif self.vy < 0:
-                self.rect.top = block.rect.bottom
                 self.vy = 0
             
 
@@ -590,14 +2171,17 @@ class Monster(Enemy):
             self.reverse()
             
     def is_near(self, hero):
-        return abs(self.rect.x - hero.rect.x) < 2 * WIDTH
+        return abs(self.rect.x - hero.rect.x) < 2 * VIEW_WIDTH
 
     def update(self, level, hero):
         if self.is_near(hero):
+            if CHASE:
+                self.chase(level)
+
             self.apply_gravity(level)
-            self.move_and_process_blocks(level.blocks)
+            self.move_and_process_blocks(level.tiles)
             self.check_world_boundaries(level)
-            self.set_images()
+            self.set_images(level.timers)
 
     
             
@@ -615,38 +2199,42 @@ class Bird(Enemy):
 
         self.point_value = 150
 
-    def move_and_process_blocks(self, blocks):
-        self.rect.x += self.vx
-        hit_list = pygame.sprite.spritecollide(self, blocks, False)
+    path = "fly"
 
-        for block in hit_list:
-            if self.vx > 0:
-                self.rect.right = block.rect.left
-                self.reverse()
-            elif self.vx < 0:
-                self.rect.left = block.rect.right
-                self.reverse()
+    def chase(self, level):
+        move = level.flow_field(self.path).move(self.rect)
+
+        if move is None:
+            self.vy = 0
+        else:
+            self.steer(move[0])
+            self.vy = move[1] * abs(self.vx)
 
-        self.rect.y += self.vy
-        hit_list = pygame.sprite.spritecollide(self, blocks, False)
+    def move_and_process_blocks(self, tiles):
+        dx, hit_list = tiles.sweep_x(self.rect, self.vx)
+        self.rect.x += dx
 
-        for block in hit_list:
-            if self.vy > 0:
-                self.rect.bottom = block.rect.top
-                self.vy = 0
-            elif self.vy < 0:
-                self.rect.top = block.rect.bottom
-                self.vy = 0
+        if len(hit_list) > 0:
+            self.reverse()
+
+        dy, hit_list = tiles.sweep_y(self.rect, self.vy)
+        self.rect.y += dy
+
+        if len(hit_list) > 0:
+            self.vy = 0
 
     
     def is_near_guy(self, hero):
-        return abs(self.rect.x - hero.rect.x) < 2 * WIDTH
+        return abs(self.rect.x - hero.rect.x) < 2 * VIEW_WIDTH
 
     def update(self, level, hero):
         if self.is_near_guy(hero):
-            self.move_and_process_blocks(level.blocks)
+            if CHASE:
+                self.chase(level)
+
+            self.move_and_process_blocks(level.tiles)
             self.check_world_boundaries(level)
-            self.set_images()    
+            self.set_images(level.timers)    
     
 
 class OneUp(Entity):
@@ -670,7 +2258,7 @@ class SpeedUp(Entity):
         self.value = 50
     def apply(self, character):
         character.normal_speed += 2
-        character.powerup_time += 10
+        character.add_powerup_time(10)
         
 class SpeedDown(Entity):
     def __init__(self, x, y, image):
@@ -678,7 +2266,7 @@ class SpeedDown(Entity):
         self.value = -50
     def apply(self, character):
         character.normal_speed -= 2
-        character.powerup_time += 10
+        character.add_powerup_time(10)
         
 class Heart(Entity):
     def __init__(self, x, y, image):
@@ -713,42 +2301,183 @@ class Key(Entity):
     def apply(self, character):
         character.has_key = True
     
+# Entity types
+class EntityCategory():
+    # Entities in the same category share a sprite group, a list of the ones
+    # the level starts with, the group they are drawn from and the Character
+    # method that handles touching them. Entities drawn from inactive_sprites
+    # are baked into the level's static layer.
+
+    def __init__(self, group, starting, layer, handler):
+        self.group = group
+        self.starting = starting
+        self.layer = layer
+        self.handler = handler
+
+
+class EntityType():
+    # What the items under one JSON key spawn. image is passed to the class,
+    # first_image replaces it for the first item (the top of the flag).
+
+    def __init__(self, key, cls, image, category, first_image=None):
+        self.key = key
+        self.cls = cls
+        self.image = image
+        self.category = category
+        self.first_image = first_image
+
+    def spawn(self, items, first=0):
+        spawned = [self.cls(item[0] * GRID_SIZE, item[1] * GRID_SIZE, self.image) for item in items]
+
+        if first == 0 and len(spawned) > 0 and self.first_image is not None:
+            item = items[0]
+            spawned[0] = self.cls(item[0] * GRID_SIZE, item[1] * GRID_SIZE, self.first_image)
+
+        return spawned
+
+    def icon(self):
+        if isinstance(self.image, list):
+            return self.image[0]
+
+        return self.image
+
+
+# Ordered as the sprites are layered when drawn
+ENTITY_CATEGORIES = {"coin": EntityCategory("coins", "starting_coins", "active_sprites", "process_coins"),
+                     "enemy": EntityCategory("enemies", "starting_enemies", "active_sprites", "process_enemies"),
+                     "powerup": EntityCategory("powerups", "starting_powerups", "active_sprites", "process_powerups"),
+                     "key": EntityCategory("key", "starting_keys", "active_sprites", "process_key"),
+                     "chest": EntityCategory("chest", "starting_chests", "active_sprites", "process_chest"),
+                     "alt_coin": EntityCategory("alt_coin", "starting_alt_coins", "active_sprites", "process_alt_coins"),
+                     "prize": EntityCategory("prize", "starting_prizes", "active_sprites2", "process_prizes"),
+                     "flag": EntityCategory("flag", "starting_flag", "inactive_sprites", "check_flag")}
+
+# Categories the hero checks each frame after moving, in order. Enemies are
+# handled before moving, see Character.update.
+PICKUP_ORDER = ["coin", "alt_coin", "powerup", "prize", "key", "chest", "flag"]
+
+# Loaded in this order, keyed by the lists in the level JSON
+ENTITY_TYPES = {t.key: t for t in [EntityType("bears", Bear, bear_images, "enemy"),
+                                   EntityType("monsters", Monster, monster_images, "enemy"),
+                                   EntityType("birds", Bird, bird_images, "enemy"),
+                                   EntityType("coins", Coin, coin_img, "coin"),
+                                   EntityType("oneups", OneUp, oneup_img, "powerup"),
+                                   EntityType("hearts", Heart, heart_img, "powerup"),
+                                   EntityType("speedups", SpeedUp, speedup_img, "powerup"),
+                                   EntityType("speeddowns", SpeedDown, speeddown_img, "powerup"),
+                                   EntityType("keys", Key, key_img, "key"),
+                                   EntityType("chests", Chest, chest_img, "chest"),
+                                   EntityType("prizes", Prize, oneup_img, "prize"),
+                                   EntityType("alt_coin", Coin, alt_coin_img, "alt_coin"),
+                                   EntityType("flag", Flag, flagpole_img, "flag", first_image=flag_img)]}
+
+
+class ChunkLayer():
+    # The level's static sprites (blocks and the flag) baked into chunks.
+    # A chunk is baked the first time it's drawn and only the most recently
+    # drawn ones are kept, so memory doesn't grow with the size of the level.
+
+    def __init__(self, level):
+        self.level = level
+        self.chunks = collections.OrderedDict() # (column, row) -> surface
+        self.size = math.ceil(CHUNK_SIZE * RENDER_SCALE) # In backbuffer pixels
+
+    def chunk(self, key):
+        surface = self.chunks.get(key)
+
+        if surface is not None:
+            self.chunks.move_to_end(key)
+            return surface
+
+        rect = pygame.Rect(key[0] * CHUNK_SIZE, key[1] * CHUNK_SIZE, CHUNK_SIZE, CHUNK_SIZE)
+        surface = pygame.Surface([self.size, self.size], pygame.SRCALPHA, 32)
+        self.level.bake(surface, rect, rect)
+        self.chunks[key] = surface
+
+        if len(self.chunks) > CHUNKS_KEPT:
+            self.chunks.popitem(last=False)
+
+        return surface
+
+    def rebake(self, area):
+        # Only chunks that are already baked need redrawing, the rest are
+        # baked up to date when they come into view
+        for cx in range(area.left // CHUNK_SIZE, (area.right - 1) // CHUNK_SIZE + 1):
+            for cy in range(area.top // CHUNK_SIZE, (area.bottom - 1) // CHUNK_SIZE + 1):
+                surface = self.chunks.get((cx, cy))
+
+                if surface is None:
+                    continue
+
+                rect = pygame.Rect(cx * CHUNK_SIZE, cy * CHUNK_SIZE, CHUNK_SIZE, CHUNK_SIZE)
+                clip = to_render_rect(area.clip(rect).move(-rect.x, -rect.y))
+                surface.set_clip(clip)
+                surface.fill(TRANSPARENT, clip)
+                self.level.bake(surface, rect, area.clip(rect))
+                surface.set_clip(None)
+
+    def draw(self, surface, offset_x, offset_y):
+        width, height = surface.get_size()
+        right = min(self.level.width, math.ceil(width / RENDER_SCALE) - offset_x)
+        bottom = min(self.level.height, math.ceil(height / RENDER_SCALE) - offset_y)
+
+        for cx in range(max(0, -offset_x) // CHUNK_SIZE, (right - 1) // CHUNK_SIZE + 1):
+            for cy in range(max(0, -offset_y) // CHUNK_SIZE, (bottom - 1) // CHUNK_SIZE + 1):
+                surface.blit(self.chunk((cx, cy)), [to_render(cx * CHUNK_SIZE + offset_x), to_render(cy * CHUNK_SIZE + offset_y)])
+
+
+def camera_offset(center, view, size):
+    # How far the level is shifted along one axis to keep center in the
+    # middle of the view, without showing past either edge
+    if center < view / 2:
+        return 0
+    elif center > size - view / 2:
+        return min(0, view - size)
+
+    return view / 2 - center
+
+
 class Level():
 
-    def __init__(self, file_path):
-        self.starting_blocks = []
-        self.starting_enemies = []
-        self.starting_coins = []
-        self.starting_powerups = []
-        self.starting_flag = []
-        self.starting_keys = []
-        self.starting_chests = []
-        self.starting_prizes = []
-        self.starting_alt_coins = []
+    ENTITY_KEYS = list(ENTITY_TYPES)
+    REQUIRED_KEYS = ['width', 'height', 'start', 'name', 'blocks', 'gravity', 'terminal-velocity', 'music',
+                     'background-color', 'background-img', 'scenery-img']
+
+    def __init__(self, file_path, timers):
+        self.file_path = file_path
+        self.timers = timers
 
         self.blocks = pygame.sprite.Group()
-        self.enemies = pygame.sprite.Group()
-        self.coins = pygame.sprite.Group()
-        self.powerups = pygame.sprite.Group()
-        self.flag = pygame.sprite.Group()
-        self.key = pygame.sprite.Group()
-        self.chest = pygame.sprite.Group()
-        self.prize = pygame.sprite.Group()
-        self.alt_coin = pygame.sprite.Group()
-        
+        self.platforms = pygame.sprite.Group()
+
+        # e.g. self.starting_coins and self.coins
+        for category in ENTITY_CATEGORIES.values():
+            setattr(self, category.starting, [])
+            setattr(self, category.group, pygame.sprite.Group())
+
         self.chest_opened = False
+        self.flow_fields = {} # Made when an enemy first chases, see FlowField
 
         self.active_sprites = pygame.sprite.Group()
         self.active_sprites2 = pygame.sprite.Group()
         self.inactive_sprites = pygame.sprite.Group()
 
+        # What each JSON item turned into, by cell, so the editor and hot
+        # reloads can find and replace just those without scanning the level.
+        # cell_blocks is (x, y) -> [block], spawned is key -> (x, y) -> [(item, e, groups)]
+        self.cell_blocks = {}
+        self.spawned = {}
+
         with open(file_path, 'r') as f:
             data = f.read()
 
         map_data = json.loads(data)
+        self.validate(map_data)
+        self.map_data = map_data
 
         self.width = map_data['width'] * GRID_SIZE
         self.height = map_data['height'] * GRID_SIZE
+        self.background_color = map_data['background-color'] or DEFAULT_BACKGROUND
             
         self.start_x = map_data['start'][0] * GRID_SIZE
         self.start_y = map_data['start'][1] * GRID_SIZE
@@ -756,157 +2485,726 @@ class Level():
         
 
         for item in map_data['blocks']:
-            x, y = item[0] * GRID_SIZE, item[1] * GRID_SIZE
-            img = block_images[item[2]]
-            self.starting_blocks.append(Block(x, y, img))
+            self.spawn_block(item)
 
-        for item in map_data['bears']:
-            x, y = item[0] * GRID_SIZE, item[1] * GRID_SIZE
-            self.starting_enemies.append(Bear(x, y, bear_images))
+        for key in Level.ENTITY_KEYS:
+            self.spawned[key] = {}
+            self.spawn_entities(key, map_data[key])
 
-        for item in map_data['monsters']:
-            x, y = item[0] * GRID_SIZE, item[1] * GRID_SIZE
-            self.starting_enemies.append(Monster(x, y, monster_images))
-            
-        for item in map_data['birds']:
-            x, y = item[0] * GRID_SIZE, item[1] * GRID_SIZE
-            self.starting_enemies.append(Bird(x, y, bird_images))
+        # Static sprites are baked in chunks as they come into view, see ChunkLayer
+        self.inactive_layer = ChunkLayer(self)
+        self.build_backdrops(map_data)
+
+        audio.load_music(map_data['music'])
+
+        self.gravity = map_data['gravity']
+        self.terminal_velocity = map_data['terminal-velocity']
 
-        for item in map_data['coins']:
-            x, y = item[0] * GRID_SIZE, item[1] * GRID_SIZE
-            self.starting_coins.append(Coin(x, y, coin_img))
+        self.completed = False
 
-        for item in map_data['oneups']:
-            x, y = item[0] * GRID_SIZE, item[1] * GRID_SIZE
-            self.starting_powerups.append(OneUp(x, y, oneup_img))
+        self.tiles = TileIndex(self.blocks)
+        self.inactive_sprites.add(self.blocks)
+        self.spawn_platforms(map_data.get('platforms', []))
+
+        for category in ENTITY_CATEGORIES.values():
+            group = getattr(self, category.group)
+            group.add(getattr(self, category.starting))
+            getattr(self, category.layer).add(group)
+
+        # What Character.update checks after moving, as (method, group)
+        self.pickups = [(getattr(Character, ENTITY_CATEGORIES[name].handler), getattr(self, ENTITY_CATEGORIES[name].group))
+                        for name in PICKUP_ORDER]
+
+    def validate(self, map_data):
+        # Raises KeyError, IndexError, TypeError or ValueError if the level
+        # can't be built from map_data, so a reload can check before it
+        # changes anything
+        for key in Level.REQUIRED_KEYS + Level.ENTITY_KEYS:
+            if key not in map_data:
+                raise KeyError(key)
+
+        for name in ['background', 'scenery']:
+            if map_data[name + '-img'] != "":
+                for key in ['-fill-y', '-position', '-repeat-x']:
+                    if name + key not in map_data:
+                        raise KeyError(name + key)
+
+        x, y = map_data['start']
+
+        for x, y, code in map_data['blocks']:
+            if code not in block_images:
+                raise KeyError(code)
+
+        for key in Level.ENTITY_KEYS:
+            for item in map_data[key]:
+                if len(item) < 2:
+                    raise IndexError(key + " item " + str(item))
+
+        for item in map_data.get('platforms', []):
+            if len(item['path']) == 0:
+                raise ValueError("platform with no path")
+
+    def spawn_block(self, item):
+        x, y = item[0] * GRID_SIZE, item[1] * GRID_SIZE
+        img = block_images[item[2]]
+        block = Block(x, y, img)
+        block.item = tuple(item)
+
+        self.blocks.add(block)
+        self.cell_blocks.setdefault((item[0], item[1]), []).append(block)
+
+        return block
+
+    def spawn_entities(self, key, items, first=0):
+        # Builds the entities for one JSON key and adds them to its starting
+        # list and to spawned. Returns them along with the groups they belong
+        # in. first is the index of items[0] in the JSON list (only the first
+        # flag item is the flag, the rest are pole).
+        category = ENTITY_CATEGORIES[ENTITY_TYPES[key].category]
+        entities = ENTITY_TYPES[key].spawn(items, first)
+        getattr(self, category.starting).extend(entities)
+        groups = [getattr(self, category.group), getattr(self, category.layer)]
+        spawned = [(e, groups) for e in entities]
+
+        for item, (e, groups) in zip(items, spawned):
+            cell = (int(item[0]), int(item[1]))
+            self.spawned[key].setdefault(cell, []).append((item, e, groups))
+
+        return spawned
+
+    def block_items(self):
+        return [list(block.item) for blocks in self.cell_blocks.values() for block in blocks]
+
+    def entity_items(self, key):
+        return [item for spawned in self.spawned[key].values() for item, e, groups in spawned]
+
+    def sync_map_data(self):
+        # The editor only changes cell_blocks and spawned, this writes them
+        # back into map_data before it's saved or compared
+        self.map_data['blocks'] = self.block_items()
+
+        for key in Level.ENTITY_KEYS:
+            self.map_data[key] = self.entity_items(key)
+
+    def spawn_platforms(self, items):
+        for item in items:
+            platform = Platform(item['path'], item.get('width', 1), item.get('speed', 1), item.get('loop', False),
+                                item.get('falls', False), item.get('delay', 30))
+            self.platforms.add(platform)
+            self.active_sprites.add(platform)
+            self.tiles.add(platform)
+
+    def clear_platforms(self):
+        for platform in self.platforms:
+            if not platform.fallen:
+                self.tiles.remove(platform)
+
+            platform.kill()
+
+    def update_platforms(self, bodies):
+        # Moves the platforms and whatever is standing on them. Only the
+        # platforms that moved are taken out of the TileIndex and put back.
+        rects = [b.rect for b in bodies]
+        standing = {} # Bodies by the height of their feet
+
+        for body in bodies:
+            standing.setdefault(body.rect.bottom, []).append(body)
+
+        for platform in self.platforms:
+            if platform.fallen:
+                continue
+
+            rect = platform.rect
+            riders = [b for b in standing.get(rect.top, ()) if b.rect.bottom == rect.top and
+                      b.rect.right > rect.left and b.rect.left < rect.right]
+            x, y = platform.advance(self, len(riders) > 0)
+            dx = x - rect.x
+            dy = y - rect.y
+
+            if dx == 0 and dy == 0:
+                continue
+
+            self.move_platform(platform, x, y)
+
+            if platform.fallen:
+                continue
+
+            for body in riders:
+                # Kept on top, then carried sideways as far as the blocks allow
+                body.rect.bottom = rect.top
+                move, hit_list = self.tiles.sweep_x(body.rect, dx)
+                body.rect.x += move
+
+            for i in rect.collidelistall(rects):
+                # Anything else in the way is pushed out
+                body = bodies[i]
+
+                if dy < 0 and body.rect.centery < rect.centery:
+                    body.rect.bottom = rect.top
+                elif dx > 0:
+                    body.rect.left = rect.right
+                elif dx < 0:
+                    body.rect.right = rect.left
+                elif dy > 0:
+                    body.rect.top = rect.bottom
+
+    def move_platform(self, platform, x, y):
+        self.tiles.remove(platform)
+        platform.rect.topleft = (x, y)
+
+        if not platform.fallen:
+            self.tiles.add(platform)
+
+    def flow_field(self, mode):
+        if mode not in self.flow_fields:
+            self.flow_fields[mode] = FlowField(self, mode)
+
+        return self.flow_fields[mode]
+
+    def update_flow_fields(self, hero):
+        for field in self.flow_fields.values():
+            field.update(hero.rect)
 
-        for item in map_data['hearts']:
-            x, y = item[0] * GRID_SIZE, item[1] * GRID_SIZE
-            self.starting_powerups.append(Heart(x, y, heart_img))
+    def is_baked(self, key):
+        # Whether entities under key are drawn into the static layer
+        return ENTITY_CATEGORIES[ENTITY_TYPES[key].category].layer == "inactive_sprites"
 
-        for item in map_data['speedups']:
-            x, y = item[0] * GRID_SIZE, item[1] * GRID_SIZE
-            self.starting_powerups.append(SpeedUp(x, y, speedup_img))
+    def build_backdrops(self, map_data):
+        # Keeps each backdrop image once, draw_backdrops repeats it across the view.
+        # The background scrolls at a third of the level's speed, the scenery at half.
+        backdrops = []
+
+        for name, speed in [('background', 3), ('scenery', 2)]:
+            if map_data[name + '-img'] == "":
+                continue
+
+            img = pygame.image.load(map_data[name + '-img'])
+
+            if map_data[name + '-fill-y']:
+                h = img.get_height()
+                w = int(img.get_width() * VIEW_HEIGHT / h)
+                img = pygame.transform.scale(img, (w, VIEW_HEIGHT))
+
+            if pygame.display.get_surface() is not None:
+                # Blitting them every frame is several times slower unconverted
+                img = img.convert_alpha()
+
+            if "top" in map_data[name + '-position']:
+                start_y = 0
+            elif "bottom" in map_data[name + '-position']:
+                start_y = self.height - img.get_height()
 
-        for item in map_data['speeddowns']:
-            x, y = item[0] * GRID_SIZE, item[1] * GRID_SIZE
-            self.starting_powerups.append(SpeedDown(x, y, speeddown_img))
-            
-        for item in map_data['keys']:
-            x, y = item[0] * GRID_SIZE, item[1] * GRID_SIZE
-            self.starting_keys.append(Key(x, y, key_img))
-            
-        for item in map_data['chests']:
-            x, y = item[0] * GRID_SIZE, item[1] * GRID_SIZE
-            self.starting_chests.append(Chest(x, y, chest_img))
+            backdrops.append((scaled(img), img.get_width(), start_y, map_data[name + '-repeat-x'], speed))
 
-        for item in map_data['prizes']:
-            x, y = item[0] * GRID_SIZE, item[1] * GRID_SIZE
-            self.starting_prizes.append(Prize(x, y, oneup_img))
+        # Only replaced once every image has loaded
+        self.backdrops = backdrops
 
-        for item in map_data['alt_coin']:
-            x, y = item[0] * GRID_SIZE, item[1] * GRID_SIZE
-            self.starting_alt_coins.append(Coin(x, y, alt_coin_img))
-            
-        for i, item in enumerate(map_data['flag']):
-            x, y = item[0] * GRID_SIZE, item[1] * GRID_SIZE
+    def draw_backdrops(self, surface, offset_x, offset_y):
+        # Positions are in level pixels, w is the image's width in the level
+        surface.fill(self.background_color, to_render_rect([int(offset_x / 3), offset_y, self.width, self.height]))
+
+        for img, w, start_y, repeat, speed in self.backdrops:
+            x = int(offset_x / speed)
+            y = to_render(offset_y + start_y)
+            surface.set_clip(to_render_rect([x, offset_y, self.width, self.height]))
+
+            if repeat:
+                first = max(0, -x // w)
+                last = min((self.width - 1) // w, (math.ceil(surface.get_width() / RENDER_SCALE) - x) // w)
 
-            if i == 0:
-                img = flag_img
+                for i in range(first, last + 1):
+                    surface.blit(img, [to_render(x + i * w), y])
             else:
-                img = flagpole_img
+                surface.blit(img, [to_render(x), y])
 
-            self.starting_flag.append(Flag(x, y, img))
-        
+            surface.set_clip(None)
 
-        self.background_layer = pygame.Surface([self.width, self.height], pygame.SRCALPHA, 32)
-        self.scenery_layer = pygame.Surface([self.width, self.height], pygame.SRCALPHA, 32)
-        self.inactive_layer = pygame.Surface([self.width, self.height], pygame.SRCALPHA, 32)
-        self.active_layer = pygame.Surface([self.width, self.height], pygame.SRCALPHA, 32)
+    def draw_sprites(self, surface, sprites, offset_x, offset_y):
+        surface.blits([(scaled(s.image), (to_render(s.rect.x + offset_x), to_render(s.rect.y + offset_y))) for s in sprites], False)
 
-        if map_data['background-color'] != "":
-            self.background_layer.fill(map_data['background-color'])
+    def bake(self, surface, rect, area):
+        # Draws the static sprites overlapping area onto surface, which
+        # covers rect of the level
+        for block in self.tiles.collide(area):
+            if block in self.blocks:
+                surface.blit(scaled(block.image), [to_render(block.rect.x - rect.x), to_render(block.rect.y - rect.y)])
 
-        if map_data['background-img'] != "":
-            background_img = pygame.image.load(map_data['background-img'])
+        for flag in self.flag:
+            if flag.rect.colliderect(area):
+                surface.blit(scaled(flag.image), [to_render(flag.rect.x - rect.x), to_render(flag.rect.y - rect.y)])
 
-            if map_data['background-fill-y']:
-                h = background_img.get_height()
-                w = int(background_img.get_width() * HEIGHT / h)
-                background_img = pygame.transform.scale(background_img, (w, HEIGHT))
+    def rebake(self, rect):
+        # Redraws one area of the static tile layer instead of the whole thing
+        self.inactive_layer.rebake(rect)
 
-            if "top" in map_data['background-position']:
-                start_y = 0
-            elif "bottom" in map_data['background-position']:
-                start_y = self.height - background_img.get_height()
+    def add_block(self, block):
+        self.blocks.add(block)
+        self.inactive_sprites.add(block)
+        self.tiles.add(block)
+        self.rebake(block.rect)
+        self.flow_fields.clear()
 
-            if map_data['background-repeat-x']:
-                for x in range(0, self.width, background_img.get_width()):
-                    self.background_layer.blit(background_img, [x, start_y])
-            else:
-                self.background_layer.blit(background_img, [0, start_y])
+    def remove_block(self, block):
+        cell = block.item[:2]
+        self.cell_blocks[cell].remove(block)
 
-        if map_data['scenery-img'] != "":
-            scenery_img = pygame.image.load(map_data['scenery-img'])
+        if len(self.cell_blocks[cell]) == 0:
+            del self.cell_blocks[cell]
 
-            if map_data['scenery-fill-y']:
-                h = scenery_img.get_height()
-                w = int(scenery_img.get_width() * HEIGHT / h)
-                scenery_img = pygame.transform.scale(scenery_img, (w, HEIGHT))
+        self.tiles.remove(block)
+        block.kill()
+        self.rebake(block.rect)
+        self.flow_fields.clear()
 
-            if "top" in map_data['scenery-position']:
-                start_y = 0
-            elif "bottom" in map_data['scenery-position']:
-                start_y = self.height - scenery_img.get_height()
+    def despawn(self, e):
+        for category in ENTITY_CATEGORIES.values():
+            starting = getattr(self, category.starting)
 
-            if map_data['scenery-repeat-x']:
-                for x in range(0, self.width, scenery_img.get_width()):
-                    self.scenery_layer.blit(scenery_img, [x, start_y])
-            else:
-                self.scenery_layer.blit(scenery_img, [0, start_y])
+            if e in starting:
+                starting.remove(e)
+
+        e.kill()
+
+    def block_at(self, x, y):
+        blocks = self.cell_blocks.get((x, y))
+
+        if blocks:
+            return blocks[-1]
 
-        pygame.mixer.music.load(map_data['music'])
+        return None
 
+    def place_block(self, x, y, code):
+        # Used by the editor, map_data is brought up to date by sync_map_data
+        self.add_block(self.spawn_block([x, y, code]))
+
+    def erase_block(self, block):
+        self.remove_block(block)
+
+    def entity_at(self, x, y):
+        # Returns the JSON key of the entity spawned in a cell, and the cell
+        for key in Level.ENTITY_KEYS:
+            if (x, y) in self.spawned[key]:
+                return key, (x, y)
+
+        return None, None
+
+    def place_entity(self, key, x, y):
+        first = sum(len(spawned) for spawned in self.spawned[key].values())
+        spawned = self.spawn_entities(key, [[x, y]], first)
+
+        for e, groups in spawned:
+            for group in groups:
+                group.add(e)
+
+            if self.is_baked(key):
+                self.rebake(e.rect)
+
+    def erase_entity(self, key, cell):
+        for item, e, groups in self.spawned[key].pop(cell):
+            self.despawn(e)
+
+            if self.is_baked(key):
+                self.rebake(e.rect)
+
+    def save(self):
+        # One key per line, like the hand written levels
+        self.sync_map_data()
+        lines = ['\t' + json.dumps(key) + ': ' + json.dumps(value) for key, value in self.map_data.items()]
+
+        with open(self.file_path, 'w') as f:
+            f.write('{\n' + ',\n'.join(lines) + '\n}\n')
+
+    def reload(self, map_data):
+        # Applies an edited copy of the level JSON. Only blocks and entity
+        # lists that changed are rebuilt. Returns False if the change needs
+        # a full rebuild (size changes). map_data is checked first, so if it
+        # raises the level is left as it was.
+        self.validate(map_data)
+        self.sync_map_data()
+        old = self.map_data
+
+        for key in ['width', 'height']:
+            if map_data[key] != old[key]:
+                return False
+
+        backdrop_keys = [k for k in map_data if k.startswith('background') or k.startswith('scenery')]
+
+        if any(map_data.get(k) != old.get(k) for k in backdrop_keys):
+            self.build_backdrops(map_data)
+            self.background_color = map_data['background-color'] or DEFAULT_BACKGROUND
+
+        if map_data['blocks'] != old['blocks']:
+            old_items = {}
+            new_items = {}
+
+            for item in old['blocks']:
+                old_items[tuple(item)] = old_items.get(tuple(item), 0) + 1
+
+            for item in map_data['blocks']:
+                new_items[tuple(item)] = new_items.get(tuple(item), 0) + 1
+
+            for item, count in old_items.items():
+                for i in range(count - new_items.get(item, 0)):
+                    blocks = [b for b in self.cell_blocks[item[:2]] if b.item == item]
+                    self.remove_block(blocks[-1])
+
+            for item, count in new_items.items():
+                for i in range(count - old_items.get(item, 0)):
+                    self.add_block(self.spawn_block(item))
+
+        if map_data.get('platforms') != old.get('platforms'):
+            self.clear_platforms()
+            self.spawn_platforms(map_data.get('platforms', []))
+
+        for key in Level.ENTITY_KEYS:
+            if map_data[key] != old[key]:
+                dirty = []
+
+                for spawned in self.spawned[key].values():
+                    for item, e, groups in spawned:
+                        self.despawn(e)
+                        dirty.append(e.rect)
+
+                self.spawned[key] = {}
+
+                for e, groups in self.spawn_entities(key, map_data[key]):
+                    for group in groups:
+                        group.add(e)
+
+                    dirty.append(e.rect)
+
+                if self.is_baked(key):
+                    for rect in dirty:
+                        self.rebake(rect)
+
+        self.start_x = map_data['start'][0] * GRID_SIZE
+        self.start_y = map_data['start'][1] * GRID_SIZE
+        self.level_name = map_data['name']
         self.gravity = map_data['gravity']
         self.terminal_velocity = map_data['terminal-velocity']
 
-        self.completed = False
+        if map_data['music'] != old['music']:
+            audio.load_music(map_data['music'])
 
-        self.blocks.add(self.starting_blocks)
-        self.enemies.add(self.starting_enemies)
-        self.coins.add(self.starting_coins)
-        self.powerups.add(self.starting_powerups)
-        self.flag.add(self.starting_flag)
-        self.key.add(self.starting_keys)
-        self.chest.add(self.starting_chests)
-        self.alt_coin.add(self.starting_alt_coins)
-    
-        self.prize.add(self.starting_prizes)
-    
-        self.active_sprites.add(self.coins, self.enemies, self.powerups, self.key, self.chest, self.alt_coin)
-        self.active_sprites2.add(self.prize)
-        self.inactive_sprites.add(self.blocks, self.flag)
+        self.map_data = map_data
 
-        self.inactive_sprites.draw(self.inactive_layer)
+        return True
 
     def reset(self, character):
-        self.enemies.add(self.starting_enemies)
-        self.coins.add(self.starting_coins)
-        self.powerups.add(self.starting_powerups)
-        self.key.add(self.starting_keys)
-        self.chest.add(self.starting_chests)
-        self.prize.add(self.starting_prizes)
-        self.alt_coin.add(self.starting_alt_coins)
-        self.chest_opened = False
-        
-            
+        for platform in self.platforms:
+            if not platform.fallen:
+                self.tiles.remove(platform)
 
-        self.active_sprites.add(self.coins, self.enemies, self.powerups, self.key, self.chest, self.alt_coin)
-        self.active_sprites2.add(self.prize)
+            platform.reset()
+            self.tiles.add(platform)
+
+        # Puts back everything that was picked up or killed
+        for category in ENTITY_CATEGORIES.values():
+            group = getattr(self, category.group)
+            group.add(getattr(self, category.starting))
+            getattr(self, category.layer).add(group)
+
+        self.chest_opened = False
 
         for e in self.enemies:
             e.reset()
 
+class HotReloader():
+    # Dev mode only. Polls the level file and every image for changes and
+    # patches the running level in place, the hero keeps its position and state.
+
+    def __init__(self, game):
+        self.game = game
+        self.mtimes = {}
+        self.last_poll = 0
+
+    def mtime(self, path):
+        try:
+            return os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+
+    def changed(self, path):
+        mtime = self.mtime(path)
+
+        if path not in self.mtimes:
+            self.mtimes[path] = mtime
+            return False
+
+        if mtime != self.mtimes[path]:
+            self.mtimes[path] = mtime
+            return mtime is not None
+
+        return False
+
+    def poll(self):
+        now = time.monotonic()
+
+        if now - self.last_poll < HOT_RELOAD_INTERVAL:
+            return
+
+        self.last_poll = now
+        level = self.game.level
+
+        if self.changed(level.file_path):
+            self.reload_level(level)
+
+        for file_path in loaded_images:
+            if self.changed(file_path):
+                self.reload_image(file_path)
+
+        for key in ['background-img', 'scenery-img']:
+            file_path = level.map_data[key]
+
+            if file_path != "" and self.changed(file_path):
+                level.build_backdrops(level.map_data)
+
+    def reload_level(self, level):
+        try:
+            with open(level.file_path, 'r') as f:
+                map_data = json.loads(f.read())
+
+            if not level.reload(map_data):
+                self.game.level = Level(level.file_path, self.game.timers)
+                self.game.level.reset(self.game)
+
+            print("Reloaded", level.file_path)
+        except (ValueError, KeyError, IndexError, TypeError, OSError, pygame.error) as e:
+            print("Could not reload", level.file_path, e)
+
+    def reload_image(self, file_path):
+        try:
+            surfaces = reload_image(file_path)
+        except pygame.error as e:
+            print("Could not reload", file_path, e)
+            return
+
+        level = self.game.level
+        self.game.hero.load_images(hero_images)
+
+        for e in level.starting_enemies:
+            e.load_images(e.images_left)
+
+        for sprite in list(level.blocks) + level.starting_flag:
+            if sprite.image in surfaces:
+                level.rebake(sprite.rect)
+
+        print("Reloaded", file_path)
+
+
+class Editor():
+    # Level editing with the mouse. Left click places the selected tile or
+    # entity, right click removes what is in the cell, and each edit only
+    # re-bakes the cell it touched. Q/E or the mouse wheel pick from the
+    # palette, W/A/S/D scroll and F2 saves back to the level file.
+
+    def __init__(self, game):
+        self.game = game
+        self.camera_x = 0
+        self.camera_y = 0
+        self.selected = 0
+
+        self.palette = [("block", code, img) for code, img in block_images.items()]
+        self.palette += [("entity", t.key, t.icon()) for t in ENTITY_TYPES.values()]
+
+        self.cursor = self.palette[0][2].copy()
+        self.cursor.set_alpha(128)
+
+    def open(self):
+        offset_x, offset_y = self.game.calculate_offset()
+        self.camera_x = -offset_x
+        self.camera_y = -offset_y
+
+    def offset(self):
+        level = self.game.level
+        self.camera_x = max(0, min(self.camera_x, level.width - VIEW_WIDTH))
+        self.camera_y = max(0, min(self.camera_y, level.height - VIEW_HEIGHT))
+
+        return -self.camera_x, -self.camera_y
+
+    def cell_at(self, pos):
+        x, y = self.game.window_to_view(pos)
+        offset_x, offset_y = self.offset()
+        cx = int((x - offset_x) // GRID_SIZE)
+        cy = int((y - offset_y) // GRID_SIZE)
+        level = self.game.level
+
+        if 0 <= cx < level.width // GRID_SIZE and 0 <= cy < level.height // GRID_SIZE:
+            return cx, cy
+
+        return None
+
+    def select(self, step):
+        self.selected = (self.selected + step) % len(self.palette)
+        self.cursor = self.palette[self.selected][2].copy()
+        self.cursor.set_alpha(128)
+
+    def paint(self, cell):
+        kind, key, img = self.palette[self.selected]
+        level = self.game.level
+        x, y = cell
+
+        if kind == "block":
+            block = level.block_at(x, y)
+
+            if block is not None:
+                if block.item[2] == key:
+                    return
+
+                level.erase_block(block)
+
+            level.place_block(x, y, key)
+        else:
+            old_key, old_cell = level.entity_at(x, y)
+
+            if old_key == key:
+                return
+
+            if old_key is not None:
+                level.erase_entity(old_key, old_cell)
+
+            level.place_entity(key, x, y)
+
+    def erase(self, cell):
+        level = self.game.level
+        block = level.block_at(*cell)
+
+        if block is not None:
+            level.erase_block(block)
+        else:
+            key, cell = level.entity_at(*cell)
+
+            if key is not None:
+                level.erase_entity(key, cell)
+
+    def handle_event(self, event):
+        if event.type == pygame.MOUSEBUTTONDOWN or event.type == pygame.MOUSEMOTION:
+            cell = self.cell_at(event.pos)
+
+            if event.type == pygame.MOUSEBUTTONDOWN:
+                left, right = event.button == 1, event.button == 3
+            else:
+                left, right = event.buttons[0], event.buttons[2]
+
+            if cell is not None and left:
+                self.paint(cell)
+            elif cell is not None and right:
+                self.erase(cell)
+
+        elif event.type == pygame.MOUSEWHEEL:
+            self.select(-event.y)
+
+        elif event.type == pygame.KEYDOWN:
+            if event.key == EDIT_NEXT:
+                self.select(1)
+            elif event.key == EDIT_PREV:
+                self.select(-1)
+            elif event.key == EDIT_SAVE:
+                self.game.level.save()
+                print("Saved", self.game.level.file_path)
+
+    def update(self):
+        pressed = pygame.key.get_pressed()
+
+        if pressed[LEFT]:
+            self.camera_x -= 16
+        elif pressed[RIGHT]:
+            self.camera_x += 16
+
+        if pressed[EDIT_UP]:
+            self.camera_y -= 16
+        elif pressed[DOWN]:
+            self.camera_y += 16
+
+    def draw(self, surface):
+        offset_x, offset_y = self.offset()
+        cell = self.cell_at(pygame.mouse.get_pos())
+
+        if cell is not None:
+            rect = to_render_rect([cell[0] * GRID_SIZE + offset_x, cell[1] * GRID_SIZE + offset_y, GRID_SIZE, GRID_SIZE])
+            surface.blit(scaled(self.cursor), rect)
+            pygame.draw.rect(surface, WHITE, rect, max(1, ui(2)))
+
+        kind, key, img = self.palette[self.selected]
+        text = FONT_SM.render("Editing: " + key + "  (F2 saves, F1 plays)", 1, WHITE)
+        surface.blit(text, (WIDTH / 2 - text.get_width() / 2, HEIGHT - ui(48)))
+
+
+class FramePacer():
+    # Times update and draw each frame and moves between QUALITY_LEVELS.
+    # Quality drops after DEGRADE_AFTER frames over budget and comes back after
+    # RESTORE_AFTER frames that used less than half of it.
+
+    def __init__(self, budget_ms=FRAME_BUDGET_MS):
+        self.budget_ms = budget_ms
+        self.quality = len(QUALITY_LEVELS) - 1
+        self.settings = QUALITY_LEVELS[self.quality]
+
+        self.histogram = [0] * (len(FRAME_HISTOGRAM_BUCKETS) + 1)
+        self.update_ms = 0
+        self.draw_ms = 0
+        self.average_ms = 0
+        self.over_budget = 0
+        self.headroom = 0
+
+        self.mark = 0
+
+    def begin(self):
+        self.mark = time.perf_counter()
+
+    def end_update(self):
+        now = time.perf_counter()
+        self.update_ms = (now - self.mark) * 1000
+        self.mark = now
+
+    def end_draw(self):
+        now = time.perf_counter()
+        self.draw_ms = (now - self.mark) * 1000
+        self.mark = now
+
+        self.record(self.update_ms + self.draw_ms)
+
+    def record(self, frame_ms):
+        for i, bound in enumerate(FRAME_HISTOGRAM_BUCKETS):
+            if frame_ms < bound:
+                self.histogram[i] += 1
+                break
+        else:
+            self.histogram[-1] += 1
+
+        self.average_ms = 0.9 * self.average_ms + 0.1 * frame_ms
+
+        if self.average_ms > self.budget_ms:
+            self.over_budget += 1
+            self.headroom = 0
+        elif self.average_ms < self.budget_ms / 2:
+            self.headroom += 1
+            self.over_budget = 0
+        else:
+            self.over_budget = 0
+            self.headroom = 0
+
+        if self.over_budget >= DEGRADE_AFTER and self.quality > 0:
+            self.set_quality(self.quality - 1)
+        elif self.headroom >= RESTORE_AFTER and self.quality < len(QUALITY_LEVELS) - 1:
+            self.set_quality(self.quality + 1)
+
+    def set_quality(self, quality):
+        self.quality = quality
+        self.settings = QUALITY_LEVELS[quality]
+        self.over_budget = 0
+        self.headroom = 0
+
+        Enemy.animate_enemies = self.settings["animate_enemies"]
+
+    def stats(self):
+        return {"quality": self.quality,
+                "update_ms": self.update_ms,
+                "draw_ms": self.draw_ms,
+                "average_ms": self.average_ms,
+                "histogram": list(zip(FRAME_HISTOGRAM_BUCKETS + [None], self.histogram))}
+
+
 class Game():
 
     SPLASH = 0
@@ -916,38 +3214,99 @@ class Game():
     LEVEL_COMPLETED = 4
     GAME_OVER = 5
     VICTORY = 6
+    EDITING = 7
 
     def __init__(self):
-        self.window = pygame.display.set_mode([WIDTH, HEIGHT])
+        # Everything is drawn to self.window, a backbuffer at the render
+        # resolution, and present() scales it once onto the real display.
+        # The VIEW_WIDTH by VIEW_HEIGHT area of the level around the hero is
+        # drawn into it at RENDER_SCALE, see scaled().
+        self.display = pygame.display.set_mode([WINDOW_WIDTH, WINDOW_HEIGHT], pygame.RESIZABLE)
+        self.window = pygame.Surface([WIDTH, HEIGHT]).convert()
+        self.resize(self.display.get_size())
         pygame.display.set_caption(TITLE)
         self.done = False
         self.clock = pygame.time.Clock()
         self.refresh_rate = 60
-        self.ticks = 0
-        self.timer_ticks = 0
         self.time_limit = 300
+        self.pacer = FramePacer()
+        self.show_frame_stats = False
+        self.hud_layer = pygame.Surface([WIDTH, HEIGHT], pygame.SRCALPHA, 32)
+        self.hud_age = 0
+        self.editor = Editor(self)
+        self.stage_before_edit = Game.PLAYING
+        self.ghost_recorder = GhostRecorder()
+        self.ghost_store = None if HEADLESS else GhostStore(GHOST_DIR)
+        self.ghost = None
+
+        if DEV_MODE:
+            self.hot_reloader = HotReloader(self)
+        else:
+            self.hot_reloader = None
         
         self.reset()
 
     def start(self):
-        self.level = Level(levels[self.current_level])
+        self.level = Level(levels[self.current_level], self.timers)
         self.level.reset(self)
         self.level.chest_opened = False
         self.hero.respawn(self.level)
+        self.section = None
+        particles.clear()
+        self.start_ghost()
+
+        telemetry.emit("start", self.timers.tick, self.hero.rect.x, self.hero.rect.y, level=self.level.level_name,
+                       coins=len(self.level.coins) + len(self.level.alt_coin))
             
     def advance(self):
         self.current_level += 1
         self.hero.max_hearts += 1
         self.start()
         self.stage = Game.START
+        memory.snapshot("advance", self)
 
     def reset(self):
-        self.hero = Character(hero_images)
+        # Game timers only run while playing, see update()
+        self.timers = Scheduler()
+        self.timers.every(self.refresh_rate, self.count_down)
+        self.hero = Character(hero_images, self.timers)
         self.current_level = 0
         self.start()
         self.level.chest_opened = False
         self.stage = Game.SPLASH
         self.time_limit = 300
+        memory.snapshot("reset", self)
+
+    def resize(self, size):
+        win_w, win_h = size
+        factor = min(win_w // WIDTH, win_h // HEIGHT)
+
+        if SCALE_MODE == "integer" and factor >= 1:
+            w, h = WIDTH * factor, HEIGHT * factor
+        else:
+            factor = min(win_w / WIDTH, win_h / HEIGHT)
+            w, h = max(1, int(WIDTH * factor)), max(1, int(HEIGHT * factor))
+
+        self.present_rect = pygame.Rect((win_w - w) // 2, (win_h - h) // 2, w, h)
+        self.present_target = self.display.subsurface(self.present_rect)
+        self.display.fill(BLACK)
+
+    def window_to_view(self, pos):
+        # Converts a position on the display (e.g. the mouse) to a position in the view
+        x = (pos[0] - self.present_rect.x) * WIDTH / self.present_rect.width / RENDER_SCALE
+        y = (pos[1] - self.present_rect.y) * HEIGHT / self.present_rect.height / RENDER_SCALE
+
+        return int(x), int(y)
+
+    def present(self):
+        if self.present_rect.size == (WIDTH, HEIGHT):
+            self.present_target.blit(self.window, [0, 0])
+        elif SCALE_MODE == "smooth" and self.window.get_bitsize() in (24, 32):
+            pygame.transform.smoothscale(self.window, self.present_rect.size, self.present_target)
+        else:
+            pygame.transform.scale(self.window, self.present_rect.size, self.present_target)
+
+        pygame.display.flip()
 
     def display_splash(self, surface):
         line1 = FONT_LG.render(TITLE, 1, DARK_BLUE)
@@ -957,7 +3316,7 @@ class Game():
         y1 = HEIGHT / 3 - line1.get_height() / 2;
 
         x2 = WIDTH / 2 - line2.get_width() / 2;
-        y2 = y1 + line1.get_height() + 16;
+        y2 = y1 + line1.get_height() + ui(16);
 
         surface.blit(line1, (x1, y1))
         surface.blit(line2, (x2, y2))
@@ -970,7 +3329,7 @@ class Game():
         y1 = HEIGHT / 3 - line1.get_height() / 2;
 
         x2 = WIDTH / 2 - line2.get_width() / 2;
-        y2 = y1 + line1.get_height() + 16;
+        y2 = y1 + line1.get_height() + ui(16);
 
         surface.blit(line1, (x1, y1))
         surface.blit(line2, (x2, y2))
@@ -983,20 +3342,20 @@ class Game():
         coins_text = FONT_SM.render("Coins x" + str(self.hero.collected_coins), 1, WHITE)
         time_text = FONT_SM.render("Time left:" + str(self.time_limit), 1, WHITE)
 
-        surface.blit(score_text, (WIDTH - score_text.get_width() - 32, 32))
-        surface.blit(coins_text, (WIDTH - coins_text.get_width() - 32, 64))
-        surface.blit(hearts_text, (32, 96))
-        surface.blit(lives_text, (32, 128))
-        surface.blit(level_text, (32, 32))
-        surface.blit(time_text, (32, 64))
+        surface.blit(score_text, (WIDTH - score_text.get_width() - ui(32), ui(32)))
+        surface.blit(coins_text, (WIDTH - coins_text.get_width() - ui(32), ui(64)))
+        surface.blit(hearts_text, (ui(32), ui(96)))
+        surface.blit(lives_text, (ui(32), ui(128)))
+        surface.blit(level_text, (ui(32), ui(32)))
+        surface.blit(time_text, (ui(32), ui(64)))
 
         if self.stage == Game.PAUSED:
             pause_text = FONT_SM.render("Paused", 1, BLACK)
-            surface.blit(pause_text, (WIDTH / 2 - 46, 128))
+            surface.blit(pause_text, (WIDTH / 2 - pause_text.get_width() / 2, ui(128)))
 
         if self.stage == Game.PLAYING and self.hero.has_key:
             key_text = FONT_SM.render("Got the Key.", 1, WHITE)
-            surface.blit(key_text, (32, 160))
+            surface.blit(key_text, (ui(32), ui(160)))
         
         
         if self.stage == Game.LEVEL_COMPLETED or self.stage == Game.VICTORY:
@@ -1005,24 +3364,82 @@ class Game():
             ending_powerup_text = FONT_SM.render("Total Powerups Collected: " + str(self.hero.power_ups_collected), 1, BLACK)
             ending_kills_text = FONT_SM.render("Total Powerups Collected: " + str(self.hero.enemies_slain), 1, BLACK)
             
-            surface.blit(ending_coins_text, (32, 512))
-            surface.blit(ending_score_text, (32, 544))
-            surface.blit(ending_powerup_text, (32, 576))
-            surface.blit(ending_kills_text, (32, 608))
+            surface.blit(ending_coins_text, (ui(32), HEIGHT - ui(128)))
+            surface.blit(ending_score_text, (ui(32), HEIGHT - ui(96)))
+            surface.blit(ending_powerup_text, (ui(32), HEIGHT - ui(64)))
+            surface.blit(ending_kills_text, (ui(32), HEIGHT - ui(32)))
+
+        if self.stage == Game.GAME_OVER or self.stage == Game.VICTORY:
+            self.display_high_scores(surface)
+
+    def display_frame_stats(self, surface):
+        # The frame pacer's numbers, toggled with FRAME_STATS. The histogram
+        # counts every frame since the start.
+        stats = self.pacer.stats()
+        buckets = [("<" + str(bound) if bound is not None else str(FRAME_HISTOGRAM_BUCKETS[-1]) + "+") + ": " + str(count)
+                   for bound, count in stats["histogram"]]
+        half = len(buckets) // 2
+        lines = ["Quality " + str(stats["quality"]) + "/" + str(len(QUALITY_LEVELS) - 1) + "  average " + format(stats["average_ms"], ".1f") + " ms",
+                 "Update " + format(stats["update_ms"], ".1f") + " ms  draw " + format(stats["draw_ms"], ".1f") + " ms",
+                 "  ".join(buckets[:half]),
+                 "  ".join(buckets[half:])]
+
+        for i, line in enumerate(lines):
+            text = FONT_XS.render(line, 1, WHITE)
+            surface.blit(text, (WIDTH / 2 - text.get_width() / 2, ui(32) + i * ui(24)))
+
+    def display_high_scores(self, surface):
+        # Filled in by the run history thread, shows nothing until it answers
+        best = run_history.best.get(self.level.level_name)
+        lines = []
+
+        if best is not None:
+            lines.append("Best on " + str(self.level.level_name) + ": " + str(best))
+
+        for i, (score, level) in enumerate(run_history.top):
+            lines.append(str(i + 1) + ". " + str(score) + "  " + str(level))
+
+        y = HEIGHT - ui(32) * len(lines)
+
+        for line in lines:
+            text = FONT_SM.render(line, 1, BLACK)
+            surface.blit(text, (WIDTH - text.get_width() - ui(32), y))
+            y += ui(32)
     
     def process_events(self):
         for event in pygame.event.get():
             if event.type == pygame.QUIT:
                 self.done = True
 
+            elif event.type == pygame.VIDEORESIZE:
+                self.resize(self.display.get_size())
+
+            elif self.stage == Game.EDITING and event.type in [pygame.MOUSEBUTTONDOWN, pygame.MOUSEMOTION, pygame.MOUSEWHEEL]:
+                self.editor.handle_event(event)
+
             elif event.type == pygame.KEYDOWN:
-                if self.stage == Game.SPLASH or self.stage == Game.START:
+                if event.key == SCREENSHOT:
+                    capture.screenshot(self.window)
+
+                elif event.key == RECORD:
+                    capture.toggle_recording()
+
+                elif event.key == FRAME_STATS:
+                    self.show_frame_stats = not self.show_frame_stats
+
+                elif event.key == EDIT and self.stage in [Game.PLAYING, Game.PAUSED, Game.EDITING]:
+                    self.toggle_editor()
+
+                elif self.stage == Game.EDITING:
+                    self.editor.handle_event(event)
+
+                elif self.stage == Game.SPLASH or self.stage == Game.START:
                     self.stage = Game.PLAYING
                     play_music()
 
                 elif self.stage == Game.PLAYING:
                     if event.key == JUMP:
-                        self.hero.jump(self.level.blocks)
+                        self.hero.jump(self.level.tiles)
                     if event.key == PAUSE:
                         self.stage = Game.PAUSED
                     if event.key == DOWN:
@@ -1056,79 +3473,168 @@ class Game():
             else:
                 self.hero.stop()
 
-            
-        if self.hero.powerup_time != 0:
-            self.ticks += 1
-            if self.ticks % self.refresh_rate == 0:
-                self.hero.powerup_time -= 1
-                print(self.hero.powerup_time)
-            if self.hero.powerup_time == 0:
-                self.hero.normal_speed = 5
-                
-        if self.stage == Game.PLAYING and self.time_limit > 0:
-            self.timer_ticks += 1
-            if self.timer_ticks % self.refresh_rate == 0:
-                self.time_limit -= 1
-                
-            if self.time_limit == 0:
-                print("Times Up!")
-                self.hero.hearts = 0
-                self.timer_ticks = 0
-                self.time_limit = 300
-                
-    
+
+    def toggle_editor(self):
+        if self.stage == Game.EDITING:
+            self.stage = self.stage_before_edit
+        else:
+            # Opened before the stage changes, so it starts where the camera was
+            self.editor.open()
+            self.stage_before_edit = self.stage
+            self.stage = Game.EDITING
+
+    def apply_input(self, buttons):
+        # Does what process_events does with the keyboard while playing. JUMP
+        # acts like a key press, the other bits like keys being held down.
+        if self.stage != Game.PLAYING:
+            return
+
+        self.hero.apply_input(buttons, self.level.tiles)
+
+    def count_down(self):
+        self.time_limit -= 1
+
+        if self.time_limit == 0:
+            print("Times Up!")
+            telemetry.emit("time_up", self.timers.tick, self.hero.rect.x, self.hero.rect.y)
+            self.hero.hearts = 0
+            self.time_limit = 300
                 
     def update(self):
+        if self.hot_reloader is not None:
+            self.hot_reloader.poll()
+
+        if self.stage == Game.EDITING:
+            self.editor.update()
+
         if self.stage == Game.PLAYING:
+            # Timers fire before the hero updates so running out of time still costs a life
+            self.timers.advance()
+            self.level.update_platforms([self.hero] + self.level.enemies.sprites())
             self.hero.update(self.level)
+
+            if CHASE:
+                self.level.update_flow_fields(self.hero)
+
             self.level.enemies.update(self.level, self.hero)
+            particles.update()
+
+            if self.ghost_store is not None:
+                self.ghost_recorder.record(self.hero)
+
+                if self.ghost is not None:
+                    self.ghost.advance()
+
+            section = self.hero.rect.centerx // TELEMETRY_SECTION
+
+            if section != self.section:
+                telemetry.emit("section", self.timers.tick, self.hero.rect.x, self.hero.rect.y, section=section)
+                self.section = section
 
         if self.level.completed:
+            if self.stage == Game.PLAYING:
+                self.finish_run("completed")
+
             if self.current_level < len(levels) - 1:
                 self.stage = Game.LEVEL_COMPLETED
             else:
                 self.stage = Game.VICTORY
-            pygame.mixer.music.stop()
+            stop_music()
 
         elif self.hero.lives == 0:
+            if self.stage == Game.PLAYING:
+                self.finish_run("game_over")
+
             self.stage = Game.GAME_OVER
-            pygame.mixer.music.stop()
+            stop_music()
 
         elif self.hero.hearts == 0:
             self.level.reset(self)
             self.hero.respawn(self.level)
+            self.start_ghost()
+            memory.snapshot("death", self)
+
+
+    def finish_run(self, outcome):
+        run_history.record(self.level.level_name, outcome, self.hero, self.time_limit)
+        run_history.refresh(self.level.level_name)
+
+        if outcome == "completed" and self.ghost_store is not None:
+            self.ghost_store.save(self.level.file_path, self.ghost_recorder.finish(), len(self.hero.pose_images))
 
+    def start_ghost(self):
+        # Each life is recorded from the start point and raced against the
+        # best recording of the level so far
+        self.ghost = None
+
+        if self.ghost_store is not None:
+            self.ghost_recorder.start(self.hero)
+            data = self.ghost_store.load(self.level.file_path, len(self.hero.pose_images))
+
+            if data is not None:
+                self.ghost = Ghost(data, self.hero)
 
     def calculate_offset(self):
-        x = -1 * self.hero.rect.centerx + WIDTH / 2
+        if self.stage == Game.EDITING:
+            return self.editor.offset()
 
-        if self.hero.rect.centerx < WIDTH / 2:
-            x = 0
-        elif self.hero.rect.centerx > self.level.width - WIDTH / 2:
-            x = -1 * self.level.width + WIDTH
+        x = camera_offset(self.hero.rect.centerx, VIEW_WIDTH, self.level.width)
+        y = camera_offset(self.hero.rect.centery, VIEW_HEIGHT, self.level.height)
 
-        return x, 0
+        return x, y
 
     def draw(self):
+        self.render()
+        capture.frame(self.window)
+        self.present()
+
+    def render(self):
+        # Draws the frame into self.window, without showing it
         offset_x, offset_y = self.calculate_offset()
+        offset_x, offset_y = int(offset_x), int(offset_y)
+        settings = self.pacer.settings
+        level = self.level
+        window = self.window
 
-        self.level.active_layer.fill(TRANSPARENT)
-        self.level.active_sprites.draw(self.level.active_layer)
-        
+        if settings["parallax"]:
+            level.draw_backdrops(window, offset_x, offset_y)
+        else:
+            window.fill(level.background_color)
 
-        if self.hero.invincibility % 3 < 2:
-            self.level.active_layer.blit(self.hero.image, [self.hero.rect.x, self.hero.rect.y])
+        # Sprites are drawn straight onto the window, kept inside the level
+        window.set_clip(to_render_rect([offset_x, offset_y, level.width, level.height]))
+        level.inactive_layer.draw(window, offset_x, offset_y)
+        level.draw_sprites(window, level.active_sprites, offset_x, offset_y)
 
-        if self.level.chest_opened:
-            self.level.active_sprites2.draw(self.level.active_layer)
+        if self.ghost is not None:
+            self.ghost.draw(window, offset_x, offset_y)
 
-        self.window.blit(self.level.background_layer, [offset_x / 3, offset_y])
-        self.window.blit(self.level.scenery_layer, [offset_x / 2, offset_y])
-        self.window.blit(self.level.inactive_layer, [offset_x, offset_y])
-        self.window.blit(self.level.active_layer, [offset_x, offset_y])
+        if self.hero.invincibility % 3 < 2 or not settings["blink"]:
+            window.blit(scaled(self.hero.image), [to_render(self.hero.rect.x + offset_x), to_render(self.hero.rect.y + offset_y)])
+
+        if level.chest_opened:
+            level.draw_sprites(window, level.active_sprites2, offset_x, offset_y)
+
+        window.set_clip(None)
+
+        if settings["particles"]:
+            particles.draw(window, offset_x, offset_y)
+
+        if self.stage == Game.EDITING:
+            self.editor.draw(window)
+
+        # The HUD is only re-rendered every few frames at lower quality
+        if self.hud_age % settings["hud_interval"] == 0 or self.stage != Game.PLAYING:
+            self.hud_layer.fill(TRANSPARENT)
+            self.display_stats(self.hud_layer)
+            self.hud_age = 0
+
+        self.hud_age += 1
+        self.window.blit(self.hud_layer, [0, 0])
+
+        if self.show_frame_stats:
+            self.display_frame_stats(self.window)
 
-        self.display_stats(self.window)
-        
         if self.stage == Game.SPLASH:
             self.display_splash(self.window)
         elif self.stage == Game.START:
@@ -1140,19 +3646,20 @@ class Game():
         elif self.stage == Game.GAME_OVER:
             self.display_message(self.window, "Game Over", "Press 'R' to restart.")
 
-            
-        pygame.display.flip()
-
     def loop(self):
         while not self.done:
+            self.pacer.begin()
             self.process_events()
             self.update()
+            self.pacer.end_update()
             self.draw()
+            self.pacer.end_draw()
             self.clock.tick(FPS)
 
 if __name__ == "__main__":
     game = Game()
     game.start()
     game.loop()
+    capture.close()
     pygame.quit()
     sys.exit()
@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+
+# Generates levels in the same JSON format as levels/world-1.json.
+#
+# Levels are built left to right out of flat stretches, pits, steps and
+# floating platforms. Every pit and step is checked against the hero's jump
+# (jump power, run speed, gravity and terminal velocity, stepped the same way
+# Character.update does) so each generated level can be finished. Tile codes
+# are picked from each block's neighbours afterwards.
+#
+#   python level_gen.py --count 1000 --width 200 --difficulty 0.7 --out levels/generated
+
+import argparse
+import json
+import os
+import random
+import time
+
+os.environ.setdefault("PLATFORMER_HEADLESS", "1")
+
+import game
+
+HEIGHT = 10
+START_COLUMNS = 6 # Flat, enemy free ground at each end of the level
+END_COLUMNS = 8
+
+
+class JumpTable():
+    # How far the hero can get sideways while still at or above a given
+    # height, from stepping a running jump frame by frame.
+
+    def __init__(self, jump_power, speed, gravity, terminal_velocity):
+        self.points = []
+        vy = -jump_power
+        x = 0
+        height = 0
+
+        while height >= -HEIGHT * game.GRID_SIZE:
+            vy = min(vy + gravity, terminal_velocity)
+            height -= vy
+            x += speed
+            self.points.append((x, height))
+
+            if gravity <= 0:
+                break
+
+        self.max_height = max(h for x, h in self.points)
+
+    def reach(self, rise):
+        reach = [x for x, h in self.points if h >= rise]
+
+        if len(reach) == 0:
+            return -1
+
+        return max(reach)
+
+    def can_jump(self, gap, rise, slack):
+        # gap and rise in pixels, rise is positive when the landing is higher
+        return gap <= self.reach(rise) * slack and rise <= self.max_height * slack
+
+
+def tile_code(solid, x, y, width):
+    def filled(cx, cy):
+        # The ground carries on past the sides and bottom of the level
+        if cy >= HEIGHT or cx < 0 or cx >= width:
+            return True
+        if cy < 0:
+            return False
+
+        return solid[cy][cx]
+
+    if filled(x, y - 1):
+        return "CN"
+
+    left = filled(x - 1, y)
+    right = filled(x + 1, y)
+
+    if filled(x, y + 1):
+        if left and right:
+            return "TM"
+        elif right:
+            return "TL"
+        elif left:
+            return "TR"
+        else:
+            return "TP"
+    else:
+        if left and right:
+            return "TM"
+        elif right:
+            return "EL"
+        elif left:
+            return "ER"
+        else:
+            return "LF"
+
+
+class LevelGenerator():
+
+    def __init__(self, jumps, gravity, terminal_velocity):
+        self.jumps = jumps
+        self.gravity = gravity
+        self.terminal_velocity = terminal_velocity
+
+    def generate(self, seed, width, difficulty, name=None):
+        rng = random.Random(seed)
+        width = max(width, START_COLUMNS + END_COLUMNS + 1)
+        slack = 0.6 + 0.3 * difficulty # Share of the hero's best jump a level may ask for
+
+        solid = [[False] * width for y in range(HEIGHT)]
+        used = set()
+        tops = [None] * width # Top ground row of each column, None for pits
+
+        entities = {key: [] for key in ['bears', 'monsters', 'birds', 'coins', 'oneups', 'hearts', 'speedups',
+                                        'speeddowns', 'keys', 'chests', 'prizes', 'alt_coin', 'flag']}
+
+        def fill_column(x, top):
+            tops[x] = top
+
+            for y in range(top, HEIGHT):
+                solid[y][x] = True
+
+        def place(key, x, y):
+            if 0 <= y < HEIGHT and not solid[y][x] and (x, y) not in used:
+                used.add((x, y))
+                entities[key].append([x, y])
+                return True
+
+            return False
+
+        # Ground
+        top = HEIGHT - 1
+        x = 0
+
+        for x in range(START_COLUMNS):
+            fill_column(x, top)
+
+        x = START_COLUMNS
+        last_x = width - END_COLUMNS
+        flats = []
+        pits = []
+
+        while x < last_x:
+            roll = rng.random()
+
+            if roll < 0.2 + 0.25 * difficulty:
+                # Pit, then the ground picks up again at a reachable height
+                gap = rng.randint(1, 2 + int(3 * difficulty))
+                new_top = min(HEIGHT - 1, max(HEIGHT - 4, top + rng.randint(-1, 1)))
+                rise = (top - new_top) * game.GRID_SIZE
+
+                while gap > 1 and not self.jumps.can_jump(gap * game.GRID_SIZE, rise, slack):
+                    gap -= 1
+
+                if not self.jumps.can_jump(gap * game.GRID_SIZE, rise, slack) or x + gap >= last_x:
+                    fill_column(x, top)
+                    x += 1
+                    continue
+
+                pits.append((x, gap, min(top, new_top)))
+                x += gap
+                top = new_top
+
+            elif roll < 0.35 + 0.25 * difficulty:
+                # Step up or down
+                step = rng.choice([-2, -1, 1, 2])
+                new_top = min(HEIGHT - 1, max(HEIGHT - 5, top - step))
+
+                if not self.jumps.can_jump(0, (top - new_top) * game.GRID_SIZE, slack):
+                    new_top = top
+
+                top = new_top
+
+            length = rng.randint(3, 8)
+            start = x
+
+            for x in range(x, min(x + length, last_x)):
+                fill_column(x, top)
+
+            x += 1
+            flats.append((start, x, top))
+
+        for x in range(last_x, width):
+            fill_column(x, top)
+
+        flats.append((last_x, width, top))
+
+        # Flag near the end, on the ground
+        flag_x = width - 3
+
+        for y in range(tops[flag_x] - 4, tops[flag_x]):
+            used.add((flag_x, y))
+            entities['flag'].append([flag_x, y])
+
+        # Floating platforms over flats and pits, always optional to use
+        for start, end, top in flats:
+            if end - start >= 4 and rng.random() < 0.5:
+                row = top - rng.randint(2, 3)
+                length = rng.randint(1, min(4, end - start - 2))
+                px = rng.randint(start + 1, end - length - 1) # Keep clear of both ends so steps stay jumpable
+
+                if row >= 1 and self.jumps.can_jump(game.GRID_SIZE, (top - row) * game.GRID_SIZE, slack):
+                    for i in range(length):
+                        solid[row][px + i] = True
+
+                    if length >= 2 and rng.random() < 0.3 + 0.5 * difficulty:
+                        place('monsters', px + rng.randrange(length), row - 1)
+
+                    for i in range(length):
+                        if rng.random() < 0.5:
+                            place('coins', px + i, row - 1)
+
+        for x, gap, top in pits:
+            # A line of coins over the pit, showing where to jump
+            for i in range(gap):
+                if rng.random() < 0.7:
+                    place('coins', x + i, top - 2)
+
+        # Enemies and pickups on the flats
+        for start, end, top in flats:
+            if start < START_COLUMNS or end > last_x:
+                continue
+
+            for x in range(start, end):
+                roll = rng.random()
+
+                if roll < 0.08 + 0.15 * difficulty:
+                    place('bears', x, top - 1)
+                elif roll < 0.1 + 0.2 * difficulty:
+                    place('birds', x, top - 2)
+                elif roll < 0.3:
+                    place('coins', x, top - 1 - rng.randint(1, 2))
+                elif roll < 0.32:
+                    place('alt_coin', x, top - 3)
+                elif roll < 0.34 - 0.02 * difficulty:
+                    place(rng.choice(['oneups', 'hearts', 'speedups', 'speeddowns']), x, top - 1)
+
+        # A key somewhere in the first half and its chest later on
+        if rng.random() < 0.5 and len(flats) > 3:
+            middle = len(flats) // 2
+            start, end, top = rng.choice(flats[1:middle])
+            key_x = rng.randrange(start, end)
+
+            start, end, top = rng.choice(flats[middle:])
+            chest_x = rng.randrange(start, end)
+
+            if place('keys', key_x, tops[key_x] - 1) and place('chests', chest_x, top - 1):
+                place('prizes', chest_x, top - 2)
+
+        blocks = []
+
+        for y in range(HEIGHT):
+            for x in range(width):
+                if solid[y][x]:
+                    blocks.append([x, y, tile_code(solid, x, y, width)])
+
+        level = {"name": name or "Level " + str(seed),
+                 "width": width,
+                 "height": HEIGHT,
+                 "background-color": [130, 182, 255],
+                 "background-img": "assets/backgrounds/mountains.png",
+                 "background-position": "top",
+                 "background-repeat-x": 1,
+                 "background-fill-y": 1,
+                 "scenery-img": "assets/backgrounds/forest.png",
+                 "scenery-position": "bottom",
+                 "scenery-repeat-x": 1,
+                 "scenery-fill-y": 1,
+                 "music": "assets/sounds/theme_of_the wanderer.ogg",
+                 "start": [1, tops[1] - 1],
+                 "gravity": self.gravity,
+                 "terminal-velocity": self.terminal_velocity,
+                 "blocks": blocks}
+
+        level.update(entities)
+
+        return level
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate platformer levels.")
+    parser.add_argument("--count", type=int, default=10)
+    parser.add_argument("--width", type=int, default=120, help="level width in tiles")
+    parser.add_argument("--difficulty", type=float, default=0.5, help="0 (easy) to 1 (hard)")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the first level, the rest count up from it")
+    parser.add_argument("--gravity", type=float, default=1.0)
+    parser.add_argument("--terminal-velocity", type=float, default=32)
+    parser.add_argument("--out", default="levels/generated")
+    args = parser.parse_args()
+
+    hero = game.Character(game.hero_images, game.Scheduler())
+    jumps = JumpTable(hero.jump_power, hero.normal_speed, args.gravity, args.terminal_velocity)
+    generator = LevelGenerator(jumps, args.gravity, args.terminal_velocity)
+    difficulty = min(1.0, max(0.0, args.difficulty))
+
+    os.makedirs(args.out, exist_ok=True)
+    start = time.perf_counter()
+
+    for seed in range(args.seed, args.seed + args.count):
+        level = generator.generate(seed, args.width, difficulty)
+
+        with open(os.path.join(args.out, "level-" + str(seed) + ".json"), 'w') as f:
+            json.dump(level, f, separators=(",", ":"))
+
+    elapsed = time.perf_counter() - start
+    print("Wrote", args.count, "levels to", args.out, "in", round(elapsed, 2), "s,", int(args.count / elapsed), "levels per second")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,779 @@
+#!/usr/bin/env python3
+
+# Local multiplayer. A server process owns the only real copy of the level
+# and runs it at a fixed tick rate with one Character per player. Clients
+# send their buttons over UDP and get back snapshots holding only the heroes,
+# enemies and items that changed since the last snapshot they acknowledged.
+#
+# Each client moves its own hero straight away (prediction). When a snapshot
+# says which of its inputs the server has used, the client takes the
+# server's hero, replays the inputs the server hasn't seen yet on top, and
+# carries on from there (reconciliation).
+#
+#   python netplay.py --host               start a server and play on it
+#   python netplay.py --connect 127.0.0.1  join another player's server
+#   python netplay.py --test --clients 4   loopback harness: snapshot sizes and round trip times
+
+import argparse
+import collections
+import os
+import random
+import select
+import socket
+import struct
+import subprocess
+import sys
+import time
+
+if "--server" in sys.argv or "--test" in sys.argv:
+    os.environ.setdefault("PLATFORMER_HEADLESS", "1")
+
+if "--server" in sys.argv:
+    os.environ.setdefault("SDL_NO_SIGNAL_HANDLERS", "1") # So terminate() stops the server process
+
+import pygame
+
+import game
+
+PORT = 47800
+TICK_RATE = 60
+MAX_PLAYERS = 8
+HISTORY = 64 # Snapshots the server keeps to diff against
+INPUT_REDUNDANCY = 4 # Each input packet repeats this many of the latest inputs, in case one is lost
+MAX_QUEUED_INPUTS = 8 # The server drops the oldest inputs past this, so a fast client can't build up lag
+TIMEOUT = 5.0 # Seconds without a packet before the server drops a player
+MAX_PACKET = 1200 # Snapshots past this many bytes are sent in parts, so big levels still fit in datagrams
+
+# Packet types
+JOIN = 0
+WELCOME = 1
+INPUT = 2
+SNAPSHOT = 3
+LEAVE = 4
+
+WELCOME_FORMAT = struct.Struct("<BBB")          # type, player, tick rate; followed by the level path
+INPUT_FORMAT = struct.Struct("<BIIB")           # type, newest input seq, newest snapshot tick, input count; then one byte per input
+SNAPSHOT_FORMAT = struct.Struct("<BIIIBBHHH")   # type, tick, baseline tick, last input seq used, players, flags, time left, part, parts
+
+# Snapshot records, the first byte says which
+HERO = 0
+ENEMY = 1
+ITEM = 2
+PLATFORM = 3
+
+RECORDS = {HERO: struct.Struct("<BBiiffBBBBBiH"),   # kind, player, x, y, vx, vy, speed, pose, flags, hearts, lives, score, invincibility
+           ENEMY: struct.Struct("<BHiiBB"),         # kind, index, x, y, frame, alive
+           ITEM: struct.Struct("<BHB"),             # kind, index, alive
+           PLATFORM: struct.Struct("<BHii")}        # kind, index, x, y
+
+# Hero flags
+ON_GROUND = 1
+FACING_RIGHT = 2
+CROUCHING = 4
+HAS_KEY = 8
+
+# Snapshot flags
+CHEST_OPENED = 1
+
+
+def enemy_frame(e):
+    if e.image in e.images_right:
+        return 128 | e.images_right.index(e.image)
+    elif e.image in e.images_left:
+        return e.images_left.index(e.image)
+
+    return 0
+
+
+def level_items(level):
+    return (level.starting_coins + level.starting_alt_coins + level.starting_powerups + level.starting_keys +
+            level.starting_chests + level.starting_prizes)
+
+
+def pack_hero(player, hero):
+    flags = 0
+
+    if hero.on_ground:
+        flags |= ON_GROUND
+    if hero.facing_right:
+        flags |= FACING_RIGHT
+    if hero.crouching:
+        flags |= CROUCHING
+    if hero.has_key:
+        flags |= HAS_KEY
+
+    return RECORDS[HERO].pack(HERO, player, hero.rect.x, hero.rect.y, hero.vx, hero.vy, hero.speed,
+                              hero.poses.get(hero.image, 0), flags, max(0, hero.hearts), hero.lives,
+                              hero.score, min(hero.invincibility, 0xffff))
+
+
+def unpack_hero(hero, record):
+    kind, player, x, y, vx, vy, speed, pose, flags, hearts, lives, score, invincibility = RECORDS[HERO].unpack(record)
+
+    hero.rect.x = x
+    hero.rect.y = y
+    hero.vx = vx
+    hero.vy = vy
+    hero.speed = speed
+    hero.image = hero.pose_images[pose]
+    hero.on_ground = flags & ON_GROUND != 0
+    hero.facing_right = flags & FACING_RIGHT != 0
+    hero.crouching = flags & CROUCHING != 0
+    hero.has_key = flags & HAS_KEY != 0
+    hero.hearts = hearts
+    hero.lives = lives
+    hero.score = score
+    hero.invincibility = invincibility
+
+
+def records_valid(data, i, counts):
+    # Whether data from i on is whole records of known kinds, each for an
+    # entity that exists. counts is how many there are of each kind.
+    while i < len(data):
+        fmt = RECORDS.get(data[i])
+
+        if fmt is None or i + fmt.size > len(data):
+            return False
+
+        number = struct.unpack_from("<H" if data[i] != HERO else "<B", data, i + 1)[0]
+
+        if number >= counts[data[i]]:
+            return False
+
+        i += fmt.size
+
+    return True
+
+
+def read_records(data, i):
+    # Yields (key, record) pairs, the key names the entity the record is for
+    while i < len(data):
+        fmt = RECORDS[data[i]]
+        record = data[i:i + fmt.size]
+        yield (data[i], struct.unpack_from("<H" if data[i] != HERO else "<B", data, i + 1)[0]), record
+        i += fmt.size
+
+
+class Player():
+
+    def __init__(self, number, address, hero):
+        self.number = number
+        self.address = address
+        self.hero = hero
+        self.inputs = collections.deque()
+        self.newest_input = 0 # Highest input seq received
+        self.used_input = 0 # Highest input seq the simulation has used
+        self.buttons = 0
+        self.baseline = 0 # Newest snapshot the client has
+        self.last_heard = time.perf_counter()
+
+
+class Server():
+
+    def __init__(self, level_path, port=PORT, tick_rate=TICK_RATE):
+        self.level_path = level_path
+        self.tick_rate = tick_rate
+        self.timers = game.Scheduler()
+        self.level = game.Level(level_path, self.timers)
+        self.level.reset(self)
+        self.enemies = list(self.level.starting_enemies)
+        self.items = level_items(self.level)
+        self.platforms = self.level.platforms.sprites()
+        self.players = {} # Address -> Player
+        self.tick = 0
+        self.history = collections.OrderedDict() # Tick -> {key: record}
+        self.time_limit = 300
+        self.timers.every(game.refresh_rate, self.count_down)
+
+        # Character.check_flag reads the time limit from the running game
+        game.game = self
+
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind(("", port))
+        self.socket.setblocking(False)
+        self.port = self.socket.getsockname()[1]
+
+    def count_down(self):
+        self.time_limit -= 1
+
+        if self.time_limit == 0:
+            self.restart()
+
+    def restart(self):
+        self.level.reset(self)
+        self.level.completed = False
+        self.time_limit = 300
+
+        for player in self.players.values():
+            player.hero.respawn(self.level)
+
+    def receive(self):
+        while True:
+            try:
+                data, address = self.socket.recvfrom(2048)
+            except (BlockingIOError, ConnectionResetError):
+                return
+
+            if len(data) == 0:
+                continue
+
+            player = self.players.get(address)
+
+            if data[0] == JOIN:
+                self.join(address)
+            elif data[0] == INPUT and player is not None:
+                self.read_input(player, data)
+            elif data[0] == LEAVE and player is not None:
+                del self.players[address]
+
+    def join(self, address):
+        if address not in self.players:
+            taken = [p.number for p in self.players.values()]
+            free = [n for n in range(MAX_PLAYERS) if n not in taken]
+
+            if len(free) == 0:
+                return
+
+            hero = game.Character(game.hero_images, self.timers)
+            hero.respawn(self.level)
+            self.players[address] = Player(free[0], address, hero)
+
+        player = self.players[address]
+        path = self.level_path.encode("utf-8")
+        self.socket.sendto(WELCOME_FORMAT.pack(WELCOME, player.number, self.tick_rate) + path, address)
+
+    def read_input(self, player, data):
+        # Short or garbled packets are dropped
+        if len(data) < INPUT_FORMAT.size:
+            return
+
+        kind, seq, baseline, count = INPUT_FORMAT.unpack_from(data)
+
+        if len(data) < INPUT_FORMAT.size + count or count > seq:
+            return
+
+        buttons = data[INPUT_FORMAT.size:INPUT_FORMAT.size + count]
+        player.last_heard = time.perf_counter()
+
+        if baseline in self.history:
+            player.baseline = max(player.baseline, baseline)
+
+        # The packet holds inputs seq - count + 1 to seq, only new ones are queued
+        for i, b in enumerate(buttons):
+            input_seq = seq - count + 1 + i
+
+            if input_seq > player.newest_input:
+                player.inputs.append((input_seq, b))
+                player.newest_input = input_seq
+
+        while len(player.inputs) > MAX_QUEUED_INPUTS:
+            player.used_input = player.inputs.popleft()[0]
+
+    def step(self):
+        self.receive()
+        self.tick += 1
+        self.timers.advance()
+
+        now = time.perf_counter()
+
+        for address, player in list(self.players.items()):
+            if now - player.last_heard > TIMEOUT:
+                del self.players[address]
+
+        heroes = [p.hero for p in self.players.values()]
+        self.level.update_platforms(heroes + self.level.enemies.sprites())
+
+        for player in self.players.values():
+            # With nothing new from a client its last buttons are held down
+            if len(player.inputs) > 0:
+                player.used_input, player.buttons = player.inputs.popleft()
+
+            player.hero.apply_input(player.buttons, self.level.tiles)
+            player.hero.update(self.level)
+
+        if len(heroes) > 0:
+            for e in self.level.enemies.sprites():
+                nearest = min(heroes, key=lambda h: abs(h.rect.x - e.rect.x))
+                e.update(self.level, nearest)
+
+        for player in self.players.values():
+            if player.hero.hearts <= 0:
+                if player.hero.lives <= 0:
+                    player.hero.lives = 3
+
+                player.hero.respawn(self.level)
+
+        if self.level.completed:
+            self.restart()
+
+        self.send_snapshots()
+
+    def world_state(self):
+        state = {}
+
+        for player in self.players.values():
+            state[(HERO, player.number)] = pack_hero(player.number, player.hero)
+
+        for i, e in enumerate(self.enemies):
+            state[(ENEMY, i)] = RECORDS[ENEMY].pack(ENEMY, i, e.rect.x, e.rect.y, enemy_frame(e), e.alive())
+
+        for i, item in enumerate(self.items):
+            state[(ITEM, i)] = RECORDS[ITEM].pack(ITEM, i, item.alive())
+
+        for i, platform in enumerate(self.platforms):
+            state[(PLATFORM, i)] = RECORDS[PLATFORM].pack(PLATFORM, i, platform.rect.x, platform.rect.y)
+
+        return state
+
+    def send_snapshots(self):
+        state = self.world_state()
+        self.history[self.tick] = state
+
+        while len(self.history) > HISTORY:
+            self.history.popitem(last=False)
+
+        mask = 0
+
+        for player in self.players.values():
+            mask |= 1 << player.number
+
+        flags = CHEST_OPENED if self.level.chest_opened else 0
+
+        for player in self.players.values():
+            baseline = player.baseline if player.baseline in self.history else 0
+            old = self.history.get(baseline, {})
+            changed = [record for key, record in state.items() if old.get(key) != record]
+
+            # Records are never split, each part can be checked on its own
+            parts = [[]]
+            size = SNAPSHOT_FORMAT.size
+
+            for record in changed:
+                if size + len(record) > MAX_PACKET and len(parts[-1]) > 0:
+                    parts.append([])
+                    size = SNAPSHOT_FORMAT.size
+
+                parts[-1].append(record)
+                size += len(record)
+
+            for i, part in enumerate(parts):
+                header = SNAPSHOT_FORMAT.pack(SNAPSHOT, self.tick, baseline, player.used_input, mask, flags,
+                                              self.time_limit, i, len(parts))
+
+                try:
+                    self.socket.sendto(header + b"".join(part), player.address)
+                except BlockingIOError:
+                    # The rest of the tick is dropped like a lost packet, the
+                    # client hasn't acknowledged it so the next one has it all again
+                    break
+
+    def run(self, seconds=None):
+        interval = 1 / self.tick_rate
+        next_tick = time.perf_counter()
+        stop = None if seconds is None else next_tick + seconds
+
+        while stop is None or next_tick < stop:
+            wait = next_tick - time.perf_counter()
+
+            if wait > 0:
+                # Inputs that come in while waiting are queued for the next tick
+                select.select([self.socket], [], [], wait)
+                self.receive()
+                continue
+
+            self.step()
+            next_tick += interval
+
+            # Don't try to catch up on more than a few ticks after a stall
+            next_tick = max(next_tick, time.perf_counter() - 4 * interval)
+
+
+class Client():
+
+    def __init__(self, host="127.0.0.1", port=PORT, timeout=5.0):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.connect((host, port))
+
+        welcome = self.join(timeout)
+        kind, self.number, self.tick_rate = WELCOME_FORMAT.unpack_from(welcome)
+        level_path = welcome[WELCOME_FORMAT.size:].decode("utf-8")
+
+        self.socket.setblocking(False)
+        self.timers = game.Scheduler()
+        self.level = game.Level(level_path, self.timers)
+        self.level.reset(self)
+        self.enemies = list(self.level.starting_enemies)
+        self.items = level_items(self.level)
+        self.platforms = self.level.platforms.sprites()
+        self.hero = game.Character(game.hero_images, self.timers)
+        self.hero.respawn(self.level)
+        self.others = {} # Player number -> Character, drawn where the server last put them
+        self.enemy_state = [(e.rect.x, e.rect.y, enemy_frame(e), True) for e in self.enemies]
+        self.item_alive = [True] * len(self.items)
+        self.chest_opened = False
+        self.time_limit = 300
+
+        self.seq = 0
+        self.pending = collections.deque() # (seq, buttons, predicted position, sent time) not yet used by the server
+        self.recent = collections.deque(maxlen=INPUT_REDUNDANCY)
+        self.snapshots = collections.OrderedDict() # Tick -> {key: record}
+        self.parts = {} # Tick -> {part: packet} for snapshots still coming in
+        self.newest = 0
+        self.acked = 0
+
+        # Measurements for the test harness
+        self.snapshot_sizes = []
+        self.round_trips = []
+        self.corrections = 0
+
+    def join(self, timeout):
+        self.socket.settimeout(0.25)
+        give_up = time.perf_counter() + timeout
+
+        while time.perf_counter() < give_up:
+            self.socket.send(bytes([JOIN]))
+
+            try:
+                data = self.socket.recv(2048)
+            except (socket.timeout, ConnectionRefusedError):
+                continue
+
+            if len(data) > WELCOME_FORMAT.size and data[0] == WELCOME:
+                return data
+
+        raise ConnectionError("no answer from the server")
+
+    def leave(self):
+        try:
+            self.socket.send(bytes([LEAVE]))
+        except OSError:
+            # The server is already gone
+            pass
+
+        self.socket.close()
+
+    def predict(self, buttons):
+        # The movement half of Character.update, pickups and enemies are left to the server
+        hero = self.hero
+        hero.apply_input(buttons, self.level.tiles)
+        hero.apply_gravity(self.level)
+        hero.move_and_process_blocks(self.level.tiles)
+        hero.check_world_boundaries(self.level)
+        hero.crouch()
+        hero.animate()
+
+    def send_input(self, buttons):
+        self.seq += 1
+        self.recent.append(buttons)
+
+        packet = INPUT_FORMAT.pack(INPUT, self.seq, self.newest, len(self.recent)) + bytes(self.recent)
+        self.socket.send(packet)
+
+        self.timers.advance()
+        self.predict(buttons)
+        self.pending.append((self.seq, buttons, self.hero.rect.topleft, time.perf_counter()))
+
+    def receive(self):
+        newest = None
+
+        while True:
+            try:
+                data = self.socket.recv(65536)
+            except (BlockingIOError, ConnectionRefusedError):
+                break
+
+            if len(data) > 0 and data[0] == SNAPSHOT:
+                data = self.reassemble(data)
+                state = self.read_snapshot(data) if data is not None else None
+
+                if state is not None:
+                    newest = state
+
+        if newest is not None:
+            self.apply(*newest)
+
+    def reassemble(self, data):
+        # A snapshot sent in parts is only read once they're all here, as one
+        # packet. Parts of a tick that never completes are dropped with it.
+        if len(data) < SNAPSHOT_FORMAT.size:
+            return None
+
+        header = SNAPSHOT_FORMAT.unpack_from(data)
+        tick, part, parts = header[1], header[-2], header[-1]
+
+        if parts == 1:
+            return data
+
+        if tick <= self.newest or part >= parts:
+            return None
+
+        received = self.parts.setdefault(tick, {})
+        received[part] = data
+
+        for t in [t for t in self.parts if t <= self.newest or t < tick - HISTORY]:
+            del self.parts[t]
+
+        if sorted(received) != list(range(parts)):
+            return None
+
+        del self.parts[tick]
+
+        return data[:SNAPSHOT_FORMAT.size] + b"".join(received[i][SNAPSHOT_FORMAT.size:] for i in range(parts))
+
+    def read_snapshot(self, data):
+        if len(data) < SNAPSHOT_FORMAT.size:
+            return None
+
+        kind, tick, baseline, used_input, mask, flags, time_limit, part, parts = SNAPSHOT_FORMAT.unpack_from(data)
+
+        if tick <= self.newest or (baseline != 0 and baseline not in self.snapshots):
+            return None
+
+        counts = {HERO: MAX_PLAYERS, ENEMY: len(self.enemies), ITEM: len(self.items), PLATFORM: len(self.platforms)}
+
+        if not records_valid(data, SNAPSHOT_FORMAT.size, counts):
+            return None
+
+        self.snapshot_sizes.append(len(data))
+
+        state = dict(self.snapshots[baseline]) if baseline != 0 else {}
+
+        for key, record in read_records(data, SNAPSHOT_FORMAT.size):
+            state[key] = record
+
+        # Players that left are dropped from the state as well
+        for key in [k for k in state if k[0] == HERO and not mask & (1 << k[1])]:
+            del state[key]
+
+        self.snapshots[tick] = state
+        self.newest = tick
+
+        while len(self.snapshots) > HISTORY:
+            self.snapshots.popitem(last=False)
+
+        self.chest_opened = flags & CHEST_OPENED != 0
+        self.time_limit = time_limit
+
+        return state, used_input
+
+    def apply(self, state, used_input):
+        now = time.perf_counter()
+
+        for key, record in state.items():
+            kind, number = key
+
+            if kind == HERO and number != self.number:
+                if number not in self.others:
+                    self.others[number] = game.Character(game.hero_images, game.Scheduler())
+
+                unpack_hero(self.others[number], record)
+            elif kind == ENEMY:
+                k, i, x, y, frame, alive = RECORDS[ENEMY].unpack(record)
+                self.enemy_state[i] = (x, y, frame, alive)
+            elif kind == ITEM:
+                k, i, alive = RECORDS[ITEM].unpack(record)
+                self.item_alive[i] = alive != 0
+            elif kind == PLATFORM:
+                k, i, x, y = RECORDS[PLATFORM].unpack(record)
+
+                if self.platforms[i].rect.topleft != (x, y):
+                    self.level.move_platform(self.platforms[i], x, y)
+
+        for number in [n for n in self.others if (HERO, n) not in state]:
+            del self.others[number]
+
+        if (HERO, self.number) not in state:
+            return
+
+        # Reconcile: start from the server's hero and replay what it hasn't used yet
+        predicted = None
+
+        while len(self.pending) > 0 and self.pending[0][0] <= used_input:
+            seq, buttons, predicted, sent = self.pending.popleft()
+
+            if seq > self.acked:
+                self.round_trips.append(now - sent)
+
+        self.acked = max(self.acked, used_input)
+        unpack_hero(self.hero, state[(HERO, self.number)])
+
+        if predicted is not None and predicted != self.hero.rect.topleft:
+            self.corrections += 1
+
+        sound_on = game.sound_on
+        game.sound_on = False
+
+        for seq, buttons, position, sent in self.pending:
+            self.predict(buttons)
+
+        game.sound_on = sound_on
+
+    def calculate_offset(self):
+        x = game.camera_offset(self.hero.rect.centerx, game.VIEW_WIDTH, self.level.width)
+        y = game.camera_offset(self.hero.rect.centery, game.VIEW_HEIGHT, self.level.height)
+
+        return x, y
+
+    def draw(self, surface):
+        level = self.level
+        offset_x, offset_y = self.calculate_offset()
+        offset_x, offset_y = int(offset_x), int(offset_y)
+        level.draw_backdrops(surface, offset_x, offset_y)
+        surface.set_clip(game.to_render_rect([offset_x, offset_y, level.width, level.height]))
+        level.inactive_layer.draw(surface, offset_x, offset_y)
+        level.draw_sprites(surface, self.platforms, offset_x, offset_y)
+        items = [item for item, alive in zip(self.items, self.item_alive)
+                 if alive and (self.chest_opened or item not in level.starting_prizes)]
+        level.draw_sprites(surface, items, offset_x, offset_y)
+
+        for e, (x, y, frame, alive) in zip(self.enemies, self.enemy_state):
+            if alive:
+                images = e.images_right if frame & 128 else e.images_left
+                image = game.scaled(images[(frame & 127) % len(images)])
+                surface.blit(image, [game.to_render(x + offset_x), game.to_render(y + offset_y)])
+
+        level.draw_sprites(surface, list(self.others.values()) + [self.hero], offset_x, offset_y)
+
+        surface.set_clip(None)
+
+        text = game.FONT_SM.render("Player " + str(self.number + 1) + "   Score: " + str(self.hero.score) +
+                                   "   Time left: " + str(self.time_limit), 1, game.WHITE)
+        surface.blit(text, (game.ui(32), game.ui(32)))
+
+
+def read_buttons():
+    pressed = pygame.key.get_pressed()
+    buttons = 0
+
+    if pressed[game.LEFT]:
+        buttons |= game.INPUT_LEFT
+    elif pressed[game.RIGHT]:
+        buttons |= game.INPUT_RIGHT
+
+    if pressed[game.DOWN]:
+        buttons |= game.INPUT_DOWN
+
+    return buttons
+
+
+def play(client):
+    window = pygame.display.set_mode([game.WIDTH, game.HEIGHT])
+    pygame.display.set_caption(game.TITLE + " - player " + str(client.number + 1))
+    clock = pygame.time.Clock()
+    jump = False
+    running = True
+
+    while running:
+        for event in pygame.event.get():
+            if event.type == pygame.QUIT:
+                running = False
+            elif event.type == pygame.KEYDOWN and event.key == game.JUMP:
+                jump = True
+
+        buttons = read_buttons()
+
+        if jump:
+            buttons |= game.INPUT_JUMP
+            jump = False
+
+        client.receive()
+        client.send_input(buttons)
+        client.draw(window)
+        pygame.display.flip()
+        clock.tick(client.tick_rate)
+
+    client.leave()
+
+
+def start_server(level_path, port):
+    args = [sys.executable, os.path.abspath(__file__), "--server", "--port", str(port), level_path]
+
+    return subprocess.Popen(args)
+
+
+def percentile(values, p):
+    values = sorted(values)
+
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def test(level_path, port, clients, seconds, seed):
+    # Runs a server process and some clients pressing random buttons, then
+    # reports what went over the wire
+    server = start_server(level_path, port)
+    rng = random.Random(seed)
+
+    try:
+        players = [Client("127.0.0.1", port) for i in range(clients)]
+        held = [0] * clients
+        interval = 1 / players[0].tick_rate
+        next_tick = time.perf_counter()
+        stop = next_tick + seconds
+
+        while next_tick < stop:
+            wait = next_tick - time.perf_counter()
+
+            if wait > 0:
+                time.sleep(wait)
+
+            for i, client in enumerate(players):
+                if rng.random() < 0.05:
+                    held[i] = rng.choice([0, game.INPUT_LEFT, game.INPUT_RIGHT, game.INPUT_RIGHT, game.INPUT_DOWN])
+
+                buttons = held[i] | (game.INPUT_JUMP if rng.random() < 0.03 else 0)
+                client.receive()
+                client.send_input(buttons)
+
+            next_tick += interval
+
+        for client in players:
+            client.leave()
+    finally:
+        server.terminate()
+        server.wait()
+
+    sizes = [s for c in players for s in c.snapshot_sizes]
+    trips = [t * 1000 for c in players for t in c.round_trips]
+    inputs = sum(c.seq for c in players)
+
+    print(clients, "clients for", seconds, "s at", players[0].tick_rate, "ticks per second")
+    print("snapshots:", len(sizes), " bytes: first", players[0].snapshot_sizes[0], " mean", round(sum(sizes) / len(sizes), 1),
+          " p95", percentile(sizes, 0.95), " max", max(sizes))
+    print("bandwidth per client:", round(sum(sizes) / clients / seconds / 1024, 2), "kB/s")
+    print("round trip ms: mean", round(sum(trips) / len(trips), 2), " p95", round(percentile(trips, 0.95), 2),
+          " max", round(max(trips), 2))
+    print("predictions corrected:", sum(c.corrections for c in players), "of", inputs, "inputs")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local network multiplayer.")
+    parser.add_argument("level", nargs="?", default=game.levels[0])
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--server", action="store_true", help="run a server without a window")
+    parser.add_argument("--host", action="store_true", help="run a server and join it")
+    parser.add_argument("--connect", metavar="HOST", help="join a server")
+    parser.add_argument("--test", action="store_true", help="measure snapshot sizes and round trips over loopback")
+    parser.add_argument("--clients", type=int, default=2)
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.server:
+        Server(args.level, args.port).run()
+    elif args.test:
+        test(args.level, args.port, args.clients, args.seconds, args.seed)
+    elif args.host:
+        server = start_server(args.level, args.port)
+
+        try:
+            play(Client("127.0.0.1", args.port))
+        finally:
+            server.terminate()
+    else:
+        play(Client(args.connect or "127.0.0.1", args.port))
+
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
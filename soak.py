@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+
+# Goes round the game's transitions over and over, headless: a fresh game
+# (Game.reset), some random play, a death (Level.reset) and moving on to
+# the next level (Game.advance). Memory tracking is on, so anything that
+# piles up from one cycle to the next is reported.
+#
+#   python soak.py --cycles 20 --ticks 600
+
+import argparse
+import os
+import random
+import time
+
+os.environ.setdefault("PLATFORMER_HEADLESS", "1")
+os.environ["PLATFORMER_MEMORY"] = "1"
+
+import game
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Repeat level loads, deaths and resets, watching memory.")
+    parser.add_argument("level", nargs="?", default=game.levels[0])
+    parser.add_argument("--cycles", type=int, default=10)
+    parser.add_argument("--ticks", type=int, default=600, help="ticks of random play each cycle")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    # Advancing needs somewhere to go
+    game.levels = [args.level, args.level]
+    g = game.Game()
+    game.game = g
+    rng = random.Random(args.seed)
+    start = time.perf_counter()
+
+    for cycle in range(args.cycles):
+        g.reset()
+        g.stage = game.Game.PLAYING
+
+        for i in range(args.ticks):
+            if g.stage != game.Game.PLAYING:
+                break
+
+            g.apply_input(rng.choice([0, game.INPUT_RIGHT, game.INPUT_RIGHT | game.INPUT_JUMP, game.INPUT_LEFT]))
+            g.update()
+
+        if g.stage == game.Game.PLAYING:
+            g.hero.hearts = 0
+            g.update()
+
+        g.advance()
+
+    elapsed = time.perf_counter() - start
+
+    for line in game.memory.report():
+        print(line)
+
+    print(args.cycles, "cycles in", round(elapsed, 2), "s")
+
+    return 1 if len(game.memory.warnings) > 0 else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())